@@ -0,0 +1,61 @@
+"""
+Throughput and latency of the catalog read endpoints served by the sync
+views through WSGI versus the async views through ASGI.
+
+Both handlers are driven in-process against the same seeded SQLite database:
+WSGI requests from a pool of `--concurrency` threads (as a threaded WSGI
+server would), ASGI requests as `--concurrency` concurrent tasks on one event
+loop (as uvicorn/daphne would). Network and server overhead are left out, so
+the numbers compare Django's request paths, not deployments.
+
+    cd ecommerce_project
+    python benchmarks/asgi_vs_wsgi.py --products 2000 --requests 2000 --concurrency 64 --json run.json
+"""
+import argparse
+
+import harness
+import seed
+from harness import Request
+
+LABELS = ['mode', 'path']
+# mode -> (transport, URLconf)
+MODES = {
+    'wsgi-sync': ('wsgi', 'ecommerce_project.urls'),
+    'asgi-sync': ('asgi', 'ecommerce_project.urls'),
+    'asgi-async': ('asgi', 'ecommerce_project.urls_async'),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per endpoint and mode.")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    harness.add_report_argument(parser)
+    args = parser.parse_args(argv)
+
+    with harness.bench_database():
+        slugs = [product.slug for product in seed.catalog(args.products)]
+        endpoints = {
+            'list': ['/api/products/?page_size=24', '/api/products/?sort=price&category=category-3'],
+            'detail': [f'/api/products/{slug}/' for slug in slugs[:200]],
+            'home': ['/', '/?page=2', '/?page=3'],
+        }
+        rows = []
+        for mode in args.modes:
+            transport, urlconf = MODES[mode]
+            harness.use_urlconf(urlconf)
+            run = harness.TRANSPORTS[transport]
+            for name, paths in endpoints.items():
+                requests = [Request('GET', paths[i % len(paths)]) for i in range(args.requests)]
+                run(requests[:100], args.concurrency)  # warm caches and connections
+                results, elapsed = run(requests, args.concurrency)
+                rows.append(harness.summarize_results(results, elapsed, mode=mode, path=name))
+                harness.print_row(rows[-1], LABELS)
+        harness.write_report(args.json, 'asgi_vs_wsgi', args, rows, LABELS)
+        return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare two JSON reports of the same benchmark (written with --json), row by
+row: throughput, latency percentiles and queries, old -> new and the change.
+
+    cd ecommerce_project
+    python benchmarks/compare.py before.json after.json
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+COLUMNS = [('per_s', '/s'), ('p50_ms', 'p50 ms'), ('p95_ms', 'p95 ms'), ('p99_ms', 'p99 ms'),
+           ('queries_mean', 'queries'), ('errors', 'errors')]
+
+
+def load(path):
+    report = json.loads(Path(path).read_text())
+    rows = {tuple(row[key] for key in report['labels']): row for row in report['rows']}
+    return report, rows
+
+
+def fmt(value):
+    if value is None:
+        return '-'
+    return f'{value:.1f}' if isinstance(value, float) else str(value)
+
+
+def change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return '' if old == new else 'new'
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    args = parser.parse_args(argv)
+
+    old_report, old_rows = load(args.old)
+    new_report, new_rows = load(args.new)
+    if old_report['benchmark'] != new_report['benchmark']:
+        sys.exit(f"{args.old} is {old_report['benchmark']}, {args.new} is {new_report['benchmark']}")
+    print(f"{old_report['benchmark']}: {old_report['revision']} ({old_report['created_at']}) -> "
+          f"{new_report['revision']} ({new_report['created_at']})")
+    for key, new in new_rows.items():
+        old = old_rows.get(key)
+        print(' '.join(map(str, key)))
+        if old is None:
+            print('    only in', args.new)
+            continue
+        for column, title in COLUMNS:
+            if column in new or column in old:
+                before, after = old.get(column), new.get(column)
+                print(f"    {title:<8} {fmt(before):>10} -> {fmt(after):>10}  {change(before, after)}")
+    for key in old_rows.keys() - new_rows.keys():
+        print(' '.join(map(str, key)), '\n    only in', args.old)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Write concurrency by database profile (ecommerce_project/db_profiles.py).
+
+Runs the storefront cart-add and checkout scenarios through the WSGI handler
+from `--concurrency` threads, once per profile in `--profiles`, each on a
+freshly seeded database:
+
+    sqlite-plain  Django's SQLite defaults: rollback journal, and deferred
+                  transactions that fail with "database is locked" when
+                  another connection is writing
+    sqlite        WAL, synchronous=NORMAL, busy timeout, mmap, a larger page
+                  cache and BEGIN IMMEDIATE
+    current       whatever DATABASES is configured with, e.g. run with
+                  DJANGO_DB_PROFILE=postgresql to measure PostgreSQL
+
+Failed requests are the ones that hit a lock error (a 500 for the shopper).
+
+    cd ecommerce_project
+    python benchmarks/db_writes.py --concurrency 16 --requests 500 --json run.json
+"""
+import argparse
+from pathlib import Path
+
+import harness
+import seed
+import storefront
+from django.conf import settings
+from django.db import connection
+
+from ecommerce_project import db_profiles
+
+LABELS = ['profile', 'scenario']
+SCENARIOS = ['cart-add', 'checkout']
+
+
+def use_profile(profile):
+    if profile == 'current':
+        return
+    databases, pragmas = db_profiles.databases(profile, Path(settings.BASE_DIR), {})
+    connection.close()
+    connection.settings_dict['OPTIONS'] = databases['default'].get('OPTIONS', {})
+    settings.SQLITE_PRAGMAS = pragmas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--cart-items', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=500, help="Requests per scenario and profile.")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--profiles', nargs='+', choices=['sqlite-plain', 'sqlite', 'current'],
+                        default=['sqlite-plain', 'sqlite'])
+    harness.add_report_argument(parser)
+    args = parser.parse_args(argv)
+
+    rows = []
+    for profile in args.profiles:
+        use_profile(profile)
+        with harness.bench_database():
+            products = seed.catalog(args.products, stock=100000)
+            shoppers = [
+                (user, harness.login_headers(user))
+                for user, _, _ in seed.shoppers(args.users, addresses=False)
+            ]
+            context = {'products': products, 'shoppers': shoppers, 'cart_items': args.cart_items, 'rounds': 0}
+            for scenario in SCENARIOS:
+                build, expect = storefront.SCENARIOS[scenario]
+                results, elapsed = harness.run_wsgi(build(context, args.requests), args.concurrency)
+                rows.append(harness.summarize_results(results, elapsed, expect, profile=profile, scenario=scenario))
+                harness.print_row(rows[-1], LABELS)
+    harness.write_report(args.json, 'db_writes', args, rows, LABELS)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Shared plumbing for the scripts in this directory.
+
+Importing it sets up Django. On top of that it provides:
+
+    bench_database()     a throwaway database (a temp SQLite file, or the
+                         TEST database of whatever DATABASES points at)
+    TRANSPORTS           in-process load generators driving the WSGI or ASGI
+                         handler directly, or a threaded HTTP server on
+                         127.0.0.1 over real sockets
+    run_threads()        start workers together and time them
+    summarize()          throughput, p50/p95/p99 and query counts
+    write_report()       the rows as JSON, for benchmarks/compare.py
+
+Query counts come from the Server-Timing header that MetricsMiddleware adds
+to every response, so they are measured the same way for every transport.
+"""
+import asyncio
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY  # noqa: E402
+from django.core.handlers.asgi import ASGIHandler  # noqa: E402
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler  # noqa: E402
+from django.db import OperationalError, connection  # noqa: E402
+from django.test.client import RequestFactory  # noqa: E402
+from django.urls import clear_url_caches  # noqa: E402
+from django.utils.crypto import get_random_string  # noqa: E402
+
+# One request of a scenario. headers are extra request headers, e.g. from
+# login_headers(); data is sent as JSON.
+Request = namedtuple('Request', 'method path data headers', defaults=(None, {}))
+# One response: seconds taken, status code, and queries run (None without
+# MetricsMiddleware).
+Result = namedtuple('Result', 'elapsed status queries')
+
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+@contextmanager
+def bench_database():
+    if connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    settings.ALLOWED_HOSTS = ['*']
+    # Failed requests are counted in the results; a traceback each would
+    # bury them.
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def use_urlconf(urlconf):
+    settings.ROOT_URLCONF = urlconf
+    clear_url_caches()
+
+
+def login_headers(user):
+    """Headers for a logged-in session of user, passing CSRF checks on writes."""
+    from django.contrib.sessions.backends.db import SessionStore
+
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    token = get_random_string(32)
+    return {
+        'Cookie': f'{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={token}',
+        'X-CSRFToken': token,
+    }
+
+
+def _queries(server_timing):
+    match = _QUERIES.search(server_timing or '')
+    return int(match[1]) if match else None
+
+
+def _body(request):
+    return b'' if request.data is None else json.dumps(request.data).encode()
+
+
+def run_wsgi(requests, concurrency):
+    """Call the WSGI handler from a pool of threads, as a threaded server would."""
+    handler = WSGIHandler()
+    factory = RequestFactory()
+
+    def one(request):
+        environ = factory.generic(
+            request.method, request.path, _body(request), 'application/json', headers=request.headers,
+        ).environ
+        started = time.perf_counter()
+        response = []
+        b''.join(handler(environ, lambda status, headers, *args: response.append((status, headers))))
+        elapsed = time.perf_counter() - started
+        status, headers = response[0]
+        return Result(elapsed, int(status.split()[0]), _queries(dict(headers).get('Server-Timing')))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, requests))
+    return results, time.perf_counter() - started
+
+
+def run_asgi(requests, concurrency):
+    """Await the ASGI handler from concurrent tasks on one event loop, as uvicorn would."""
+    handler = ASGIHandler()
+
+    async def one(request, gate):
+        path, _, query = request.path.partition('?')
+        body = _body(request)
+        headers = [(b'host', b'testserver'), (b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode())]
+        headers += [(name.lower().encode(), value.encode()) for name, value in request.headers.items()]
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': request.method,
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+            'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        messages = []
+        finished = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            # Django listens for a client disconnect while the view runs.
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                finished.set()
+
+        async with gate:
+            started = time.perf_counter()
+            await handler(scope, receive, send)
+            elapsed = time.perf_counter() - started
+        start = next(m for m in messages if m['type'] == 'http.response.start')
+        timing = dict(start['headers']).get(b'Server-Timing', b'').decode()
+        return Result(elapsed, start['status'], _queries(timing))
+
+    async def main():
+        gate = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(one(request, gate) for request in requests))
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    return results, time.perf_counter() - started
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def local_server():
+    """A threaded WSGI server on a free port of 127.0.0.1; yields the port."""
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+    server.set_app(WSGIHandler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_http(requests, concurrency):
+    """Send real HTTP requests from a pool of threads to a local server."""
+    with local_server() as port:
+        def one(request):
+            body = _body(request)
+            headers = {'Content-Type': 'application/json', **request.headers}
+            client = http.client.HTTPConnection('127.0.0.1', port)
+            started = time.perf_counter()
+            client.request(request.method, request.path, body=body, headers=headers)
+            response = client.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - started
+            client.close()
+            return Result(elapsed, response.status, _queries(response.getheader('Server-Timing')))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, requests))
+        return results, time.perf_counter() - started
+
+
+TRANSPORTS = {'wsgi': run_wsgi, 'asgi': run_asgi, 'http': run_http}
+
+
+def run_threads(worker, args_list):
+    """
+    Run worker(*args) for each args in its own thread, all released at once.
+    Returns the workers' return values and the wall time.
+    """
+    start = threading.Barrier(len(args_list))
+    results = [None] * len(args_list)
+
+    def run(index, args):
+        start.wait()
+        try:
+            results[index] = worker(*args)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index, args)) for index, args in enumerate(args_list)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def retry_locked(call, cleanup=None):
+    """
+    call() until it isn't refused with a lock error, which SQLite raises
+    instead of waiting under write contention. Returns its result and the
+    number of retries.
+    """
+    retries = 0
+    while True:
+        try:
+            return call(), retries
+        except OperationalError:
+            if cleanup is not None:
+                cleanup()
+            retries += 1
+            time.sleep(random.uniform(0.001, 0.005))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(latencies, elapsed, queries=(), **fields):
+    """A report row: fields first, then throughput, latency percentiles and queries."""
+    row = dict(fields)
+    row.update({
+        'count': len(latencies),
+        'per_s': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    })
+    queries = [count for count in queries if count is not None]
+    if queries:
+        row['queries_mean'] = statistics.mean(queries)
+        row['queries_max'] = max(queries)
+    return row
+
+
+def summarize_results(results, elapsed, expect=(200,), **fields):
+    return summarize(
+        [r.elapsed for r in results], elapsed, [r.queries for r in results],
+        errors=sum(1 for r in results if r.status not in expect), **fields,
+    )
+
+
+# The keys summarize() adds to a row.
+FIGURES = {'count', 'per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_mean', 'queries_max'}
+
+
+def print_row(row, keys):
+    """One line per row: keys as labels, then the figures summarize() adds."""
+    labels = ' '.join(f'{row[key]!s:<12}' for key in keys)
+    line = (f"{labels} {row['per_s']:>8.0f}/s  p50 {row['p50_ms']:>7.1f} ms  p95 {row['p95_ms']:>7.1f} ms  "
+            f"p99 {row['p99_ms']:>7.1f} ms")
+    if 'queries_mean' in row:
+        line += f"  queries {row['queries_mean']:>5.1f}"
+    extra = [key for key in row if key not in keys and key not in FIGURES]
+    line += ''.join(f'  {key} {row[key]}' for key in extra)
+    print(line)
+
+
+def add_report_argument(parser):
+    parser.add_argument('--json', metavar='PATH', help="Also write the results as JSON to PATH.")
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(path, benchmark, args, rows, labels):
+    """Write rows as JSON to path, if given; labels are the keys identifying a row."""
+    if not path:
+        return
+    report = {
+        'benchmark': benchmark,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'database': connection.vendor,
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'args': {key: value for key, value in vars(args).items() if key != 'json'},
+        'labels': labels,
+        'rows': rows,
+    }
+    Path(path).write_text(json.dumps(report, indent=2) + '\n')
@@ -0,0 +1,90 @@
+"""
+Data seeding for the benchmarks, in bulk: a catalog, and shoppers with carts,
+addresses and filled carts. Import after harness (which sets up Django).
+"""
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from ecommerce_app import search
+from ecommerce_app.models import (
+    Address, Cart, CartItem, Category, Product, ProductFacet, ProductImage, StockReservation,
+)
+from ecommerce_app.services import recount_reserved
+
+User = get_user_model()
+
+
+def catalog(products, categories=10, images=2, stock=None):
+    """
+    products products spread over categories categories, every third one on
+    sale, with images each. Stock is `stock` for every product if given, else
+    0-6. Facets and the search index are rebuilt.
+    """
+    created_categories = Category.objects.bulk_create(
+        Category(name=f'Category {i}', slug=f'category-{i}') for i in range(categories)
+    )
+    created = Product.objects.bulk_create(
+        (
+            Product(category=created_categories[i % categories], title=f'Product {i}', slug=f'product-{i}',
+                    price=100 + i % 5000, old_price=(200 + i % 5000) if i % 3 == 0 else None,
+                    description='Benchmark product ' * 20, stock=i % 7 if stock is None else stock)
+            for i in range(products)
+        ),
+        batch_size=1000,
+    )
+    ProductImage.objects.bulk_create(
+        (ProductImage(product=p, image=f'products/{p.slug}-{n}.png') for p in created for n in range(images)),
+        batch_size=1000,
+    )
+    ProductFacet.rebuild()
+    search.rebuild()
+    return created
+
+
+def hot_product(stock):
+    """The single product the contention benchmarks fight over."""
+    category = Category.objects.create(name='Flash sale', slug='flash-sale')
+    return Product.objects.create(category=category, title='Hot SKU', slug='hot-sku', price=100, stock=stock)
+
+
+def shoppers(count, prefix='shopper', addresses=True):
+    """count users, each with an empty cart and (optionally) one address: [(user, cart, address)]."""
+    users = User.objects.bulk_create((User(username=f'{prefix}{i}') for i in range(count)), batch_size=1000)
+    carts = Cart.objects.bulk_create((Cart(user=user) for user in users), batch_size=1000)
+    created = [None] * count
+    if addresses:
+        created = Address.objects.bulk_create(
+            (
+                Address(user=user, full_name=user.username, phone='1', address_line1='Street',
+                        city='City', state='State', postal_code='000000', is_default=True)
+                for user in users
+            ),
+            batch_size=1000,
+        )
+    return list(zip(users, carts, created))
+
+
+def fill_carts(carts, products, items, hold=True):
+    """
+    Put `items` products (one unit each, rotating through products) in every
+    cart, with the stock holds update_cart would have taken.
+    """
+    cart_items, holds = [], []
+    expires_at = timezone.now() + timedelta(hours=1)
+    for n, cart in enumerate(carts):
+        picked = [products[(n * items + i) % len(products)] for i in range(items)]
+        cart_items += [CartItem(cart=cart, product=product, quantity=1) for product in picked]
+        if hold:
+            holds += [StockReservation(cart=cart, product=product, quantity=1, expires_at=expires_at)
+                      for product in picked]
+        # Bulk writes skip CartItem.save(), so the totals are set here.
+        cart.item_count = items
+        cart.subtotal = sum(product.price for product in picked)
+    CartItem.objects.bulk_create(cart_items, batch_size=500)
+    Cart.objects.bulk_update(carts, ['item_count', 'subtotal'], batch_size=500)
+    if hold:
+        StockReservation.objects.bulk_create(holds, batch_size=500)
+        recount_reserved()
+    return cart_items
@@ -0,0 +1,119 @@
+"""
+Add-to-cart throughput on a single hot SKU, with stock holds kept as a
+counter on the product row (services.hold_stock) versus the naive approach
+of locking the product and summing its live holds on every add.
+
+`--buyers` threads each own a cart and add one unit at a time, `--adds` times,
+to the same product, which already carries `--holds` holds from other carts.
+Stock covers only half of the requested units, so the run also checks that
+nothing is over-reserved. SQLite reports write contention as "database is
+locked" rather than waiting, so those attempts are retried and counted.
+
+    cd ecommerce_project
+    python benchmarks/stock_holds.py --buyers 16 --adds 50 --holds 5000 --json run.json
+"""
+import argparse
+import time
+from datetime import timedelta
+
+import harness
+import seed
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from ecommerce_app.models import Product, StockReservation
+from ecommerce_app.services import InsufficientStock, hold_stock
+
+LABELS = ['strategy']
+
+
+def setup(buyers, holds, stock):
+    product = seed.hot_product(stock)
+    carts = [cart for _, cart, _ in seed.shoppers(buyers + holds, prefix='user', addresses=False)]
+    expires_at = timezone.now() + timedelta(hours=1)
+    StockReservation.objects.bulk_create(
+        (StockReservation(cart=cart, product=product, quantity=1, expires_at=expires_at) for cart in carts[buyers:]),
+        batch_size=1000,
+    )
+    Product.objects.filter(pk=product.pk).update(stock=stock + holds, reserved=holds)
+    return product, carts[:buyers]
+
+
+def hold_counter(cart, product_id, quantity):
+    with transaction.atomic():
+        hold_stock(cart, {product_id: quantity})
+
+
+def hold_summed(cart, product_id, quantity):
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        others = (
+            StockReservation.objects.filter(product_id=product_id, expires_at__gt=timezone.now())
+            .exclude(cart=cart).aggregate(total=Sum('quantity'))['total'] or 0
+        )
+        if product.stock - others < quantity:
+            raise InsufficientStock([product])
+        StockReservation.objects.update_or_create(
+            cart=cart, product_id=product_id,
+            defaults={'quantity': quantity, 'expires_at': timezone.now() + timedelta(minutes=15)},
+        )
+
+
+STRATEGIES = {'counter': hold_counter, 'summed': hold_summed}
+
+
+def run(strategy, product, carts, adds):
+    hold = STRATEGIES[strategy]
+
+    def buyer(cart):
+        latencies, retries = [], 0
+        for quantity in range(1, adds + 1):
+            started = time.perf_counter()
+            try:
+                _, retried = harness.retry_locked(lambda: hold(cart, product.pk, quantity))
+            except InsufficientStock:
+                latencies.append(time.perf_counter() - started)
+                break
+            latencies.append(time.perf_counter() - started)
+            retries += retried
+        return latencies, retries
+
+    results, elapsed = harness.run_threads(buyer, [(cart,) for cart in carts])
+    latencies = [latency for buyer_latencies, _ in results for latency in buyer_latencies]
+    return latencies, sum(retries for _, retries in results), elapsed
+
+
+def reset(product, carts, holds):
+    StockReservation.objects.filter(cart__in=carts).delete()
+    Product.objects.filter(pk=product.pk).update(reserved=holds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--adds', type=int, default=50, help="Units each buyer tries to add, one at a time.")
+    parser.add_argument('--holds', type=int, default=5000, help="Existing holds on the SKU from other carts.")
+    parser.add_argument('--strategies', nargs='+', choices=list(STRATEGIES), default=list(STRATEGIES))
+    harness.add_report_argument(parser)
+    args = parser.parse_args(argv)
+
+    with harness.bench_database():
+        stock = args.buyers * args.adds // 2
+        product, carts = setup(args.buyers, args.holds, stock)
+        rows = []
+        for strategy in args.strategies:
+            reset(product, carts, args.holds)
+            latencies, retries, elapsed = run(strategy, product, carts, args.adds)
+            held = StockReservation.objects.filter(cart__in=carts).aggregate(total=Sum('quantity'))['total'] or 0
+            rows.append(harness.summarize(
+                latencies, elapsed, strategy=strategy, retries=retries, held=held, oversold=max(held - stock, 0),
+            ))
+            harness.print_row(rows[-1], LABELS)
+        harness.write_report(args.json, 'stock_holds', args, rows, LABELS)
+        return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Checkout throughput on a single SKU by stock shard count.
+
+`--buyers` threads each check out one unit of the same product `--orders`
+times through services.place_order, once per shard count in `--shards`
+(0 = stock in Product.stock). With the stock in one row every checkout
+queues on it; with shards, concurrent decrements land on different rows.
+
+SQLite allows one writer at a time whatever rows are touched, so there the
+gain is small and lock-retry noise dominates; point DATABASES at PostgreSQL
+or MySQL to measure the row-lock contention sharding removes. Lock errors
+are retried and counted.
+
+    cd ecommerce_project
+    python benchmarks/stock_shards.py --buyers 16 --orders 20 --shards 0 1 4 16 --json run.json
+"""
+import argparse
+import time
+
+import harness
+import seed
+
+from ecommerce_app import stock_shards
+from ecommerce_app.models import CartItem, Order, Product
+from ecommerce_app.services import place_order
+
+LABELS = ['shards']
+
+
+def run(product, buyers, orders):
+    def buyer(cart, address):
+        latencies, retries = [], 0
+        for _ in range(orders):
+            started = time.perf_counter()
+
+            def checkout():
+                CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1)])
+                place_order(cart, address)
+
+            _, retried = harness.retry_locked(checkout, cleanup=lambda: CartItem.objects.filter(cart=cart).delete())
+            latencies.append(time.perf_counter() - started)
+            retries += retried
+        return latencies, retries
+
+    results, elapsed = harness.run_threads(buyer, buyers)
+    latencies = [latency for buyer_latencies, _ in results for latency in buyer_latencies]
+    return latencies, sum(retries for _, retries in results), elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--orders', type=int, default=20, help="Checkouts per buyer and shard count.")
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 1, 4, 16])
+    harness.add_report_argument(parser)
+    args = parser.parse_args(argv)
+
+    with harness.bench_database():
+        product = seed.hot_product(0)
+        buyers = [(cart, address) for _, cart, address in seed.shoppers(args.buyers, prefix='buyer')]
+        stock = args.buyers * args.orders
+        rows = []
+        for shards in args.shards:
+            Order.objects.all().delete()
+            product = stock_shards.reshard(product, shards, stock)
+            latencies, retries, elapsed = run(product, buyers, args.orders)
+            left = stock_shards.level(Product.objects.get(pk=product.pk))
+            rows.append(harness.summarize(latencies, elapsed, shards=shards, retries=retries, stock_left=left))
+            harness.print_row(rows[-1], LABELS)
+        harness.write_report(args.json, 'stock_shards', args, rows, LABELS)
+        return rows
+
+
+if __name__ == '__main__':
+    main()
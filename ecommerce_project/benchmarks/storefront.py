@@ -0,0 +1,126 @@
+"""
+Load test of the storefront flows, per scenario:
+
+    home          the store home page, anonymous, paging through
+    product-list  GET /api/products/ with a rotation of filters and sorts
+    cart-add      POST /api/cart/add/ from logged-in shoppers
+    checkout      POST /api/checkout/, each from a shopper with a filled cart
+
+Each scenario is warmed up, then `--requests` requests are sent from
+`--concurrency` concurrent clients through each `--transport`: straight into
+the WSGI handler from threads, into the ASGI handler (with the async URLconf
+asgi.py serves) from tasks on one event loop, or over HTTP to a threaded
+server on 127.0.0.1. All run in this process against a freshly seeded
+database, so nothing else needs to be started.
+
+Rows report throughput, p50/p95/p99 latency, queries per request and
+responses with an unexpected status. --json writes them with the revision
+and settings for comparing runs with benchmarks/compare.py.
+
+    cd ecommerce_project
+    python benchmarks/storefront.py --products 2000 --users 200 --requests 1000 --concurrency 16 \\
+        --transport wsgi asgi --json before.json
+"""
+import argparse
+import itertools
+
+import harness
+import seed
+from harness import Request
+
+LIST_QUERIES = [
+    '?page_size=24',
+    '?category=category-3',
+    '?sort=price&in_stock=true',
+    '?min_price=500&max_price=2000&on_sale=true',
+    '?sort=-price&category=category-7',
+    '?sort=discount&on_sale=true',
+]
+LABELS = ['transport', 'scenario']
+URLCONFS = {
+    'wsgi': 'ecommerce_project.urls',
+    'asgi': 'ecommerce_project.urls_async',
+    'http': 'ecommerce_project.urls',
+}
+
+
+def home(context, count):
+    return [Request('GET', f'/?page={i % 5 + 1}') for i in range(count)]
+
+
+def product_list(context, count):
+    queries = itertools.cycle(LIST_QUERIES)
+    return [Request('GET', '/api/products/' + next(queries)) for _ in range(count)]
+
+
+def cart_add(context, count):
+    shoppers, products = context['shoppers'], context['products']
+    return [
+        Request('POST', '/api/cart/add/', {'product_id': products[i % len(products)].pk, 'quantity': 1},
+                shoppers[i % len(shoppers)][1])
+        for i in range(count)
+    ]
+
+
+def checkout(context, count):
+    # Every checkout empties its cart, so each request gets a buyer of its own.
+    context['rounds'] += 1
+    buyers = seed.shoppers(count, prefix=f"buyer{context['rounds']}-")
+    seed.fill_carts([cart for _, cart, _ in buyers], context['products'], context['cart_items'])
+    return [
+        Request('POST', '/api/checkout/', {'address_id': address.pk}, harness.login_headers(user))
+        for user, _, address in buyers
+    ]
+
+
+# name -> (requests for a run, expected statuses)
+SCENARIOS = {
+    'home': (home, (200,)),
+    'product-list': (product_list, (200,)),
+    'cart-add': (cart_add, (200,)),
+    'checkout': (checkout, (201,)),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200, help="Logged-in shoppers adding to their carts.")
+    parser.add_argument('--cart-items', type=int, default=3, help="Lines in each cart checked out.")
+    parser.add_argument('--stock', type=int, default=100000, help="Units of every product.")
+    parser.add_argument('--requests', type=int, default=1000, help="Requests per scenario and transport.")
+    parser.add_argument('--warmup', type=int, default=50, help="Unmeasured requests first.")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--transport', nargs='+', choices=list(harness.TRANSPORTS), default=['wsgi'])
+    harness.add_report_argument(parser)
+    args = parser.parse_args(argv)
+
+    with harness.bench_database():
+        products = seed.catalog(args.products, args.categories, stock=args.stock)
+        shoppers = [
+            (user, harness.login_headers(user))
+            for user, _, _ in seed.shoppers(args.users, addresses=False)
+        ]
+        context = {'products': products, 'shoppers': shoppers, 'cart_items': args.cart_items, 'rounds': 0}
+        rows = []
+        for transport in args.transport:
+            harness.use_urlconf(URLCONFS[transport])
+            run = harness.TRANSPORTS[transport]
+            for scenario in args.scenarios:
+                build, expect = SCENARIOS[scenario]
+                if args.warmup:
+                    run(build(context, args.warmup), args.concurrency)
+                results, elapsed = run(build(context, args.requests), args.concurrency)
+                row = harness.summarize_results(
+                    results, elapsed, expect, transport=transport, scenario=scenario,
+                )
+                rows.append(row)
+                harness.print_row(row, LABELS)
+        harness.write_report(args.json, 'storefront', args, rows, LABELS)
+        return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ from .models import (
     Category, Product, ProductImage, Address,
     Cart, CartItem, Wishlist, Order, OrderItem, PaymentRecord
 )
-from ecommerce_app import serializers
+from ecommerce_app import serializers, stock_shards
 
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -17,12 +17,28 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('title', 'category', 'price', 'stock', 'created_at')
+    list_display = ('title', 'category', 'price', 'stock_level', 'reserved', 'created_at')
     search_fields = ('title', 'description')
     list_filter = ('category',)
     inlines = [ProductImageInline]
     prepopulated_fields = {"slug": ("title",)}
 
+    @admin.display(description='stock', ordering='stock')
+    def stock_level(self, obj):
+        return stock_shards.level(obj)
+
+    def get_object(self, request, object_id, from_field=None):
+        # Edit the live shard total rather than the mirror.
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None and obj.shard_count:
+            obj.stock = stock_shards.level(obj)
+        return obj
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if obj.shard_count and 'stock' in form.changed_data:
+            stock_shards.set_stock(obj, obj.stock)
+
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
     list_display = ('user', 'full_name', 'city', 'is_default')
@@ -35,7 +51,9 @@ class CartItemInline(admin.TabularInline):
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ('user', 'updated_at', 'subtotal')
+    list_display = ('user', 'updated_at', 'item_count', 'subtotal')
+    list_select_related = ('user',)
+    readonly_fields = ('item_count', 'subtotal')
     inlines = [CartItemInline]
 
 @admin.register(Wishlist)
@@ -0,0 +1,153 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+from rest_framework.renderers import JSONRenderer
+
+from .models import Category, Product
+from .serializers import ProductSerializer
+
+
+def _cache():
+    return caches[settings.PRODUCT_CACHE_ALIAS]
+
+
+def _version_key(slug):
+    return f'product:version:{slug}'
+
+
+def _payload_key(slug, version):
+    return f'product:json:{slug}:{version}'
+
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def _seed():
+    # Counters start from the clock so a counter that was evicted and
+    # re-created can never land on a version an old payload is stored under.
+    return time.time_ns()
+
+
+def product_versions(slugs):
+    cache = _cache()
+    keys = {_version_key(slug): slug for slug in slugs}
+    found = cache.get_many(keys)
+    missing = {key: _seed() for key in keys if key not in found}
+    if missing:
+        for key, value in missing.items():
+            cache.add(key, value, None)
+        found.update(cache.get_many(missing))
+    return {keys[key]: version for key, version in found.items()}
+
+
+async def aproduct_versions(slugs):
+    cache = _cache()
+    keys = {_version_key(slug): slug for slug in slugs}
+    found = await cache.aget_many(keys)
+    missing = {key: _seed() for key in keys if key not in found}
+    if missing:
+        for key, value in missing.items():
+            await cache.aadd(key, value, None)
+        found.update(await cache.aget_many(missing))
+    return {keys[key]: version for key, version in found.items()}
+
+
+def product_version(slug):
+    return product_versions([slug])[slug]
+
+
+def bump_product_versions(*slugs):
+    cache = _cache()
+    for slug in set(slugs):
+        try:
+            cache.incr(_version_key(slug))
+        except ValueError:
+            cache.add(_version_key(slug), _seed(), None)
+    bump_catalog_version()
+
+
+def _latest_change(*timestamps):
+    latest = max(filter(None, timestamps), default=None)
+    return int(latest.timestamp() * 10 ** 9) if latest else 0
+
+
+def catalog_version():
+    """
+    When anything listed in the catalog last changed, in nanoseconds since
+    the epoch. Kept in the cache by every product invalidation; after an
+    eviction it is re-seeded from the newest Product/Category updated_at.
+    """
+    cache = _cache()
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = _latest_change(
+            Product.objects.aggregate(latest=Max('updated_at'))['latest'],
+            Category.objects.aggregate(latest=Max('updated_at'))['latest'],
+        )
+        cache.add(CATALOG_VERSION_KEY, version, None)
+        version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+async def acatalog_version():
+    cache = _cache()
+    version = await cache.aget(CATALOG_VERSION_KEY)
+    if version is None:
+        version = _latest_change(
+            (await Product.objects.aaggregate(latest=Max('updated_at')))['latest'],
+            (await Category.objects.aaggregate(latest=Max('updated_at')))['latest'],
+        )
+        await cache.aadd(CATALOG_VERSION_KEY, version, None)
+        version = await cache.aget(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    _cache().set(CATALOG_VERSION_KEY, time.time_ns(), None)
+
+
+def _product_queryset(slug):
+    # Payloads are cached until the product changes again, so they are built
+    # from the primary: a lagging replica would keep serving the old data.
+    return Product.objects.using(DEFAULT_DB_ALIAS).select_related('category').prefetch_related('images').filter(slug=slug)
+
+
+def _render(product):
+    if product is None:
+        return None
+    return JSONRenderer().render(ProductSerializer(product).data)
+
+
+def render_product(slug):
+    return _render(_product_queryset(slug).first())
+
+
+def get_product_json(slug):
+    """
+    Serialized JSON bytes for the product with `slug`, or None if it does not
+    exist. Hits are served without touching the ORM or the serializer.
+    """
+    cache = _cache()
+    key = _payload_key(slug, product_version(slug))
+    body = cache.get(key)
+    if body is None:
+        body = render_product(slug)
+        if body is None:
+            return None
+        cache.set(key, body)
+    return body
+
+
+async def aget_product_json(slug):
+    cache = _cache()
+    key = _payload_key(slug, (await aproduct_versions([slug]))[slug])
+    body = await cache.aget(key)
+    if body is None:
+        body = _render(await _product_queryset(slug).afirst())
+        if body is None:
+            return None
+        await cache.aset(key, body)
+    return body
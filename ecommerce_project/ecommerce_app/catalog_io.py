@@ -0,0 +1,225 @@
+"""
+Streaming catalog import and export.
+
+Rows flow through generators (read -> validate -> chunk -> write), so neither
+direction holds more than one chunk of products in memory. The file format is
+CSV or JSON Lines with the columns in FIELDS; in CSV, images are separated by
+IMAGE_SEPARATOR and an empty old_price means none.
+"""
+import csv
+import json
+from collections import Counter
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import imaging, stock_shards
+from .models import Category, Product, ProductImage
+from .serializers import CatalogRowSerializer
+from .signals import products_bulk_changed
+from .slugs import allocate_slugs
+
+FIELDS = ('slug', 'title', 'category', 'price', 'old_price', 'description', 'stock', 'images')
+UPDATE_FIELDS = ('title', 'category', 'price', 'old_price', 'description', 'stock')
+UPDATE_ATTNAMES = ('title', 'category_id', 'price', 'old_price', 'description', 'stock')
+UPDATE_COLUMNS = UPDATE_FIELDS + ('updated_at',)
+IMAGE_SEPARATOR = '|'
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if str(path).endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def read_rows(stream, fmt, errors):
+    """Yield (line number, raw dict) pairs; unparseable lines are appended to errors as (line, detail)."""
+    if fmt == 'jsonl':
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as exc:
+                errors.append((number, f'Invalid JSON: {exc}'))
+                continue
+            yield number, row
+        return
+    for number, row in enumerate(csv.DictReader(stream), 2):
+        if row.get('old_price') == '':
+            row['old_price'] = None
+        images = row.get('images') or ''
+        row['images'] = [name for name in images.split(IMAGE_SEPARATOR) if name]
+        yield number, row
+
+
+def validate_rows(rows, errors):
+    """Yield validated rows; invalid ones are appended to errors as (line, detail)."""
+    for number, row in rows:
+        serializer = CatalogRowSerializer(data=row)
+        if serializer.is_valid():
+            yield serializer.validated_data
+        else:
+            errors.append((number, serializer.errors))
+
+
+class CatalogImporter:
+    """
+    Writes validated rows in chunks, one transaction per chunk. Rows whose
+    slug matches an existing product update it; all others are created.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.categories = dict(Category.objects.values_list('name', 'pk'))
+        self.stats = Counter()
+
+    def category_ids(self, names):
+        missing = [name for name in dict.fromkeys(names) if name not in self.categories]
+        if missing:
+            new = allocate_slugs([Category(name=name) for name in missing], 'name')
+            Category.objects.bulk_create(new, batch_size=self.batch_size)
+            self.categories.update(Category.objects.filter(name__in=missing).values_list('name', 'pk'))
+            self.stats['categories'] += len(missing)
+        return self.categories
+
+    @staticmethod
+    def changed(product):
+        # Re-imports are mostly unchanged rows; bulk_update cost grows with
+        # every row it rewrites, so only send the ones that differ.
+        return any(product.loaded_value(name) != getattr(product, name) for name in UPDATE_ATTNAMES)
+
+    @staticmethod
+    def current_images(products):
+        current = {}
+        rows = ProductImage.objects.filter(product__in=products).order_by('pk').values_list('product_id', 'image')
+        for product_id, name in rows:
+            current.setdefault(product_id, []).append(name)
+        return current
+
+    def import_chunk(self, rows):
+        # A slug repeated within the chunk: the last row wins.
+        keyed = {row['slug']: row for row in rows if row.get('slug')}
+        rows = list(keyed.values()) + [row for row in rows if not row.get('slug')]
+        categories = self.category_ids(row['category'] for row in rows)
+
+        with transaction.atomic():
+            existing = Product.objects.in_bulk(list(keyed), field_name='slug')
+            current_images = self.current_images(
+                [product for slug, product in existing.items() if keyed[slug].get('images')]
+            )
+            created, updated, images = [], [], {}
+            for row in rows:
+                product = existing.get(row.get('slug'))
+                is_new = product is None
+                if is_new:
+                    product = Product(slug=row.get('slug', ''))
+                product.title = row['title']
+                product.category_id = categories[row['category']]
+                product.price = row['price']
+                product.old_price = row.get('old_price')
+                product.description = row.get('description', '')
+                product.stock = row.get('stock', 0)
+                if row.get('images') and (is_new or row['images'] != current_images.get(product.pk)):
+                    images[id(product)] = row['images']
+                if is_new:
+                    created.append(product)
+                elif id(product) in images or self.changed(product):
+                    updated.append(product)
+                else:
+                    self.stats['unchanged'] += 1
+
+            if created:
+                allocate_slugs(created, 'title')
+                Product.objects.bulk_create(created, batch_size=self.batch_size)
+                if any(product.pk is None for product in created):
+                    # Backends that can't return ids from a bulk insert.
+                    ids = dict(Product.objects.filter(slug__in=[p.slug for p in created]).values_list('slug', 'pk'))
+                    for product in created:
+                        product.pk = ids[product.slug]
+            if updated:
+                now = timezone.now()
+                for product in updated:
+                    product.updated_at = now
+                Product.objects.bulk_update(updated, UPDATE_COLUMNS, batch_size=self.batch_size)
+                for product in updated:
+                    if product.shard_count and product.stock != product.loaded_value('stock'):
+                        stock_shards.set_stock(product, product.stock)
+
+            replaced = [product.pk for product in updated if id(product) in images]
+            if replaced:
+                ProductImage.objects.filter(product_id__in=replaced).delete()
+            new_images = ProductImage.objects.bulk_create(
+                (
+                    ProductImage(product_id=product.pk, image=name)
+                    for product in created + updated for name in images.get(id(product), ())
+                ),
+                batch_size=self.batch_size,
+            )
+            imaging.schedule(image.pk for image in new_images if image.pk is not None)
+
+            if created:
+                products_bulk_changed.send(sender=Product, instances=created, created=True)
+            if updated:
+                products_bulk_changed.send(sender=Product, instances=updated, created=False)
+
+        self.stats['created'] += len(created)
+        self.stats['updated'] += len(updated)
+        self.stats['images'] += sum(len(names) for names in images.values())
+
+    def run(self, rows):
+        for chunk in chunked(rows, self.batch_size):
+            self.import_chunk(chunk)
+            yield len(chunk)
+
+
+def export_rows(chunk_size=2000):
+    """Yield one dict per product, in pk order, with its image names."""
+    products = (
+        Product.objects.order_by('pk')
+        .values('pk', 'slug', 'title', 'category__name', 'price', 'old_price', 'description', 'stock')
+        .iterator(chunk_size=chunk_size)
+    )
+    for chunk in chunked(products, chunk_size):
+        images = {}
+        for product_id, name in (
+            ProductImage.objects.filter(product_id__in=[row['pk'] for row in chunk])
+            .order_by('pk').values_list('product_id', 'image')
+        ):
+            images.setdefault(product_id, []).append(name)
+        for row in chunk:
+            yield {
+                'slug': row['slug'],
+                'title': row['title'],
+                'category': row['category__name'],
+                'price': str(row['price']),
+                'old_price': str(row['old_price']) if row['old_price'] is not None else None,
+                'description': row['description'],
+                'stock': row['stock'],
+                'images': images.get(row['pk'], []),
+            }
+
+
+def write_rows(rows, stream, fmt):
+    """Write rows to stream, yielding after each one so callers can count progress."""
+    if fmt == 'jsonl':
+        for row in rows:
+            stream.write(json.dumps(row) + '\n')
+            yield row
+        return
+    writer = csv.DictWriter(stream, fieldnames=FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(dict(
+            row,
+            old_price=row['old_price'] or '',
+            images=IMAGE_SEPARATOR.join(row['images']),
+        ))
+        yield row
@@ -0,0 +1,52 @@
+"""
+Conditional GET for the catalog read endpoints.
+
+Validators come from the cached catalog and product versions, so a request
+whose If-None-Match / If-Modified-Since is still current is answered with a
+304 before any queryset is built or anything serialized. Anonymous responses
+may be stored by shared caches and served stale while they revalidate;
+authenticated ones must be revalidated every time.
+"""
+import hashlib
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from django.utils.http import http_date
+
+
+def list_etag(request, version):
+    # Every query parameter changes the body, in any order; so does the
+    # negotiated format (JSON or the browsable API).
+    params = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    key = repr((version, params, request.META.get('HTTP_ACCEPT', '')))
+    return quote_etag('list-' + hashlib.blake2b(key.encode(), digest_size=12).hexdigest())
+
+
+def product_etag(version):
+    return quote_etag(f'product-{version}')
+
+
+def last_modified(catalog_version):
+    """Seconds since the epoch, as Last-Modified counts them."""
+    return catalog_version // 10 ** 9
+
+
+def not_modified(request, etag, modified):
+    """A 304 (or 412) response if the client's copy is current, else None."""
+    return get_conditional_response(request, etag=etag, last_modified=modified)
+
+
+def add_validators(response, etag, modified, anonymous):
+    if response.status_code not in (200, 304):
+        return response
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(modified)
+    if anonymous:
+        patch_cache_control(
+            response, public=True, max_age=settings.CATALOG_CACHE_MAX_AGE,
+            stale_while_revalidate=settings.CATALOG_STALE_WHILE_REVALIDATE,
+        )
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
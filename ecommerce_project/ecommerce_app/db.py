@@ -0,0 +1,18 @@
+"""
+Per-connection SQLite tuning: runs settings.SQLITE_PRAGMAS (see
+ecommerce_project/db_profiles.py) on every new SQLite connection.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # On the raw connection, so the PRAGMAs don't count as queries of
+    # whatever request opened it.
+    for name, value in settings.SQLITE_PRAGMAS.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(apply_sqlite_pragmas, dispatch_uid='sqlite_pragmas')
@@ -0,0 +1,205 @@
+"""
+Sized WebP/JPEG derivatives of product images.
+
+Uploads are stored as-is; a background task queued with the upload renders
+each size in DERIVATIVES in both formats (EXIF-rotated, metadata dropped),
+records the original's dimensions and a blurhash placeholder on the
+ProductImage row, and bumps the product's cache version so cached cards and
+payloads pick up the new URLs.
+"""
+import logging
+import math
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import catalog_cache
+from .models import Product, ProductImage
+from .taskqueue import enqueue, task
+
+logger = logging.getLogger(__name__)
+
+# name -> bounding box; images are scaled down to fit, never up.
+DERIVATIVES = {
+    'thumb': (160, 160),
+    'card': (480, 480),
+    'detail': (1200, 1200),
+}
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+DERIVED_DIR = 'products/derived'
+
+# Images rendered per task: a catalog import schedules thousands at once, and
+# each task should finish well inside its lease.
+IMAGES_PER_TASK = 20
+
+
+def schedule(image_ids):
+    """Queue rendering of these images' derivatives, in the caller's transaction."""
+    image_ids = list(image_ids)
+    for start in range(0, len(image_ids), IMAGES_PER_TASK):
+        enqueue(render_images, image_ids[start:start + IMAGES_PER_TASK])
+
+
+@task()
+def render_images(image_ids):
+    for pk in image_ids:
+        process(pk)
+
+
+def run(pk):
+    """process() for a process_images thread: own connection, errors logged rather than raised."""
+    close_old_connections()
+    try:
+        process(pk)
+    except Exception:
+        logger.exception("Could not render derivatives for product image %s", pk)
+    finally:
+        close_old_connections()
+
+
+def _flatten(image):
+    # JPEG has no alpha channel: composite onto white rather than black.
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, fmt):
+    buffer = BytesIO()
+    # No exif/icc arguments are passed, so no metadata is written.
+    image.save(buffer, **FORMATS[fmt])
+    return buffer.getvalue()
+
+
+def render(source):
+    """Return (width, height, blurhash, {name: (width, height, {fmt: bytes})}) for an open image."""
+    image = ImageOps.exif_transpose(source)
+    image = _flatten(image)
+    width, height = image.size
+    rendered = {}
+    for name, box in DERIVATIVES.items():
+        resized = image.copy()
+        resized.thumbnail(box, Image.Resampling.LANCZOS)
+        rendered[name] = (resized.width, resized.height, {fmt: _encode(resized, fmt) for fmt in FORMATS})
+    preview = image.copy()
+    preview.thumbnail((32, 32), Image.Resampling.BILINEAR)
+    return width, height, blurhash(preview), rendered
+
+
+def process(pk):
+    product_image = ProductImage.objects.filter(pk=pk).first()
+    if product_image is None or not product_image.image:
+        return
+    try:
+        with product_image.image.open('rb') as file, Image.open(file) as source:
+            width, height, placeholder, rendered = render(source)
+    except (OSError, Image.DecompressionBombError) as exc:
+        logger.warning("Skipping product image %s (%s): %s", pk, product_image.image.name, exc)
+        return
+
+    stem = os.path.splitext(os.path.basename(product_image.image.name))[0]
+    old = product_image.derivatives or {}
+    derivatives = {}
+    for name, (w, h, files) in rendered.items():
+        entry = {'width': w, 'height': h}
+        for fmt, data in files.items():
+            entry[fmt] = default_storage.save(f'{DERIVED_DIR}/{stem}-{pk}-{name}.{EXTENSIONS[fmt]}', ContentFile(data))
+        derivatives[name] = entry
+
+    updated = ProductImage.objects.filter(pk=pk, image=product_image.image.name).update(
+        width=width, height=height, blurhash=placeholder, derivatives=derivatives,
+    )
+    # Drop whichever set of files lost: the old one, or ours if the image was
+    # replaced while we were rendering.
+    delete_files(old if updated else derivatives)
+    if updated:
+        product = Product.objects.filter(pk=product_image.product_id)
+        slug = product.values_list('slug', flat=True).first()
+        if slug:
+            product.update(updated_at=timezone.now())
+            catalog_cache.bump_product_versions(slug)
+
+
+def delete_files(derivatives):
+    for entry in (derivatives or {}).values():
+        for fmt in FORMATS:
+            if entry.get(fmt):
+                default_storage.delete(entry[fmt])
+
+
+# Blurhash (https://blurha.sh): a ~30 character string clients can decode
+# into a blurred placeholder while the real image loads.
+
+_BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _base83(value, length):
+    return ''.join(_BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _to_linear(value):
+    value /= 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+
+def _to_srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return round(value * 12.92 * 255)
+    return round((1.055 * value ** (1 / 2.4) - 0.055) * 255)
+
+
+def _sign_pow(value, exponent):
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash(image, x_components=4, y_components=3):
+    image = image.convert('RGB')
+    width, height = image.size
+    pixels = [tuple(_to_linear(c) for c in pixel) for pixel in image.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            norm = (1 if i == 0 and j == 0 else 2) / (width * height)
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                cy = cos_y[j][y]
+                for x in range(width):
+                    basis = cos_x[i][x] * cy
+                    pr, pg, pb = pixels[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            factors.append((r * norm, g * norm, b * norm))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _base83(0, 1)
+    result += _base83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(_sign_pow(c / max_value, 0.5) * 9 + 9.5))) for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
@@ -0,0 +1,227 @@
+"""
+Index advisor behind `manage.py suggest_indexes`.
+
+While capturing, every SELECT, UPDATE and DELETE run on any connection is
+recorded once per distinct SQL (with one set of parameters and the line of
+our code that ran it first). analyze() then asks the database for each
+query's plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN (FORMAT JSON) on
+PostgreSQL) and reports:
+
+    full scan   a table read row by row
+    sort        a temporary B-tree (SQLite) or Sort node (PostgreSQL) built
+                for ORDER BY or GROUP BY
+
+each with the index that would let the query avoid it, when one can be read
+off the query: its equality conditions on the table, then one range
+condition or the sort columns (both, when the range is on the leading sort
+column, as on a keyset page). Conditions under an OR are left out.
+"""
+import json
+import re
+import threading
+from collections import namedtuple
+
+from django.apps import apps
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+
+from .metrics import _origin
+
+Query = namedtuple('Query', 'sql params origin')
+Finding = namedtuple('Finding', 'kind model table fields query runs')
+# fields: the suggested Index fields, [] when no index would help (e.g. the
+# query has no condition or sort on the table) or the model already has it.
+
+_EQUALITY = ('=', 'IN', 'IS')
+_COLUMN = r'"{table}"\."(\w+)"'
+
+
+class QueryLog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = {}
+        self.runs = {}
+        self.capturing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.capturing and not many and sql.lstrip()[:6].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            alias = context['connection'].alias
+            with self._lock:
+                key = (alias, sql)
+                self.runs[key] = self.runs.get(key, 0) + 1
+                if key not in self.queries:
+                    self.queries[key] = Query(sql, params, _origin(skip=(__file__,)))
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def start(self):
+        for connection in connections.all(initialized_only=True):
+            self.install(connection=connection)
+        connection_created.connect(self.install, dispatch_uid='index_advisor')
+        self.capturing = True
+
+    def stop(self):
+        self.capturing = False
+        connection_created.disconnect(dispatch_uid='index_advisor')
+
+
+def _tables(all_apps):
+    models = apps.get_models() if all_apps else apps.get_app_config('ecommerce_app').get_models()
+    return {model._meta.db_table: model for model in models}
+
+
+def _clause(sql, keyword, ends):
+    """The text of the last `keyword` clause, up to the first of `ends`."""
+    start = sql.rfind(f' {keyword} ')
+    if start < 0:
+        return ''
+    clause = sql[start + len(keyword) + 2:]
+    for end in ends:
+        clause = clause.split(f' {end} ')[0]
+    return clause
+
+
+def _without_or(condition):
+    """
+    `condition` minus its OR'd branches: a column compared inside one needn't
+    be compared for every row, so it can't lead an index.
+    """
+    text, groups, depth = [], [], 0
+    for char in condition:
+        if char == ')' and depth:
+            depth -= 1
+            if not depth:
+                text.append(f'({_without_or(groups.pop())})')
+                continue
+        if depth:
+            groups[-1] += char
+        elif char == '(':
+            groups.append('')
+        else:
+            text.append(char)
+        if char == '(':
+            depth += 1
+    text = ''.join(text)
+    return '' if ' OR ' in text else text
+
+
+def suggest(sql, table, sort=True):
+    """
+    Index columns for `table` that would serve `sql` ('-' marks descending),
+    or [] if none would.
+    """
+    column = _COLUMN.format(table=re.escape(table))
+    where = _without_or(_clause(sql, 'WHERE', ['GROUP BY', 'ORDER BY', 'LIMIT']))
+    equal, ranged = [], []
+    for name, operator in re.findall(column + r'\s*(=|IN\b|IS\b|>=|<=|>|<)', where):
+        (equal if operator in _EQUALITY else ranged).append(name)
+    fields = list(dict.fromkeys(equal))
+    ranged = [name for name in ranged if name not in fields]
+    order = []
+    if sort:
+        clause = _clause(sql, 'ORDER BY', ['LIMIT', 'OFFSET']) or _clause(sql, 'GROUP BY', ['HAVING', 'ORDER BY'])
+        # Columns inside an expression, e.g. LENGTH("slug"), can't use an index.
+        order = [('-' if direction else '') + name
+                 for name, direction in re.findall(r'(?<!\()' + column + r'(?!\))(\s+DESC)?', clause)
+                 if name not in fields]
+    if ranged and not (order and order[0].lstrip('-') == ranged[0]):
+        fields.append(ranged[0])
+    else:
+        # With no range, or one on the leading sort column (a keyset page),
+        # the index can also hand rows over in order.
+        fields += list(dict.fromkeys(order))
+    return fields
+
+
+def _unique_columns(model):
+    return {field.column for field in model._meta.concrete_fields if field.unique}
+
+
+def _existing(model):
+    """Column lists of the model's indexes and unique constraints."""
+    meta = model._meta
+    columns = {field.name: field.column for field in meta.concrete_fields}
+    existing = [[field.column] for field in meta.concrete_fields if field.db_index or field.unique]
+    existing += [[columns[name] for name in fields] for fields in meta.unique_together]
+    for index in [*meta.indexes, *meta.constraints]:
+        existing.append([columns[name.lstrip('-')] for name in getattr(index, 'fields', ())])
+    return existing
+
+
+def to_fields(model, columns):
+    """Index columns as Django Index fields: attribute names rather than columns."""
+    names = {field.column: field.name for field in model._meta.concrete_fields}
+    return [('-' if column.startswith('-') else '') + names[column.lstrip('-')] for column in columns]
+
+
+def covered(model, columns):
+    """Whether an index or unique constraint the model already has starts with `columns`."""
+    bare = [column.lstrip('-') for column in columns]
+    return any(index[:len(bare)] == bare for index in _existing(model))
+
+
+def _sqlite_plan(connection, query):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + query.sql, query.params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def _sqlite_findings(connection, query, tables):
+    aliases = {alias: table for table, alias in re.findall(r'"(\w+)" (?:AS )?"?(T\d+)"?', query.sql)}
+    for detail in _sqlite_plan(connection, query):
+        scan = re.match(r'SCAN (\w+)(?: AS \w+)?$', detail)
+        if scan:
+            table = aliases.get(scan[1], scan[1])
+            if table in tables:
+                yield 'full scan', table, suggest(query.sql, table)
+        elif detail.startswith('USE TEMP B-TREE FOR') and 'DISTINCT' not in detail:
+            for table in tables:
+                if f'"{table}".' in _clause(query.sql, 'ORDER BY', ['LIMIT']) + _clause(query.sql, 'GROUP BY', []):
+                    yield 'sort', table, suggest(query.sql, table)
+                    break
+
+
+def _postgresql_findings(connection, query, tables):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query.sql, query.params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        table = node.get('Relation Name')
+        if node['Node Type'] == 'Seq Scan' and table in tables:
+            yield 'full scan', table, suggest(query.sql, table)
+        elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+            for table in tables:
+                if any(key.startswith(f'{table}.') for key in node.get('Sort Key', [])):
+                    yield 'sort', table, suggest(query.sql, table)
+                    break
+
+
+def analyze(log, all_apps=False):
+    """Findings for the captured queries, worst (most runs) first."""
+    tables = _tables(all_apps)
+    findings = []
+    for (alias, _), query in log.queries.items():
+        connection = connections[alias]
+        explain = {'sqlite': _sqlite_findings, 'postgresql': _postgresql_findings}.get(connection.vendor)
+        if explain is None:
+            continue
+        try:
+            found = list(explain(connection, query, tables))
+        except DatabaseError:
+            # E.g. a temporary table the query ran against is gone.
+            continue
+        for kind, table, columns in found:
+            model = tables[table]
+            # Leading with a unique column, the query already has its index.
+            if columns and columns[0].lstrip('-') in _unique_columns(model) or covered(model, columns):
+                columns = []
+            findings.append(Finding(kind, model, table, to_fields(model, columns), query, log.runs[alias, query.sql]))
+    return sorted(findings, key=lambda finding: -finding.runs)
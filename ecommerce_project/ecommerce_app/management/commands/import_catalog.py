@@ -0,0 +1,52 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce_app.catalog_io import CatalogImporter, detect_format, read_rows, validate_rows
+
+
+class Command(BaseCommand):
+    help = "Stream products from a CSV or JSON Lines file into the catalog, creating or updating by slug."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or - for stdin.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="Defaults to jsonl for .jsonl/.ndjson files, csv otherwise.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Rows validated and written per transaction.")
+
+    def handle(self, *args, path, format, batch_size, **options):
+        fmt = detect_format(path, format)
+        errors = []
+        importer = CatalogImporter(batch_size=batch_size)
+        started = time.monotonic()
+        done = 0
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as exc:
+            raise CommandError(exc)
+        try:
+            rows = validate_rows(read_rows(stream, fmt, errors), errors)
+            for count in importer.run(rows):
+                done += count
+                if options['verbosity'] > 1:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(f"{done} rows ({done / elapsed:.0f} rows/s)")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for line, detail in errors[:20]:
+            self.stderr.write(f"line {line}: {detail}")
+        if len(errors) > 20:
+            self.stderr.write(f"... and {len(errors) - 20} more invalid rows")
+
+        elapsed = time.monotonic() - started
+        stats = importer.stats
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {done} rows in {elapsed:.2f}s ({done / elapsed if elapsed else done:.0f} rows/s): "
+            f"{stats['created']} created, {stats['updated']} updated, {stats['unchanged']} unchanged, "
+            f"{stats['images']} images, "
+            f"{stats['categories']} new categories, {len(errors)} skipped."
+        ))
@@ -0,0 +1,31 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import imaging
+from ecommerce_app.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = "Render the sized WebP/JPEG derivatives for product images that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Re-render images that already have derivatives.")
+        parser.add_argument('--workers', type=int, default=2,
+                            help="Images rendered in parallel (Pillow releases the GIL while resizing).")
+
+    def handle(self, *args, all, workers, **options):
+        images = ProductImage.objects.order_by('pk')
+        if not all:
+            images = images.filter(derivatives={})
+        pks = list(images.values_list('pk', flat=True))
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for done, _ in enumerate(pool.map(imaging.run, pks), 1):
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"{done}/{len(pks)} images")
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {len(pks)} images in {elapsed:.2f}s ({len(pks) / elapsed if elapsed else 0:.1f} images/s)."
+        ))
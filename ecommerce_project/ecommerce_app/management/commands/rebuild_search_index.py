@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index from the database."
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        search.rebuild()
+        backend = type(search.get_backend()).__name__
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt search index ({backend}) in {time.monotonic() - started:.2f}s."
+        ))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ecommerce_app.models import Cart
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored subtotal and item_count of every cart from its items."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of carts updated per statement.")
+
+    def handle(self, *args, batch_size, **options):
+        updated = 0
+        last_pk = 0
+        while True:
+            pks = list(
+                Cart.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not pks:
+                break
+            with transaction.atomic():
+                updated += Cart.objects.filter(pk__in=pks).recalculate_totals()
+            last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f"Recalculated totals for {updated} carts."))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce_app.services import recount_reserved, release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Give back the stock held by expired cart reservations. Meant to run every minute or so from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Holds released per transaction.")
+        parser.add_argument(
+            '--recount', action='store_true',
+            help="Afterwards recompute every product's reserved count from the remaining holds.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        released = release_expired_reservations(batch_size=options['batch_size'])
+        message = f"Released {released} expired holds"
+        if options['recount']:
+            message += f", recounted {recount_reserved()} products"
+        self.stdout.write(self.style.SUCCESS(f"{message} in {time.monotonic() - started:.2f}s."))
@@ -0,0 +1,38 @@
+import json
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import taskqueue
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks on a thread pool until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Tasks run concurrently (default TASK_WORKERS).")
+        parser.add_argument('--poll-interval', type=float, help="Seconds to sleep when nothing is due.")
+        parser.add_argument('--burst', action='store_true', help="Exit once no task is due.")
+        parser.add_argument('--stats', action='store_true', help="Print queue depth and latency, then exit.")
+
+    def handle(self, *args, workers, poll_interval, burst, stats, **options):
+        if stats:
+            self.stdout.write(json.dumps(taskqueue.stats(), indent=2))
+            return
+
+        stop = threading.Event()
+        # Finish the tasks in hand on Ctrl-C / SIGTERM instead of abandoning
+        # them to the lease timeout.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+
+        worker = taskqueue.Worker(workers=workers, poll_interval=poll_interval)
+        self.stdout.write(f"Worker {worker.name} running with {worker.workers} threads.")
+        started = time.monotonic()
+        worker.run(burst=burst, stop=stop)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Ran {worker.processed} tasks ({worker.failed} failed) in {elapsed:.2f}s."
+        ))
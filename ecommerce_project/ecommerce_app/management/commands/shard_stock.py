@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce_app import stock_shards
+from ecommerce_app.models import Product
+
+
+class Command(BaseCommand):
+    help = "Split the stock of hot products across N counter rows (0 merges it back), or refresh sharded stock mirrors."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help="Products to (re)shard.")
+        parser.add_argument('--shards', type=int, default=8, help="Shard count; 0 stops sharding.")
+        parser.add_argument(
+            '--sync', action='store_true',
+            help="Refresh Product.stock from the shards of every sharded product instead.",
+        )
+
+    def handle(self, *args, **options):
+        if options['sync']:
+            ids = list(Product.objects.filter(shard_count__gt=0).values_list('pk', flat=True))
+            for pk in ids:
+                stock_shards.sync(pk)
+            self.stdout.write(self.style.SUCCESS(f"Synced {len(ids)} sharded products."))
+            return
+        if not options['slugs']:
+            raise CommandError("Give at least one product slug, or --sync.")
+        if not 0 <= options['shards'] <= 256:
+            raise CommandError("--shards must be between 0 and 256.")
+        products = Product.objects.in_bulk(options['slugs'], field_name='slug')
+        missing = set(options['slugs']) - set(products)
+        if missing:
+            raise CommandError("Unknown products: " + ", ".join(sorted(missing)))
+        for slug, product in products.items():
+            product = stock_shards.reshard(product, options['shards'])
+            self.stdout.write(f"{slug}: {product.stock} in stock across {options['shards']} shards")
+        self.stdout.write(self.style.SUCCESS(f"Resharded {len(products)} products."))
@@ -0,0 +1,68 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.test.runner import DiscoverRunner
+
+from ecommerce_app.index_advisor import QueryLog, analyze
+
+
+class CapturingRunner(DiscoverRunner):
+    """Runs the tests with the log capturing, and analyzes before the test databases go."""
+
+    def __init__(self, log, all_apps, **kwargs):
+        super().__init__(**kwargs)
+        self.query_log = log
+        self.all_apps = all_apps
+        self.findings = []
+
+    def setup_databases(self, **kwargs):
+        config = super().setup_databases(**kwargs)
+        self.query_log.start()
+        return config
+
+    def teardown_databases(self, old_config, **kwargs):
+        self.query_log.stop()
+        self.findings = analyze(self.query_log, self.all_apps)
+        super().teardown_databases(old_config, **kwargs)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the tests, EXPLAIN every distinct query they ran and report full table scans and "
+        "sorts without an index, with the index that would avoid each."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_labels', nargs='*', default=['ecommerce_app'])
+        parser.add_argument('--all-apps', action='store_true', help="Also report tables of Django's own apps.")
+        parser.add_argument('--show-sql', action='store_true', help="Print an example query for each suggestion.")
+        parser.add_argument(
+            '--all', action='store_true',
+            help="Also list scans and sorts no new index would avoid (no conditions, already indexed, ...).",
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        log = QueryLog()
+        runner = CapturingRunner(log, options['all_apps'], verbosity=0, interactive=False)
+        runner.run_tests(options['test_labels'])
+
+        suggestions = defaultdict(list)
+        for finding in runner.findings:
+            if finding.fields or options['all']:
+                suggestions[finding.model, tuple(finding.fields)].append(finding)
+        ranked = sorted(suggestions.items(), key=lambda item: (not item[0][1], -sum(f.runs for f in item[1])))
+        for (model, fields), findings in ranked:
+            kinds = ', '.join(sorted({finding.kind for finding in findings}))
+            runs = sum(finding.runs for finding in findings)
+            index = f"models.Index(fields={list(fields)})" if fields else "no new index applies"
+            self.stdout.write(f"{model._meta.label}: {index}")
+            self.stdout.write(f"    {kinds} in {len(findings)} queries ({runs} runs), first from {findings[0].query.origin}")
+            if options['show_sql']:
+                self.stdout.write(f"    {findings[0].query.sql}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Explained {len(log.queries)} distinct queries, {sum(1 for _, fields in suggestions if fields)} "
+            f"suggested indexes "
+            f"in {time.monotonic() - started:.2f}s."
+        ))
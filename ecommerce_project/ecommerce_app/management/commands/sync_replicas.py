@@ -0,0 +1,45 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the primary SQLite database into the replica files of DATABASE_REPLICAS "
+        "(DJANGO_DB_REPLICAS), so replica routing can be tried out locally. With --interval, "
+        "keep copying, which also simulates replication lag."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help="Seconds between copies; copy once if omitted.")
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError("Only SQLite replicas are copied here; real replicas are kept by the database.")
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError("No replicas configured: set DJANGO_DB_REPLICAS.")
+        while True:
+            started = time.monotonic()
+            source = sqlite3.connect(primary.settings_dict['NAME'])
+            try:
+                for alias in settings.DATABASE_REPLICAS:
+                    target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+                    try:
+                        # The backup API copies a consistent snapshot, even
+                        # while the primary is being written to.
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(self.style.SUCCESS(
+                f"Copied the primary to {len(settings.DATABASE_REPLICAS)} replicas "
+                f"in {time.monotonic() - started:.2f}s."
+            ))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
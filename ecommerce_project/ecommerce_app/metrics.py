@@ -0,0 +1,318 @@
+"""
+Per-endpoint request metrics.
+
+MetricsMiddleware times every request and, through hooks that only record
+while a request is being measured, the time it spends in:
+
+    db         every SQL query, via an execute wrapper on each connection
+    serialize  DRF serializers built on TimedSerializerMixin
+    render     DRF renderers and Django templates (the classes below, enabled
+               in settings)
+
+Each stage is a histogram in an in-process registry labelled by endpoint,
+served at /metrics in the Prometheus text format, and summarized for the
+browser in a Server-Timing header. The registry is per process: scrape each
+worker.
+
+With METRICS_DEBUG_QUERIES, identical SQL run METRICS_DUPLICATE_QUERY_THRESHOLD
+or more times in one request (the signature of an N+1) is logged with the
+line of application code that issued it.
+"""
+import hmac
+import logging
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+from rest_framework import renderers
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('db', 'serialize', 'render')
+# Upper bounds in seconds, and in queries for the query-count histogram.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def collect(self):
+        with self._lock:
+            return {key: list(series) for key, series in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class CounterMetric:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = Counter()
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Time to produce the response.", DURATION_BUCKETS)
+QUERIES = Histogram('http_request_db_queries', "SQL queries run per request.", QUERY_BUCKETS)
+STAGE_SECONDS = {
+    stage: Histogram(f'http_request_{stage}_seconds', f"Time per request spent in {stage}.", DURATION_BUCKETS)
+    for stage in STAGES
+}
+DUPLICATE_QUERIES = CounterMetric(
+    'http_request_duplicate_queries_total', "Repeated identical queries seen with METRICS_DEBUG_QUERIES.",
+)
+PAGE_CACHE_REQUESTS = CounterMetric(
+    'page_cache_requests_total', "Anonymous page requests by page cache result: hit, wait (for another render) or miss.",
+)
+REGISTRY = [REQUEST_SECONDS, QUERIES, *STAGE_SECONDS.values(), DUPLICATE_QUERIES, PAGE_CACHE_REQUESTS]
+
+
+def _label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(key, **extra):
+    pairs = [*key, *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in pairs) + '}'
+
+
+def render_prometheus():
+    lines = []
+    for metric in REGISTRY:
+        kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+        lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {kind}']
+        for key, value in sorted(metric.collect().items()):
+            if kind == 'counter':
+                lines.append(f'{metric.name}{_labels(key)} {value}')
+                continue
+            # observe() counts a value in every bucket it fits, so the
+            # counts are already cumulative as Prometheus expects.
+            for bound, count in zip(metric.buckets, value):
+                lines.append(f'{metric.name}_bucket{_labels(key, le=bound)} {count}')
+            lines.append(f'{metric.name}_bucket{_labels(key, le="+Inf")} {value[-2]}')
+            lines.append(f'{metric.name}_sum{_labels(key)} {value[-1]}')
+            lines.append(f'{metric.name}_count{_labels(key)} {value[-2]}')
+    return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    def __init__(self, debug_queries=False):
+        self.queries = 0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.active = None
+        self.debug_queries = debug_queries
+        self.statements = Counter()
+        self.origins = {}
+
+
+_current = ContextVar('request_metrics', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Count the enclosed time towards `name`, unless an enclosing stage already is."""
+    stats = _current.get()
+    if stats is None or stats.active is not None:
+        yield
+        return
+    stats.active = name
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.stages[name] += time.perf_counter() - started
+        stats.active = None
+
+
+_PROJECT_DIR = str(Path(settings.BASE_DIR).resolve())
+
+
+def _origin(skip=()):
+    """The innermost frame of our own code (not Django's, DRF's, this module's or skip's)."""
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(_PROJECT_DIR) and frame.filename != __file__ and frame.filename not in skip:
+            return f'{frame.filename}:{frame.lineno} in {frame.name}'
+    return 'unknown'
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    stats.queries += 1
+    if stats.debug_queries:
+        stats.statements[sql] += 1
+        if sql not in stats.origins:
+            stats.origins[sql] = _origin()
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        # Queries inside a serializer or template count towards db as well.
+        stats.stages['db'] += time.perf_counter() - started
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder, dispatch_uid='metrics_query_recorder')
+
+
+def endpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+def _finish(request, response, stats, started):
+    elapsed = time.perf_counter() - started
+    labels = {'endpoint': endpoint(request), 'method': request.method}
+    REQUEST_SECONDS.observe(elapsed, **labels)
+    QUERIES.observe(stats.queries, **labels)
+    for name, seconds in stats.stages.items():
+        STAGE_SECONDS[name].observe(seconds, **labels)
+
+    timings = [f'db;dur={stats.stages["db"] * 1000:.1f};desc="{stats.queries} queries"']
+    timings += [f'{name};dur={stats.stages[name] * 1000:.1f}' for name in STAGES[1:]]
+    timings.append(f'total;dur={elapsed * 1000:.1f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    repeated = {sql: count for sql, count in stats.statements.items()
+                if count >= settings.METRICS_DUPLICATE_QUERY_THRESHOLD}
+    for sql, count in repeated.items():
+        DUPLICATE_QUERIES.inc(count - 1, **labels)
+        logger.warning("%s %s ran the same query %d times, first from %s: %s",
+                       request.method, labels['endpoint'], count, stats.origins[sql], sql)
+    if repeated:
+        response.headers['X-Duplicate-Queries'] = str(len(repeated))
+    return response
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _start(self):
+        stats = RequestStats(debug_queries=settings.METRICS_DEBUG_QUERIES)
+        return stats, _current.set(stats), time.perf_counter()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats, token, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return _finish(request, response, stats, started)
+
+    async def __acall__(self, request):
+        stats, token, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return _finish(request, response, stats, started)
+
+
+def metrics_view(request):
+    # Not by address: behind a reverse proxy on the same host every request
+    # comes from 127.0.0.1.
+    token = settings.METRICS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    allowed = bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+    if not (allowed or request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class TimedSerializerMixin:
+    """Counts top-level to_representation() calls towards the serialize stage."""
+
+    def to_representation(self, instance):
+        with stage('serialize'):
+            return super().to_representation(instance)
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    def render(self, *args, **kwargs):
+        with stage('render'):
+            return super().render(*args, **kwargs)
+
+
+class BrowsableAPIRenderer(renderers.BrowsableAPIRenderer):
+    def render(self, *args, **kwargs):
+        with stage('render'):
+            return super().render(*args, **kwargs)
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        with stage('render'):
+            return self.template.render(context, request)
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """The standard Django template backend, timing render() for metrics."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
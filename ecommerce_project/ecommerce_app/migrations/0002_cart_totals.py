@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:54
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('ecommerce_app', 'Cart')
+    CartItem = apps.get_model('ecommerce_app', 'CartItem')
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    total_field = models.DecimalField(max_digits=12, decimal_places=2)
+    Cart.objects.update(
+        subtotal=Coalesce(
+            Subquery(items.annotate(total=Sum(F('quantity') * F('product__price'), output_field=total_field)).values('total')),
+            Value(Decimal('0')),
+            output_field=total_field,
+        ),
+        item_count=Coalesce(Subquery(items.annotate(count=Sum('quantity')).values('count')), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(backfill_cart_totals, migrations.RunPython.noop),
+    ]
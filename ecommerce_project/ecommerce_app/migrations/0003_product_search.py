@@ -0,0 +1,35 @@
+from django.db import migrations
+
+FTS_TABLE = 'ecommerce_app_product_search'
+
+
+def create_search_index(apps, schema_editor):
+    # Other databases use the in-process index in ecommerce_app.search.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+        "title, description, category, category_slug UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    schema_editor.execute(
+        f'INSERT INTO {FTS_TABLE} (rowid, title, description, category, category_slug) '
+        'SELECT p.id, p.title, p.description, c.name, c.slug '
+        'FROM ecommerce_app_product p JOIN ecommerce_app_category c ON c.id = p.category_id'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0002_cart_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.8 on 2026-10-17 07:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, Count, F, Value, When
+
+# Frozen copy of models.PRICE_BUCKETS at the time of this migration.
+PRICE_BUCKETS = (0, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+
+def populate_facets(apps, schema_editor):
+    Product = apps.get_model('ecommerce_app', 'Product')
+    ProductFacet = apps.get_model('ecommerce_app', 'ProductFacet')
+    bucket = Case(
+        *(When(price__gte=edge, then=Value(i)) for i, edge in reversed(list(enumerate(PRICE_BUCKETS)))),
+        default=Value(0),
+    )
+    rows = (
+        Product.objects.order_by()
+        .annotate(
+            bucket=bucket,
+            available=Case(When(stock__gt=0, then=Value(True)), default=Value(False)),
+            discounted=Case(When(old_price__gt=F('price'), then=Value(True)), default=Value(False)),
+        )
+        .values('category_id', 'bucket', 'available', 'discounted')
+        .annotate(total=Count('id'))
+    )
+    ProductFacet.objects.bulk_create(
+        ProductFacet(category_id=row['category_id'], price_bucket=row['bucket'], in_stock=row['available'],
+                     on_sale=row['discounted'], count=row['total'])
+        for row in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0003_product_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_bucket', models.PositiveSmallIntegerField()),
+                ('in_stock', models.BooleanField()),
+                ('on_sale', models.BooleanField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-created_at'], name='product_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['stock'], name='product_stock_idx'),
+        ),
+        migrations.AddField(
+            model_name='productfacet',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='ecommerce_app.category'),
+        ),
+        migrations.AddConstraint(
+            model_name='productfacet',
+            constraint=models.UniqueConstraint(fields=('category', 'price_bucket', 'in_stock', 'on_sale'), name='unique_product_facet'),
+        ),
+        migrations.RunPython(populate_facets, migrations.RunPython.noop),
+    ]
@@ -1,62 +1,310 @@
-from django.db import models
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
-from django.utils.text import slugify
 from django.utils import timezone
 
+from .slugs import save_with_unique_slug
+
 User = settings.AUTH_USER_MODEL
 
+
+class TrackLoadedValuesMixin:
+    """
+    Remembers the column values an instance was loaded with, so save() and
+    signal handlers can tell what changed without re-reading the row.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def loaded_value(self, name, default=None):
+        return getattr(self, '_loaded_values', {}).get(name, default)
+
+    def remember_saved_values(self, update_fields=None):
+        """Call after a save so the next save compares against what was written."""
+        deferred = self.get_deferred_fields()
+        values = getattr(self, '_loaded_values', {})
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if update_fields is None or field.name in update_fields or field.attname in update_fields:
+                values[field.attname] = getattr(self, field.attname)
+        self._loaded_values = values
+
+
 class Category(models.Model):
     name = models.CharField(max_length=200, unique=True)
     slug = models.SlugField(max_length=200, unique=True, blank=True)
     image = models.ImageField(upload_to='categories/', blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name_plural = 'Categories'
 
     def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
+        save_with_unique_slug(self, 'name', super().save, *args, **kwargs)
 
     def __str__(self):
         return self.name
 
 
-class Product(models.Model):
+class ProductQuerySet(models.QuerySet):
+    def with_primary_image(self):
+        """Prefetch only the first image of each product, in one query."""
+        return self.prefetch_related(models.Prefetch(
+            'images',
+            queryset=ProductImage.objects.order_by('id')[:1],
+            to_attr='primary_images',
+        ))
+
+    def storefront(self):
+        return self.only('id', 'title', 'price', 'slug', 'created_at').with_primary_image()
+
+    def release_reserved(self, amounts):
+        """Take {product_id: units} off reserved in one UPDATE."""
+        if amounts:
+            self.filter(pk__in=amounts).update(reserved=Greatest(
+                Case(*(When(pk=pk, then=F('reserved') - qty) for pk, qty in amounts.items())), Value(0),
+            ))
+
+
+class Product(TrackLoadedValuesMixin, models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     title = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     old_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     description = models.TextField(blank=True)
     stock = models.PositiveIntegerField(default=0)
+    # Units held by live StockReservations; maintained by services.hold_stock.
+    reserved = models.PositiveIntegerField(default=0, editable=False)
+    # With shards, stock lives in StockShard rows and `stock` is a mirror
+    # refreshed in the background; see stock_shards.py.
+    shard_count = models.PositiveSmallIntegerField(default=0, editable=False)
     slug = models.SlugField(max_length=255, unique=True, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
+    # Bulk writers set this themselves; catalog_cache seeds the catalog
+    # version from its maximum.
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+            models.Index(fields=['category', '-created_at'], name='product_category_created_idx'),
+            models.Index(fields=['stock'], name='product_stock_idx'),
+            # Newest first: the default ordering and the list's keyset sort.
+            models.Index(fields=['-created_at', 'id'], name='product_created_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+        ]
+
+    # Kept by targeted UPDATEs elsewhere; a save of a loaded product would
+    # otherwise write back whatever it was loaded with.
+    COUNTER_FIELDS = ('reserved', 'shard_count')
 
     def save(self, *args, **kwargs):
-        if not self.slug:
-            base = slugify(self.title)
-            slug = base
-            n = 1
-            while Product.objects.filter(slug=slug).exists():
-                slug = f"{base}-{n}"
-                n += 1
-            self.slug = slug
-        super().save(*args, **kwargs)
+        if not self._state.adding and not args and not kwargs.get('force_insert') \
+                and kwargs.get('update_fields') is None:
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS and field.attname not in deferred
+            ]
+        save_with_unique_slug(self, 'title', super().save, *args, **kwargs)
+        self.remember_saved_values(kwargs.get('update_fields'))
 
     def __str__(self):
         return self.title
 
+    def facet_key(self, values=None):
+        """The ProductFacet row this product is counted in."""
+        if values is None:
+            values = {name: getattr(self, name) for name in ('category_id', 'price', 'old_price', 'stock')}
+        elif not {'category_id', 'price', 'old_price', 'stock'} <= set(values):
+            return None
+        price, old_price = values['price'], values['old_price']
+        return (
+            values['category_id'],
+            price_bucket(price),
+            values['stock'] > 0,
+            old_price is not None and old_price > price,
+        )
+
+    def loaded_facet_key(self):
+        return self.facet_key(getattr(self, '_loaded_values', {}))
+
+    @property
+    def available(self):
+        """Stock not held by anyone's cart."""
+        return max(self.stock - self.reserved, 0)
+
+    @property
+    def primary_image(self):
+        if hasattr(self, 'primary_images'):
+            return self.primary_images[0] if self.primary_images else None
+        return self.images.order_by('id').first()
+
+
+# Lower edges of the price buckets facet counts are grouped into; the last
+# bucket is open-ended.
+PRICE_BUCKETS = (0, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+
+def price_bucket(price):
+    return max(bisect_right(PRICE_BUCKETS, price) - 1, 0)
+
+
+class ProductFacet(models.Model):
+    """
+    Materialized product counts per (category, price bucket, in stock, on
+    sale). Kept up to date incrementally from Product saves and deletes, so
+    facet counts are a sum over a handful of rows instead of a COUNT over the
+    catalog.
+    """
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='facets')
+    price_bucket = models.PositiveSmallIntegerField()
+    in_stock = models.BooleanField()
+    on_sale = models.BooleanField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'price_bucket', 'in_stock', 'on_sale'],
+                                    name='unique_product_facet'),
+        ]
 
-class ProductImage(models.Model):
+    def __str__(self):
+        return f"{self.category_id}/{self.price_bucket}/{self.in_stock}/{self.on_sale}: {self.count}"
+
+    @classmethod
+    def adjust(cls, key, delta):
+        category_id, bucket, in_stock, on_sale = key
+        rows = cls.objects.filter(category_id=category_id, price_bucket=bucket, in_stock=in_stock, on_sale=on_sale)
+        if delta < 0:
+            rows.filter(count__gte=-delta).update(count=F('count') + delta)
+            return
+        if rows.update(count=F('count') + delta):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(category_id=category_id, price_bucket=bucket,
+                                   in_stock=in_stock, on_sale=on_sale, count=delta)
+        except IntegrityError:
+            rows.update(count=F('count') + delta)
+
+    @classmethod
+    def move(cls, old_key, new_key):
+        if old_key != new_key:
+            if old_key is not None:
+                cls.adjust(old_key, -1)
+            cls.adjust(new_key, 1)
+
+    @classmethod
+    def rebuild(cls):
+        """Recount every facet row from the product table in one GROUP BY."""
+        bucket = Case(
+            *(When(price__gte=edge, then=Value(i)) for i, edge in reversed(list(enumerate(PRICE_BUCKETS)))),
+            default=Value(0),
+        )
+        rows = (
+            Product.objects.order_by()
+            .annotate(
+                bucket=bucket,
+                available=Case(When(stock__gt=0, then=Value(True)), default=Value(False)),
+                discounted=Case(When(old_price__gt=F('price'), then=Value(True)), default=Value(False)),
+            )
+            .values('category_id', 'bucket', 'available', 'discounted')
+            .annotate(total=Count('id'))
+        )
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                cls(category_id=row['category_id'], price_bucket=row['bucket'], in_stock=row['available'],
+                    on_sale=row['discounted'], count=row['total'])
+                for row in rows
+            )
+
+    @classmethod
+    def _count_querysets(cls, category=None, min_price=None, max_price=None, in_stock=False, on_sale=False):
+        rows = cls.objects.filter(count__gt=0)
+        if in_stock:
+            rows = rows.filter(in_stock=True)
+        if on_sale:
+            rows = rows.filter(on_sale=True)
+
+        by_category = rows
+        if min_price is not None:
+            by_category = by_category.filter(price_bucket__gte=price_bucket(min_price))
+        if max_price is not None:
+            by_category = by_category.filter(price_bucket__lte=price_bucket(max_price))
+        categories = (
+            by_category.values_list('category__slug', 'category__name')
+            .annotate(total=Sum('count')).order_by('category__name')
+        )
+
+        by_price = rows.filter(category__slug=category) if category else rows
+        buckets = by_price.values_list('price_bucket').annotate(total=Sum('count')).order_by()
+        return categories, buckets
+
+    @staticmethod
+    def _format_counts(categories, buckets):
+        buckets = dict(buckets)
+        edges = PRICE_BUCKETS + (None,)
+        return {
+            'categories': [
+                {'slug': slug, 'name': name, 'count': total} for slug, name, total in categories
+            ],
+            'price': [
+                {'min': edges[i], 'max': edges[i + 1], 'count': buckets[i]}
+                for i in range(len(PRICE_BUCKETS)) if buckets.get(i)
+            ],
+        }
+
+    @classmethod
+    def counts(cls, **filters):
+        """
+        Facet counts for a listing. Each facet ignores its own filter, so the
+        category facet shows what other categories would hold under the current
+        price filter and vice versa. Price filters apply at bucket granularity.
+        Accepts category, min_price, max_price, in_stock and on_sale.
+        """
+        categories, buckets = cls._count_querysets(**filters)
+        return cls._format_counts(list(categories), list(buckets))
+
+    @classmethod
+    async def acounts(cls, **filters):
+        categories, buckets = cls._count_querysets(**filters)
+        return cls._format_counts([row async for row in categories], [row async for row in buckets])
+
+
+class ProductImage(TrackLoadedValuesMixin, models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/')
+    # Filled in by imaging.process() after upload.
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    blurhash = models.CharField(max_length=64, blank=True, editable=False)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"Image for {self.product.title}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.remember_saved_values(kwargs.get('update_fields'))
+
+    def derivative(self, size, fmt='webp'):
+        """Storage name of a rendered size, or None until it has been rendered."""
+        return self.derivatives.get(size, {}).get(fmt)
+
 
 class Address(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='addresses')
@@ -69,6 +317,11 @@ class Address(models.Model):
     postal_code = models.CharField(max_length=20)
     is_default = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_default'], name='address_user_default_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if self.is_default:
             # unset others
@@ -79,21 +332,48 @@ class Address(models.Model):
         return f"{self.full_name} - {self.city}"
 
 
+class CartQuerySet(models.QuerySet):
+    def recalculate_totals(self):
+        """Recompute the stored subtotal/item_count of every cart in one UPDATE."""
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        line_total = F('quantity') * F('product__price')
+        total_field = models.DecimalField(max_digits=12, decimal_places=2)
+        return self.update(
+            subtotal=Coalesce(
+                Subquery(items.annotate(total=Sum(line_total, output_field=total_field)).values('total')),
+                Value(Decimal('0')),
+                output_field=total_field,
+            ),
+            item_count=Coalesce(Subquery(items.annotate(count=Sum('quantity')).values('count')), Value(0)),
+            updated_at=timezone.now(),
+        )
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cart')
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
     def __str__(self):
         return f"Cart({self.user})"
 
-    @property
-    def subtotal(self):
-        items = self.items.all()
-        total = sum(item.subtotal for item in items)
-        return total
+    @classmethod
+    def adjust_totals(cls, cart_id, quantity, amount):
+        cls.objects.filter(pk=cart_id).update(
+            item_count=F('item_count') + quantity,
+            subtotal=F('subtotal') + amount,
+            updated_at=timezone.now(),
+        )
+
+    def clear(self):
+        self.items.all().delete()
+        Cart.objects.filter(pk=self.pk).update(subtotal=0, item_count=0, updated_at=timezone.now())
 
 
-class CartItem(models.Model):
+class CartItem(TrackLoadedValuesMixin, models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
@@ -108,6 +388,64 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.title}"
 
+    def save(self, *args, **kwargs):
+        # Cart.subtotal/item_count are kept in step in the same transaction.
+        old_cart = self.loaded_value('cart_id')
+        old_product = self.loaded_value('product_id')
+        old_quantity = self.loaded_value('quantity', 0)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_cart in (None, self.cart_id) and old_product in (None, self.product_id):
+                delta = self.quantity - old_quantity
+                if delta:
+                    Cart.adjust_totals(self.cart_id, delta, delta * self.product.price)
+            else:
+                Cart.objects.filter(pk__in={old_cart, self.cart_id}).recalculate_totals()
+        self.remember_saved_values(kwargs.get('update_fields'))
+
+    def delete(self, *args, **kwargs):
+        quantity = self.loaded_value('quantity', self.quantity)
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            Cart.adjust_totals(self.cart_id, -quantity, -quantity * self.product.price)
+        return result
+
+
+class StockShard(models.Model):
+    """One slice of a sharded product's stock."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+    index = models.PositiveSmallIntegerField()
+    stock = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'index'], name='unique_product_stock_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}[{self.index}] = {self.stock}"
+
+
+class StockReservation(models.Model):
+    """
+    A time-limited hold on `quantity` units of a product for one cart. The
+    sum of live holds per product is kept in Product.reserved, so available
+    stock is read from the product row rather than summed per request.
+    """
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product_reservation'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for cart {self.cart_id} until {self.expires_at}"
+
 
 class Wishlist(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='wishlist')
@@ -135,6 +473,15 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Order history: one user's orders, newest first.
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_id_idx'),
+            # The admin's status and date filters.
+            models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+            models.Index(fields=['-created_at'], name='order_created_idx'),
+        ]
+
     def calculate_total(self):
         items_total = sum(item.subtotal for item in self.items.all())
         self.total = items_total
@@ -179,7 +526,58 @@ class PaymentRecord(models.Model):
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-created_at'], name='payment_status_created_idx'),
+        ]
+
     def __str__(self):
         return f"Payment {self.payment_id} - {self.status}"
 
 
+class TaskQuerySet(models.QuerySet):
+    def due(self, now, lease):
+        """Queued tasks whose time has come, plus running ones whose worker has gone quiet."""
+        return self.filter(
+            models.Q(status=Task.QUEUED, run_at__lte=now)
+            | models.Q(status=Task.RUNNING, locked_at__lt=now - lease)
+        )
+
+
+class Task(models.Model):
+    """A unit of background work, run by `manage.py run_tasks`. See taskqueue.py."""
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
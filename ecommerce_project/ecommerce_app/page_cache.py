@@ -0,0 +1,210 @@
+"""
+Full-page cache for anonymous storefront pages.
+
+PageCacheMiddleware answers GETs and HEADs of PAGE_CACHE_VIEWS from clients
+without a session cookie with the page as rendered for the first of them,
+without touching the view, the templates or the rest of the middleware.
+Pages are keyed by path and query string and by the version of what they
+show: the product's version for views taking a product `slug` (bumped when
+that product or its images change), the catalog version for the others
+(bumped when any product does).
+
+When a page is missing, one request renders it while the others wait up to
+PAGE_CACHE_LOCK_WAIT seconds for it rather than rendering it too. It is
+rendered from the primary database, since it is cached until the next change
+and a lagging replica could still hold the old rows. Alongside the page, a
+gzip and (with the brotli package installed) a brotli copy are stored and
+served to clients that accept them.
+
+Only 200 responses that set no cookie and aren't marked private or no-store
+are cached.
+"""
+import asyncio
+import gzip
+import hashlib
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+
+from . import metrics, routers
+from .catalog_cache import acatalog_version, aproduct_versions, catalog_version, product_versions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smallest body worth compressing, as in GZipMiddleware.
+MIN_COMPRESS_LENGTH = 200
+_POLL_SECONDS = 0.05
+_REFUSED = re.compile(r';\s*q=0(\.0*)?\s*$')
+
+
+def _cache():
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def _match(request):
+    if request.method not in ('GET', 'HEAD') or settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return None
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return None
+    return match if match.view_name in settings.PAGE_CACHE_VIEWS else None
+
+
+def page_key(request, version):
+    params = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    digest = hashlib.blake2b(repr((request.path, params)).encode(), digest_size=16).hexdigest()
+    return f'page:{digest}:{version}'
+
+
+def encodings(request):
+    """Encodings to look for, best first."""
+    accepted = {
+        part.split(';')[0].strip().lower()
+        for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')
+        if not _REFUSED.search(part)
+    }
+    return [encoding for encoding in ('br', 'gzip') if encoding in accepted] + ['identity']
+
+
+def variants(response):
+    """Cache entries for `response`: encoding -> (headers, body)."""
+    patch_vary_headers(response, ['Accept-Encoding'])
+    headers = [(name, value) for name, value in response.items() if name.lower() != 'content-length']
+    body = response.content
+    bodies = {'identity': body}
+    if len(body) >= MIN_COMPRESS_LENGTH:
+        # Compressed once per page version, so at the highest levels.
+        bodies['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            bodies['br'] = brotli.compress(body, quality=11)
+    return {
+        encoding: (headers + ([] if encoding == 'identity' else [('Content-Encoding', encoding)]), content)
+        for encoding, content in bodies.items()
+        if encoding == 'identity' or len(content) < len(body)
+    }
+
+
+def cacheable(response):
+    cache_control = response.get('Cache-Control', '')
+    return (
+        response.status_code == 200 and not response.streaming and not response.cookies
+        and 'private' not in cache_control and 'no-store' not in cache_control
+    )
+
+
+def _response(found, wanted):
+    for encoding in wanted:
+        if encoding in found:
+            headers, body = found[encoding]
+            response = HttpResponse(body, headers=headers)
+            response.headers['Content-Length'] = str(len(body))
+            return response
+    return None
+
+
+class PageCacheMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _lookup(self, request, match, version):
+        """The page's key, the encodings wanted and their cache keys."""
+        # Labels the request in metrics when the view never runs.
+        request.resolver_match = match
+        key = page_key(request, version)
+        wanted = encodings(request)
+        return key, wanted, {f'{key}:{encoding}': encoding for encoding in wanted}
+
+    def _found(self, request, cached, keys, wanted, result):
+        response = _response({keys[key]: entry for key, entry in cached.items()}, wanted)
+        if response is not None:
+            metrics.PAGE_CACHE_REQUESTS.inc(endpoint=request.resolver_match.view_name, result=result)
+        return response
+
+    def _entries(self, request, key, response):
+        """What to store for a freshly rendered `response`."""
+        metrics.PAGE_CACHE_REQUESTS.inc(endpoint=request.resolver_match.view_name, result='miss')
+        if not cacheable(response):
+            return {}
+        return {f'{key}:{encoding}': entry for encoding, entry in variants(response).items()}
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        match = _match(request)
+        if match is None:
+            return self.get_response(request)
+        slug = match.kwargs.get('slug')
+        version = product_versions([slug])[slug] if slug else catalog_version()
+        key, wanted, keys = self._lookup(request, match, version)
+        cache = _cache()
+        response = self._found(request, cache.get_many(keys), keys, wanted, 'hit')
+        if response is not None:
+            return response
+
+        lock = f'{key}:lock'
+        locked = cache.add(lock, 1, settings.PAGE_CACHE_LOCK_WAIT)
+        if not locked:
+            # Another request is rendering the page: wait for it, then
+            # render it ourselves if it takes too long.
+            deadline = time.monotonic() + settings.PAGE_CACHE_LOCK_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(_POLL_SECONDS)
+                response = self._found(request, cache.get_many(keys), keys, wanted, 'wait')
+                if response is not None:
+                    return response
+        routers.use_primary()
+        try:
+            response = self.get_response(request)
+            cache.set_many(self._entries(request, key, response))
+            return response
+        finally:
+            if locked:
+                cache.delete(lock)
+
+    async def __acall__(self, request):
+        match = _match(request)
+        if match is None:
+            return await self.get_response(request)
+        slug = match.kwargs.get('slug')
+        version = (await aproduct_versions([slug]))[slug] if slug else await acatalog_version()
+        key, wanted, keys = self._lookup(request, match, version)
+        cache = _cache()
+        response = self._found(request, await cache.aget_many(keys), keys, wanted, 'hit')
+        if response is not None:
+            return response
+
+        lock = f'{key}:lock'
+        locked = await cache.aadd(lock, 1, settings.PAGE_CACHE_LOCK_WAIT)
+        if not locked:
+            # Another request is rendering the page: wait for it, then
+            # render it ourselves if it takes too long.
+            deadline = time.monotonic() + settings.PAGE_CACHE_LOCK_WAIT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(_POLL_SECONDS)
+                response = self._found(request, await cache.aget_many(keys), keys, wanted, 'wait')
+                if response is not None:
+                    return response
+        routers.use_primary()
+        try:
+            response = await self.get_response(request)
+            await cache.aset_many(self._entries(request, key, response))
+            return response
+        finally:
+            if locked:
+                await cache.adelete(lock)
@@ -0,0 +1,146 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class InvalidCursor(ParseError):
+    default_detail = 'Invalid cursor.'
+    default_code = 'invalid_cursor'
+
+
+def encode_cursor(values):
+    raw = json.dumps([str(v) if v is not None else None for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (TypeError, ValueError):
+        raise InvalidCursor
+    if not isinstance(values, list):
+        raise InvalidCursor
+    return values
+
+
+def keyset_filter(ordering, values):
+    """
+    Build the "row comes after (values)" condition for a multi-column
+    ordering, e.g. ('-created_at', 'id') ->
+    created_at <= c AND (created_at < c OR (created_at = c AND id > i)).
+
+    The leading bound is implied by the OR chain, but without it the planner
+    can't turn the condition into a range on the ordering index and walks it
+    from the start instead.
+    """
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        clause = Q(**{f'{name}__{lookup}': values[i]})
+        for prev, value in zip(ordering[:i], values[:i]):
+            clause &= Q(**{prev.lstrip('-'): value})
+        condition |= clause
+    first = ordering[0]
+    return Q(**{f"{first.lstrip('-')}__{'lte' if first.startswith('-') else 'gte'}": values[0]}) & condition
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on a composite, unique ordering. Every page is a single
+    range scan of the ordering's index, starting at the cursor, so deep pages
+    cost what the first one does.
+    """
+    ordering = ('-created_at', 'id')
+    page_size = 24
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def get_ordering(self, view):
+        return tuple(getattr(view, 'keyset_ordering', None) or self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def _to_python(self, queryset, name, value):
+        if value is None:
+            return None
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field.to_python(value)
+        return queryset.model._meta.get_field(name).to_python(value)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self._set_page(list(self._page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        return self._set_page([obj async for obj in queryset.aiterator(chunk_size=self.page_size + 1)])
+
+    def _page_queryset(self, queryset, request, view):
+        self.request = request
+        self.ordering = self.get_ordering(view)
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor
+            names = [f.lstrip('-') for f in self.ordering]
+            try:
+                values = [self._to_python(queryset, n, v) for n, v in zip(names, values)]
+            except Exception:
+                raise InvalidCursor
+            queryset = queryset.filter(keyset_filter(self.ordering, values))
+
+        # Fetch one extra row to know whether another page exists.
+        return queryset[:self.page_size + 1]
+
+    def _set_page(self, results):
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        values = [getattr(last, f.lstrip('-')) for f in self.ordering]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(values))
+
+    def get_first_link(self):
+        if not self.request.query_params.get(self.cursor_query_param):
+            return None
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('first', self.get_first_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,152 @@
+"""
+Read replica routing.
+
+Catalog reads (CATALOG_MODELS) made while serving a GET or HEAD of one of
+REPLICA_VIEWS go to one of DATABASE_REPLICAS; everything else, including
+every write, every other model and view, management commands and tasks,
+uses the primary. A request sticks to the replica it first reads from,
+picked round-robin or least-loaded (fewest requests in flight in this
+process) according to REPLICA_SELECTION.
+
+A client that wrote something reads from the primary for the next
+REPLICA_PIN_SECONDS so it sees its own writes whatever the replication lag:
+ReplicaRoutingMiddleware sets a cookie whenever handling its request wrote
+to the database (or read for update). Later reads in that same request also
+go to the primary.
+"""
+import itertools
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'primary_until'
+CATALOG_MODELS = {
+    'ecommerce_app.category', 'ecommerce_app.product', 'ecommerce_app.productimage', 'ecommerce_app.productfacet',
+}
+
+
+class ReplicaPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self.in_flight = Counter()
+
+    def acquire(self, replicas, selection):
+        with self._lock:
+            # Rotating the starting point also spreads ties in least-loaded.
+            start = next(self._turn) % len(replicas)
+            order = replicas[start:] + replicas[:start]
+            alias = min(order, key=self.in_flight.__getitem__) if selection == 'least-loaded' else order[0]
+            self.in_flight[alias] += 1
+        return alias
+
+    def release(self, alias):
+        with self._lock:
+            self.in_flight[alias] -= 1
+
+
+pool = ReplicaPool()
+
+
+class RoutingState:
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.use_replicas = False
+        self.replica = None
+        self.wrote = False
+
+
+_current = ContextVar('replica_routing', default=None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if (state is None or not state.use_replicas or state.pinned or state.wrote
+                or model._meta.label_lower not in CATALOG_MODELS):
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            state.replica = pool.acquire(settings.DATABASE_REPLICAS, settings.REPLICA_SELECTION)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas are copies of the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def use_primary():
+    """Send the rest of the current request's reads to the primary."""
+    state = _current.get()
+    if state is not None:
+        state.pinned = True
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _current.get()
+        if state is not None:
+            state.use_replicas = (
+                bool(settings.DATABASE_REPLICAS) and request.method in ('GET', 'HEAD')
+                and request.resolver_match.view_name in settings.REPLICA_VIEWS
+            )
+
+    def _finish(self, state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            until = time.time() + settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, f'{until:.0f}', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = RoutingState(_pinned(request))
+        token = _current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+            if state.replica is not None:
+                pool.release(state.replica)
+        return self._finish(state, response)
+
+    async def __acall__(self, request):
+        state = RoutingState(_pinned(request))
+        token = _current.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+            if state.replica is not None:
+                pool.release(state.replica)
+        return self._finish(state, response)
@@ -0,0 +1,263 @@
+"""
+Full-text product search over title, description and category name.
+
+On SQLite the index is an FTS5 virtual table (created by migration 0003)
+ranked with its built-in bm25(). Other databases fall back to an
+in-process inverted index with the same BM25 ranking, built lazily from the
+database and kept up to date by the model signals in signals.py.
+
+Both backends return hits as (score, product_id) pairs sorted ascending,
+lower scores being better, so (score, id) works as a keyset cursor.
+"""
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+from .models import Product
+
+FTS_TABLE = 'ecommerce_app_product_search'
+TOKEN_RE = re.compile(r'\w+')
+# A title hit counts more than a category hit, which counts more than one
+# somewhere in the description.
+WEIGHTS = {'title': 10.0, 'description': 1.0, 'category': 4.0}
+BATCH_SIZE = 500
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+class FTS5Backend:
+    def _insert(self, cursor, where='', params=()):
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, description, category, category_slug) '
+            'SELECT p.id, p.title, p.description, c.name, c.slug '
+            'FROM ecommerce_app_product p JOIN ecommerce_app_category c ON c.id = p.category_id '
+            f'{where}',
+            params,
+        )
+
+    def index(self, product_ids):
+        with connection.cursor() as cursor:
+            for chunk in _chunks(product_ids):
+                marks = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({marks})', chunk)
+                self._insert(cursor, f'WHERE p.id IN ({marks})', chunk)
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            for chunk in _chunks(product_ids):
+                marks = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({marks})', chunk)
+
+    def reindex_category(self, category):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {FTS_TABLE} SET category = %s, category_slug = %s '
+                'WHERE rowid IN (SELECT id FROM ecommerce_app_product WHERE category_id = %s)',
+                [category.name, category.slug, category.pk],
+            )
+
+    def rebuild(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            self._insert(cursor)
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+
+    def search(self, query, category=None, limit=24, after=None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # Every term is quoted (so it can't be read as an FTS operator) and
+        # prefix-matched; terms are ANDed together.
+        match = ' '.join(f'"{term}"*' for term in terms)
+        weights = ', '.join(str(WEIGHTS[column]) for column in ('title', 'description', 'category'))
+        sql = (
+            f'SELECT rowid, bm25({FTS_TABLE}, {weights}, 0.0) AS score '
+            f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+        )
+        params = [match]
+        if category:
+            sql += ' AND category_slug = %s'
+            params.append(category)
+        sql = f'SELECT score, rowid FROM ({sql})'
+        if after is not None:
+            sql += ' WHERE score > %s OR (score = %s AND rowid > %s)'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY score, rowid LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(score, pk) for score, pk in cursor.fetchall()]
+
+
+class InMemoryBackend:
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._clear()
+
+    def _clear(self):
+        self.postings = defaultdict(dict)   # term -> {product_id: weighted term frequency}
+        self.doc_terms = {}                 # product_id -> terms, for removal
+        self.doc_length = {}                # product_id -> weighted length
+        self.doc_category = {}              # product_id -> category slug
+        self.total_length = 0.0
+        self._sorted_terms = None
+
+    def _rows(self, product_ids=None):
+        qs = Product.objects.values_list('id', 'title', 'description', 'category__name', 'category__slug')
+        if product_ids is not None:
+            qs = qs.filter(pk__in=product_ids)
+        return qs.iterator(chunk_size=2000)
+
+    def _add(self, pk, title, description, category_name, category_slug):
+        self._discard(pk)
+        frequencies = defaultdict(float)
+        for column, text in (('title', title), ('description', description), ('category', category_name)):
+            for term in tokenize(text):
+                frequencies[term] += WEIGHTS[column]
+        for term, frequency in frequencies.items():
+            self.postings[term][pk] = frequency
+        self.doc_terms[pk] = tuple(frequencies)
+        self.doc_length[pk] = sum(frequencies.values())
+        self.doc_category[pk] = category_slug
+        self.total_length += self.doc_length[pk]
+        self._sorted_terms = None
+
+    def _discard(self, pk):
+        for term in self.doc_terms.pop(pk, ()):
+            postings = self.postings[term]
+            postings.pop(pk, None)
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.doc_length.pop(pk, 0.0)
+        self.doc_category.pop(pk, None)
+        self._sorted_terms = None
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.rebuild()
+
+    def _on_commit(self, func):
+        # The index isn't transactional, so only apply committed changes.
+        transaction.on_commit(func)
+
+    def index(self, product_ids):
+        product_ids = list(product_ids)
+
+        def apply():
+            with self._lock:
+                if not self._loaded:
+                    return
+                rows = {row[0]: row for row in self._rows(product_ids)}
+                for pk in product_ids:
+                    if pk in rows:
+                        self._add(*rows[pk])
+                    else:
+                        self._discard(pk)
+        self._on_commit(apply)
+
+    def remove(self, product_ids):
+        product_ids = list(product_ids)
+
+        def apply():
+            with self._lock:
+                for pk in product_ids:
+                    self._discard(pk)
+        self._on_commit(apply)
+
+    def reindex_category(self, category):
+        self.index(category.products.values_list('pk', flat=True))
+
+    def rebuild(self):
+        with self._lock:
+            self._clear()
+            for row in self._rows():
+                self._add(*row)
+            self._loaded = True
+
+    def _expand(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = self._sorted_terms
+        i = bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            yield terms[i]
+            i += 1
+
+    def search(self, query, category=None, limit=24, after=None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            self._ensure_loaded()
+            count = len(self.doc_length)
+            if not count:
+                return []
+            average = self.total_length / count
+            scores = None
+            for prefix in terms:
+                term_scores = defaultdict(float)
+                for term in self._expand(prefix):
+                    postings = self.postings[term]
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for pk, frequency in postings.items():
+                        norm = self.k1 * (1 - self.b + self.b * self.doc_length[pk] / average)
+                        term_scores[pk] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pk: scores[pk] + s for pk, s in term_scores.items() if pk in scores}
+                if not scores:
+                    return []
+            hits = (
+                (-score, pk) for pk, score in scores.items()
+                if not category or self.doc_category.get(pk) == category
+            )
+            if after is not None:
+                hits = (hit for hit in hits if hit > tuple(after))
+            return heapq.nsmallest(limit, hits)
+
+
+_memory_backend = InMemoryBackend()
+
+
+def get_backend():
+    if connection.vendor == 'sqlite':
+        return FTS5Backend()
+    return _memory_backend
+
+
+def index_products(product_ids):
+    get_backend().index(product_ids)
+
+
+def remove_products(product_ids):
+    get_backend().remove(product_ids)
+
+
+def reindex_category(category):
+    get_backend().reindex_category(category)
+
+
+def rebuild():
+    get_backend().rebuild()
+
+
+def search(query, category=None, limit=24, after=None):
+    return get_backend().search(query, category=category, limit=limit, after=after)
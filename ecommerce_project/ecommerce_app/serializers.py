@@ -4,15 +4,52 @@ from .models import (
     Cart, CartItem, Wishlist, Order, OrderItem, PaymentRecord
 )
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+
+from .metrics import TimedSerializerMixin
 
 User = get_user_model()
 
-class ProductImageSerializer(serializers.ModelSerializer):
+
+class ModelSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """ModelSerializer whose output time is recorded by ecommerce_app.metrics."""
+
+
+class DynamicFieldsModelSerializer(ModelSerializer):
+    """
+    Accepts an optional `fields` argument restricting which fields are
+    serialized, e.g. ProductSerializer(qs, many=True, fields=['id', 'title']).
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class ProductImageSerializer(ModelSerializer):
+    image = serializers.SerializerMethodField()
+    derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = ProductImage
-        fields = ('id', 'image')
-
-class ProductSerializer(serializers.ModelSerializer):
+        fields = ('id', 'image', 'width', 'height', 'blurhash', 'derivatives')
+
+    def get_image(self, obj):
+        # Site-relative, like the derivatives: product payloads are cached
+        # without a request, so they can't be made absolute per host.
+        return obj.image.url if obj.image else None
+
+    def get_derivatives(self, obj):
+        # {"card": {"width": 480, "height": 320, "webp": url, "jpeg": url}, ...}
+        return {
+            size: {key: default_storage.url(value) if key in ('webp', 'jpeg') else value
+                   for key, value in entry.items()}
+            for size, entry in obj.derivatives.items()
+        }
+
+class ProductSerializer(DynamicFieldsModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     category = serializers.StringRelatedField()
 
@@ -20,18 +57,43 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ('id', 'title', 'category', 'price', 'old_price', 'description', 'stock', 'slug', 'created_at', 'images')
 
-class CategorySerializer(serializers.ModelSerializer):
+class ProductFilterSerializer(serializers.Serializer):
+    SORTS = {
+        'newest': ('-created_at', 'id'),
+        'price': ('price', 'id'),
+        '-price': ('-price', 'id'),
+        'discount': ('-discount', 'id'),
+    }
+
+    category = serializers.SlugField(required=False)
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    in_stock = serializers.BooleanField(default=False)
+    on_sale = serializers.BooleanField(default=False)
+    sort = serializers.ChoiceField(choices=list(SORTS), default='newest')
+
+class CatalogRowSerializer(serializers.Serializer):
+    slug = serializers.SlugField(max_length=255, required=False, allow_blank=True)
+    title = serializers.CharField(max_length=255)
+    category = serializers.CharField(max_length=200)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    old_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False, allow_null=True)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+    stock = serializers.IntegerField(min_value=0, default=0)
+    images = serializers.ListField(child=serializers.CharField(max_length=100), required=False, default=list)
+
+class CategorySerializer(ModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'name', 'slug', 'image')
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(ModelSerializer):
     class Meta:
         model = Address
         fields = '__all__'
         read_only_fields = ('user',)
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_id = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all(), write_only=True, source='product')
 
@@ -39,29 +101,51 @@ class CartItemSerializer(serializers.ModelSerializer):
         model = CartItem
         fields = ('id', 'product', 'product_id', 'quantity', 'subtotal')
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     subtotal = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
 
     class Meta:
         model = Cart
-        fields = ('id', 'user', 'items', 'subtotal')
+        fields = ('id', 'user', 'items', 'subtotal', 'item_count')
+
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(default=1)
 
-class WishlistSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        minimum = {'add': 1, 'set': 0}.get(attrs['op'])
+        if minimum is not None and attrs['quantity'] < minimum:
+            raise serializers.ValidationError(
+                {'quantity': f'Ensure this value is greater than or equal to {minimum}.'}
+            )
+        return attrs
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=500)
+
+class WishlistProductSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+
+class WishlistProductsSerializer(serializers.Serializer):
+    product_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=500)
+
+class WishlistSerializer(ModelSerializer):
     products = ProductSerializer(many=True, read_only=True)
 
     class Meta:
         model = Wishlist
         fields = ('id', 'user', 'products')
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(ModelSerializer):
     product = ProductSerializer(read_only=True)
 
     class Meta:
         model = OrderItem
         fields = ('id', 'product', 'quantity', 'price', 'subtotal')
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     address = AddressSerializer(read_only=True)
 
@@ -69,7 +153,14 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'user', 'address', 'status', 'total', 'items', 'created_at')
 
-class PaymentRecordSerializer(serializers.ModelSerializer):
+class OrderSummarySerializer(ModelSerializer):
+    item_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'status', 'total', 'item_count', 'created_at')
+
+class PaymentRecordSerializer(ModelSerializer):
     class Meta:
         model = PaymentRecord
         fields = '__all__'
\ No newline at end of file
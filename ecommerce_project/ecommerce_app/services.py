@@ -1,10 +1,277 @@
-from .models import Cart, CartItem, Product
-
-def add_to_cart(user, product_id, quantity=1):
-    cart, _ = Cart.objects.get_or_create(user=user)
-    product = Product.objects.get(pk=product_id)
-    item, created = CartItem.objects.get_or_create(cart=cart, product=product, defaults={'quantity': quantity})
-    if not created:
-        item.quantity += quantity
-        item.save()
-    return cart
\ No newline at end of file
+import operator
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import stock_shards
+from .models import Cart, CartItem, Order, OrderItem, Product, ProductFacet, StockReservation
+from .signals import invalidate_products
+from .taskqueue import enqueue
+from .tasks import send_order_confirmation, sync_stock_shards
+
+
+class EmptyCart(Exception):
+    pass
+
+
+class InsufficientStock(Exception):
+    def __init__(self, products):
+        self.products = products
+        super().__init__("Not enough stock for " + ", ".join(p.title for p in products))
+
+
+class UnknownProducts(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = sorted(product_ids)
+        super().__init__("Unknown product ids: " + ", ".join(map(str, self.product_ids)))
+
+
+def hold_stock(cart, quantities):
+    """
+    Make the cart's holds on these products match {product_id: quantity} (0
+    releases the hold) and push their expiry STOCK_RESERVATION_TTL ahead.
+    Raises InsufficientStock if a product can't cover the extra units; call
+    inside a transaction so nothing is kept in that case.
+
+    Every hold is a conditional increment of Product.reserved, so concurrent
+    adds of one product never wait on each other for longer than that single
+    UPDATE, and availability is never summed over the holds table.
+    """
+    if not quantities:
+        return
+    # Locked so the expired-hold reaper can't release one of these between
+    # this read and the upsert below, which would then undercount reserved.
+    held = dict(
+        cart.reservations.select_for_update().filter(product_id__in=quantities).values_list('product_id', 'quantity')
+    )
+    grow, shrink = {}, {}
+    for product_id, quantity in quantities.items():
+        delta = max(quantity, 0) - held.get(product_id, 0)
+        if delta > 0:
+            grow[product_id] = delta
+        elif delta < 0:
+            shrink[product_id] = -delta
+
+    if grow:
+        # As in place_order: the row count says whether every product matched.
+        enough = reduce(operator.or_, (Q(pk=pk, stock__gte=F('reserved') + qty) for pk, qty in grow.items()))
+        updated = Product.objects.filter(enough).update(
+            reserved=Case(*(When(pk=pk, then=F('reserved') + qty) for pk, qty in grow.items()))
+        )
+        if updated != len(grow):
+            products = Product.objects.only('id', 'title', 'stock', 'reserved').filter(pk__in=grow)
+            raise InsufficientStock([p for p in products if p.available < grow[p.pk]] or list(products))
+    Product.objects.release_reserved(shrink)
+
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    keep = [
+        StockReservation(cart=cart, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        for product_id, quantity in quantities.items() if quantity > 0
+    ]
+    if keep:
+        StockReservation.objects.bulk_create(
+            keep, update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity', 'expires_at'],
+        )
+    dropped = [product_id for product_id, quantity in quantities.items() if quantity <= 0 and product_id in held]
+    if dropped:
+        cart.reservations.filter(product_id__in=dropped).delete()
+
+
+def unavailable_products(cart):
+    """
+    Products the cart holds more of than it could get: their stock not held by
+    other carts is below the cart's quantity. Reads only; place_order decides.
+    """
+    held = dict(cart.reservations.values_list('product_id', 'quantity'))
+    wanted = dict(cart.items.values_list('product_id', 'quantity'))
+    products = Product.objects.only('id', 'title', 'stock', 'reserved').filter(pk__in=wanted).order_by('pk')
+    return [p for p in products if p.available + held.get(p.pk, 0) < wanted[p.pk]]
+
+
+def release_expired_reservations(batch_size=1000, now=None):
+    """
+    Delete holds past their expiry and give their units back, a batch per
+    transaction. Returns the number of holds released.
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            expired = StockReservation.objects.filter(expires_at__lte=now).order_by('expires_at')
+            if connection.features.has_select_for_update_skip_locked:
+                # Holds a checkout is converting right now are its business.
+                expired = expired.select_for_update(skip_locked=True)
+            rows = list(expired.values_list('pk', 'product_id', 'quantity')[:batch_size])
+            if not rows:
+                break
+            StockReservation.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+            amounts = Counter()
+            for _, product_id, quantity in rows:
+                amounts[product_id] += quantity
+            Product.objects.release_reserved(amounts)
+        released += len(rows)
+        if len(rows) < batch_size:
+            break
+    return released
+
+
+def recount_reserved():
+    """Recompute Product.reserved from the holds table, e.g. after holds were deleted by hand."""
+    holds = StockReservation.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    return Product.objects.update(reserved=Coalesce(
+        Subquery(holds.annotate(total=Sum('quantity')).values('total')), Value(0),
+    ))
+
+
+def update_cart(user, operations):
+    """
+    Apply a list of {'op': 'add' | 'set' | 'remove', 'product_id', 'quantity'}
+    operations, in order, to the user's cart in one transaction. Products are
+    looked up with a single in_bulk() and items written with one bulk_create,
+    bulk_update and delete each, whatever the number of operations. The
+    cart's stock holds follow the new quantities; InsufficientStock is raised
+    (and nothing written) if they can't.
+    """
+    with transaction.atomic():
+        # Concurrent updates of one cart queue up on its row: both would
+        # otherwise read the same items and quantities, then collide on the
+        # (cart, product) constraint or apply their deltas twice.
+        cart, _ = Cart.objects.select_for_update().get_or_create(user=user)
+        product_ids = {op['product_id'] for op in operations}
+        products = Product.objects.only('id', 'price').in_bulk(product_ids)
+        if len(products) != len(product_ids):
+            raise UnknownProducts(product_ids - set(products))
+
+        items = {item.product_id: item for item in cart.items.filter(product_id__in=product_ids)}
+        old = {product_id: item.quantity for product_id, item in items.items()}
+        quantities = dict(old)
+        for op in operations:
+            product_id = op['product_id']
+            if op['op'] == 'add':
+                quantities[product_id] = quantities.get(product_id, 0) + op.get('quantity', 1)
+            elif op['op'] == 'set':
+                quantities[product_id] = op['quantity']
+            else:
+                quantities[product_id] = 0
+
+        hold_stock(cart, {product_id: max(quantity, 0) for product_id, quantity in quantities.items()})
+
+        to_create, to_update, to_delete = [], [], []
+        count_delta, amount_delta = 0, 0
+        for product_id, quantity in quantities.items():
+            quantity = max(quantity, 0)
+            delta = quantity - old.get(product_id, 0)
+            if not delta:
+                continue
+            count_delta += delta
+            amount_delta += delta * products[product_id].price
+            if not quantity:
+                to_delete.append(items[product_id].pk)
+            elif product_id in items:
+                items[product_id].quantity = quantity
+                to_update.append(items[product_id])
+            else:
+                to_create.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+
+        # Bulk writes skip CartItem.save(), so the totals move in one step here.
+        if to_create:
+            CartItem.objects.bulk_create(to_create)
+        if to_update:
+            CartItem.objects.bulk_update(to_update, ['quantity'])
+        if to_delete:
+            CartItem.objects.filter(pk__in=to_delete).delete()
+        if count_delta or amount_delta:
+            Cart.adjust_totals(cart.pk, count_delta, amount_delta)
+    return cart
+
+
+def place_order(cart, address):
+    """
+    Turn `cart` into an Order in a constant number of queries, however many
+    lines it has (plus up to three per sharded product). The cart's stock
+    holds become stock decrements. Raises EmptyCart or InsufficientStock, in
+    which case nothing is written.
+    """
+    with transaction.atomic():
+        # Lock the cart as update_cart does, so an add can't commit between
+        # reading the lines and removing them.
+        cart = Cart.objects.select_for_update().get(pk=cart.pk)
+        lines = list(cart.items.values_list('pk', 'product_id', 'quantity', 'product__shard_count'))
+        quantities = {product_id: quantity for _, product_id, quantity, _ in lines}
+        if not quantities:
+            raise EmptyCart()
+        sharded = {product_id: shards for _, product_id, _, shards in lines if shards}
+        plain = {pk: qty for pk, qty in quantities.items() if pk not in sharded}
+        holds = list(cart.reservations.select_for_update().values_list('pk', 'product_id', 'quantity'))
+        held = {product_id: quantity for _, product_id, quantity in holds}
+
+        # Lock rows in primary key order so concurrent checkouts sharing
+        # products always queue up instead of deadlocking. Sharded products
+        # are not locked: their stock is decremented in the shards.
+        products = list(Product.objects.select_for_update().filter(pk__in=plain).order_by('pk'))
+        if sharded:
+            products += Product.objects.filter(pk__in=sharded).order_by('pk')
+
+        if plain:
+            # One conditional UPDATE for every line: a row without enough
+            # stock outside other carts' holds does not match, so the row
+            # count tells us whether all succeeded. Our own hold is released
+            # in the same step.
+            in_stock = reduce(operator.or_, (
+                Q(pk=pk, stock__gte=F('reserved') - held.get(pk, 0) + qty) for pk, qty in plain.items()
+            ))
+            updated = Product.objects.filter(in_stock).update(
+                stock=Case(*(When(pk=pk, then=F('stock') - qty) for pk, qty in plain.items())),
+                updated_at=timezone.now(),
+                reserved=Greatest(
+                    Case(*(When(pk=pk, then=F('reserved') - held.get(pk, 0)) for pk in plain)), Value(0),
+                ),
+            )
+            if updated != len(plain):
+                short = [
+                    p for p in products
+                    if p.pk in plain and p.stock - p.reserved + held.get(p.pk, 0) < plain[p.pk]
+                ]
+                raise InsufficientStock(short or products)
+        # Holds on sharded products are advisory: the shards are the only
+        # check at checkout.
+        short = [
+            p for p in products
+            if p.pk in sharded and not stock_shards.take(p.pk, quantities[p.pk], p.shard_count)
+        ]
+        if short:
+            raise InsufficientStock(short)
+        Product.objects.release_reserved({pk: qty for pk, qty in held.items() if pk not in plain})
+        if holds:
+            StockReservation.objects.filter(pk__in=[pk for pk, _, _ in holds]).delete()
+        for product in products:
+            if product.pk in plain:
+                old_key = product.facet_key()
+                product.stock -= quantities[product.pk]
+                ProductFacet.move(old_key, product.facet_key())
+            else:
+                key, delay = stock_shards.sync_schedule(product.pk)
+                enqueue(sync_stock_shards, product.pk, key=key, delay=delay)
+
+        order = Order.objects.create(
+            user_id=cart.user_id,
+            address=address,
+            status='PENDING',
+            total=sum(p.price * quantities[p.pk] for p in products),
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=p, quantity=quantities[p.pk], price=p.price)
+            for p in products
+        )
+        # Only the lines that were ordered leave the cart.
+        CartItem.objects.filter(pk__in=[pk for pk, _, _, _ in lines]).delete()
+        Cart.objects.filter(pk=cart.pk).recalculate_totals()
+        invalidate_products(*(p.slug for p in products))
+        enqueue(send_order_confirmation, order.pk, key=f'order-confirmation:{order.pk}')
+    return order
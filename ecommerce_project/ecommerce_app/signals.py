@@ -0,0 +1,150 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from . import catalog_cache, imaging, search
+from .models import Cart, Category, Product, ProductFacet, ProductImage
+
+# Sent by bulk writers (bulk_create / bulk_update skip post_save) with the
+# affected Product instances. Updated instances still carry the values they
+# were loaded with.
+products_bulk_changed = Signal()
+
+
+def invalidate_products(*slugs):
+    slugs = [slug for slug in slugs if slug]
+    if not slugs:
+        return
+    catalog_cache.bump_product_versions(*slugs)
+    # Bump again once the write is visible, in case a concurrent reader
+    # re-cached the old row while the transaction was still open.
+    transaction.on_commit(lambda: catalog_cache.bump_product_versions(*slugs))
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_products(instance.slug, instance.loaded_value('slug'))
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def product_image_changed(sender, instance, **kwargs):
+    slug = Product.objects.filter(pk=instance.product_id).values_list('slug', flat=True).first()
+    invalidate_products(slug)
+
+
+@receiver(post_save, sender=ProductImage)
+def render_image_derivatives(sender, instance, created, **kwargs):
+    if created or instance.loaded_value('image') != instance.image.name:
+        imaging.schedule([instance.pk])
+
+
+@receiver(post_delete, sender=ProductImage)
+def delete_image_derivatives(sender, instance, **kwargs):
+    derivatives = instance.derivatives
+    transaction.on_commit(lambda: imaging.delete_files(derivatives))
+
+
+@receiver(post_save, sender=Category)
+def category_changed(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_products(*instance.products.values_list('slug', flat=True))
+
+
+@receiver(post_save, sender=Product)
+def product_price_changed(sender, instance, created, **kwargs):
+    old_price = instance.loaded_value('price')
+    if not created and old_price is not None and old_price != instance.price:
+        Cart.objects.filter(items__product=instance).recalculate_totals()
+
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_holds(sender, instance, **kwargs):
+    # The cart's holds go with it via a cascade, which doesn't give their units back.
+    Product.objects.release_reserved(dict(instance.reservations.values_list('product_id', 'quantity')))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    # Cart items go with the product via a cascade that bypasses CartItem.delete().
+    instance._cart_ids = list(Cart.objects.filter(items__product=instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def product_removed_from_carts(sender, instance, **kwargs):
+    if getattr(instance, '_cart_ids', None):
+        Cart.objects.filter(pk__in=instance._cart_ids).recalculate_totals()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, created, **kwargs):
+    if not created:
+        search.reindex_category(instance)
+
+
+FACET_COLUMNS = ('category_id', 'price', 'old_price', 'stock')
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_facet(sender, instance, update_fields=None, **kwargs):
+    # A partial or hand-built instance can't tell which facet it is counted
+    # in, so read that off the row before the save overwrites it, and work out
+    # the new facet from it and the columns being written (a deferred field
+    # would otherwise be loaded with a query of its own).
+    if instance.pk is None or instance.loaded_facet_key() is not None:
+        return
+    old = Product.objects.filter(pk=instance.pk).order_by().values(*FACET_COLUMNS).first()
+    if old is None:
+        return
+    deferred = instance.get_deferred_fields()
+    new = dict(old)
+    for column in FACET_COLUMNS:
+        field = Product._meta.get_field(column.removesuffix('_id'))
+        if column not in deferred and (update_fields is None or field.name in update_fields):
+            new[column] = getattr(instance, column)
+    instance._facet_keys = (instance.facet_key(old), instance.facet_key(new))
+
+
+@receiver(post_save, sender=Product)
+def update_product_facets(sender, instance, created, **kwargs):
+    keys = instance.__dict__.pop('_facet_keys', None)
+    if created:
+        ProductFacet.adjust(instance.facet_key(), 1)
+    else:
+        ProductFacet.move(*(keys or (instance.loaded_facet_key(), instance.facet_key())))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_facet(sender, instance, **kwargs):
+    ProductFacet.adjust(instance.loaded_facet_key() or instance.facet_key(), -1)
+
+
+@receiver(products_bulk_changed, sender=Product)
+def bulk_products_changed(sender, instances, created, **kwargs):
+    search.index_products([product.pk for product in instances])
+    deltas = Counter()
+    for product in instances:
+        deltas[product.facet_key()] += 1
+        if not created:
+            deltas[product.loaded_facet_key()] -= 1
+    for key, delta in deltas.items():
+        if key is not None and delta:
+            ProductFacet.adjust(key, delta)
+    if created:
+        catalog_cache.bump_catalog_version()
+        return
+    invalidate_products(*(product.slug for product in instances))
+    repriced = [product.pk for product in instances if product.loaded_value('price') != product.price]
+    if repriced:
+        Cart.objects.filter(items__product__in=repriced).recalculate_totals()
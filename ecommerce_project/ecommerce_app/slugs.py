@@ -0,0 +1,117 @@
+"""
+Unique slug allocation without probing one candidate at a time.
+
+A slug is either the slugified base or ``<base>-<n>``. The next free slug for
+a base is found with a single query, a range scan of the slug index for the
+base and its suffixed forms, and a whole batch of unsaved instances can be
+given slugs with one query per few hundred distinct bases, so bulk imports
+can go straight to bulk_create().
+"""
+import re
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils.text import slugify
+
+# Room left after the base for "-<n>".
+SUFFIX_RESERVE = 10
+QUERY_CHUNK = 200
+SAVE_ATTEMPTS = 5
+
+
+def slug_base(model, text, field='slug'):
+    max_length = model._meta.get_field(field).max_length
+    base = slugify(text) or model._meta.model_name
+    return base[:max_length - SUFFIX_RESERVE].rstrip('-')
+
+
+def _suffix(slug, base):
+    if slug == base:
+        return 0
+    match = re.fullmatch(rf'{re.escape(base)}-([1-9][0-9]*)', slug)
+    return int(match.group(1)) if match else None
+
+
+def _prefixed(field, prefix):
+    """Rows whose `field` starts with `prefix`, as a range of its unique index."""
+    if connection.vendor == 'sqlite':
+        # SQLite's LIKE is case-insensitive so it can't use the index, but
+        # BINARY collation orders by code point, so a range can.
+        return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+    # PostgreSQL gives slug columns a varchar_pattern_ops index for LIKE.
+    return Q(**{f'{field}__startswith': prefix})
+
+
+def _taken(model, bases, field):
+    condition = reduce(or_, (Q(**{field: base}) | _prefixed(field, f'{base}-') for base in bases))
+    return model._default_manager.filter(condition).order_by().values_list(field, flat=True).iterator()
+
+
+def unique_slug(model, text, field='slug'):
+    base = slug_base(model, text, field)
+    suffixes = [_suffix(slug, base) for slug in _taken(model, [base], field)]
+    highest = max((n for n in suffixes if n is not None), default=None)
+    return base if highest is None else f'{base}-{highest + 1}'
+
+
+def allocate_slugs(instances, source, field='slug'):
+    """
+    Fill in the slug of every instance that lacks one, unique against the
+    database and within the batch. Instances are not saved.
+    """
+    instances = list(instances)
+    if not instances:
+        return instances
+    model = type(instances[0])
+    pending = [obj for obj in instances if not getattr(obj, field)]
+    bases = {id(obj): slug_base(model, getattr(obj, source), field) for obj in pending}
+
+    highest = {}
+    distinct = sorted(set(bases.values()))
+    wanted = set(distinct)
+
+    def claim(slug):
+        head, _, tail = slug.rpartition('-')
+        for base in (slug, head):
+            n = _suffix(slug, base) if base in wanted else None
+            if n is not None and n > highest.get(base, -1):
+                highest[base] = n
+
+    for start in range(0, len(distinct), QUERY_CHUNK):
+        for slug in _taken(model, distinct[start:start + QUERY_CHUNK], field):
+            claim(slug)
+    for obj in instances:
+        if getattr(obj, field):
+            claim(getattr(obj, field))
+
+    for obj in pending:
+        base = bases[id(obj)]
+        n = highest.get(base, -1) + 1
+        highest[base] = n
+        setattr(obj, field, f'{base}-{n}' if n else base)
+    return instances
+
+
+def save_with_unique_slug(instance, source, save, *args, field='slug', **kwargs):
+    """
+    Run ``save(*args, **kwargs)``, generating the slug first if it's blank.
+    A concurrent writer can take the same slug between the lookup and the
+    insert; the unique constraint catches that and a fresh slug is tried.
+    """
+    if getattr(instance, field):
+        return save(*args, **kwargs)
+    model = type(instance)
+    for attempt in range(SAVE_ATTEMPTS):
+        slug = unique_slug(model, getattr(instance, source), field)
+        setattr(instance, field, slug)
+        try:
+            with transaction.atomic():
+                return save(*args, **kwargs)
+        except IntegrityError:
+            setattr(instance, field, '')
+            # Only retry when it was the slug that collided.
+            taken = model._default_manager.filter(**{field: slug}).exists()
+            if not taken or attempt == SAVE_ATTEMPTS - 1:
+                raise
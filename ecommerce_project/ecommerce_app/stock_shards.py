@@ -0,0 +1,153 @@
+"""
+Sharded stock counters for hot products.
+
+A checkout decrements Product.stock with a conditional UPDATE, so every
+checkout of one product queues on that row. A sharded product keeps its
+stock in `shard_count` StockShard rows instead: take() decrements a random
+shard, so concurrent checkouts mostly hit different rows, and only falls
+back to locking all shards when no single shard can cover the quantity.
+
+Product.stock stays a mirror of the shard total for listings, facets and
+holds. sync() refreshes it; checkouts schedule that through the task queue,
+at most once per STOCK_SHARD_SYNC_SECONDS per product, at the end of that
+window. Shards can't go below zero, so a stale mirror never oversells.
+"""
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, Sum, When
+from django.utils import timezone
+
+from .models import Product, ProductFacet, StockShard
+from .signals import invalidate_products
+
+
+def _level_key(product_id):
+    return f'stock-shards:{product_id}'
+
+
+def split(total, shards):
+    """Spread total over shards as evenly as possible."""
+    base, extra = divmod(total, shards)
+    return [base + (index < extra) for index in range(shards)]
+
+
+def levels(products):
+    """{product pk: current stock}, summing shards (cached briefly) for sharded products."""
+    result = {product.pk: product.stock for product in products if not product.shard_count}
+    sharded = [product.pk for product in products if product.shard_count]
+    if sharded:
+        keys = {_level_key(pk): pk for pk in sharded}
+        cached = cache.get_many(keys)
+        result.update((keys[key], value) for key, value in cached.items())
+        missing = [pk for key, pk in keys.items() if key not in cached]
+        if missing:
+            totals = dict.fromkeys(missing, 0)
+            totals.update(
+                StockShard.objects.filter(product_id__in=missing).order_by()
+                .values_list('product_id').annotate(total=Sum('stock'))
+            )
+            cache.set_many({_level_key(pk): total for pk, total in totals.items()},
+                           settings.STOCK_SHARD_CACHE_SECONDS)
+            result.update(totals)
+    return result
+
+
+def level(product):
+    return levels([product])[product.pk]
+
+
+def reshard(product, shards, stock=None):
+    """
+    Move product's stock (or `stock`, if given) into `shards` shards, or
+    back into Product.stock when shards is 0.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product.pk)
+        if stock is None:
+            stock = _total(product.pk) if product.shard_count else product.stock
+        StockShard.objects.filter(product=product).delete()
+        if shards:
+            StockShard.objects.bulk_create(
+                StockShard(product=product, index=index, stock=amount)
+                for index, amount in enumerate(split(stock, shards))
+            )
+        _set_mirror(product, stock, shard_count=shards)
+        transaction.on_commit(lambda: cache.delete(_level_key(product.pk)))
+    return product
+
+
+def set_stock(product, stock):
+    """Set a product's stock, whether or not it is sharded."""
+    return reshard(product, product.shard_count, stock)
+
+
+def take(product_id, quantity, shards):
+    """
+    Decrement a sharded product's stock by quantity; False if there isn't
+    enough. Call inside a transaction.
+    """
+    # Usually one UPDATE on a random shard, which concurrent checkouts are
+    # unlikely to be touching too.
+    index = random.randrange(shards)
+    if StockShard.objects.filter(product_id=product_id, index=index, stock__gte=quantity).update(
+        stock=F('stock') - quantity,
+    ):
+        transaction.on_commit(lambda: cache.delete(_level_key(product_id)))
+        return True
+    # No single shard we tried has enough: lock them all (in index order, so
+    # concurrent fallbacks queue rather than deadlock) and drain in turn.
+    rows = list(
+        StockShard.objects.select_for_update().filter(product_id=product_id)
+        .order_by('index').values_list('pk', 'stock')
+    )
+    if sum(stock for _, stock in rows) < quantity:
+        return False
+    remaining, drained = quantity, {}
+    for pk, stock in rows:
+        if remaining and stock:
+            drained[pk] = min(stock, remaining)
+            remaining -= drained[pk]
+    StockShard.objects.filter(pk__in=drained).update(
+        stock=Case(*(When(pk=pk, then=F('stock') - amount) for pk, amount in drained.items()))
+    )
+    transaction.on_commit(lambda: cache.delete(_level_key(product_id)))
+    return True
+
+
+def sync_schedule(product_id):
+    """
+    (idempotency key, delay) for the mirror refresh of product_id covering the
+    current window. It runs once the window has ended, so it sees every
+    checkout that was deduplicated into it.
+    """
+    now = time.time()
+    window = int(now // settings.STOCK_SHARD_SYNC_SECONDS)
+    delay = (window + 1) * settings.STOCK_SHARD_SYNC_SECONDS - now
+    return f'stock-shards-sync:{product_id}:{window}', timedelta(seconds=delay)
+
+
+def sync(product_id):
+    """Refresh Product.stock (and its facet) from the shard total."""
+    with transaction.atomic():
+        product = Product.objects.select_for_update().filter(pk=product_id, shard_count__gt=0).first()
+        if product is not None and product.stock != (total := _total(product_id)):
+            _set_mirror(product, total)
+
+
+def _total(product_id):
+    return StockShard.objects.filter(product_id=product_id).aggregate(total=Sum('stock'))['total'] or 0
+
+
+def _set_mirror(product, stock, **fields):
+    old_key = product.facet_key()
+    product.stock = stock
+    for name, value in fields.items():
+        setattr(product, name, value)
+    Product.objects.filter(pk=product.pk).update(stock=stock, updated_at=timezone.now(), **fields)
+    ProductFacet.move(old_key, product.facet_key())
+    invalidate_products(product.slug)
@@ -0,0 +1,180 @@
+"""
+Database-backed background tasks.
+
+enqueue() writes a Task row inside the caller's transaction, so a task exists
+exactly when the work that scheduled it committed. `manage.py run_tasks`
+claims due rows and runs them on a thread pool. Claiming uses SELECT ... FOR
+UPDATE SKIP LOCKED where the database has it, and otherwise a conditional
+UPDATE per row, so several workers can share a queue on SQLite too.
+
+Delivery is at-least-once: a task whose worker dies is picked up again once
+its lease runs out, so task functions must be safe to run twice.
+"""
+import os
+import random
+import socket
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from .models import Task
+
+_registry = {}
+
+
+def task(name=None, max_attempts=5):
+    """Register a function as a task: @task() def send_receipt(order_id): ..."""
+    def decorator(func):
+        func.task_name = name or f'{func.__module__}.{func.__qualname__}'
+        func.max_attempts = max_attempts
+        _registry[func.task_name] = func
+        return func
+    return decorator
+
+
+def enqueue(func, *args, key=None, delay=None, **kwargs):
+    """
+    Schedule func(*args, **kwargs). Arguments must be JSON serializable. A
+    task with the same idempotency `key` as an existing one is dropped.
+    """
+    new = Task(
+        name=func.task_name,
+        args=list(args),
+        kwargs=kwargs,
+        idempotency_key=key,
+        max_attempts=func.max_attempts,
+        run_at=timezone.now() + (delay or timedelta()),
+    )
+    if key:
+        # One INSERT that the unique key turns into a no-op for duplicates.
+        Task.objects.bulk_create([new], ignore_conflicts=True)
+    else:
+        new.save()
+    if settings.TASKS_EAGER:
+        transaction.on_commit(drain)
+    return new
+
+
+def drain(worker_name='inline'):
+    """Run every due task in this thread; what TASKS_EAGER does after each commit."""
+    while claimed := claim(worker_name, 1):
+        execute(claimed[0])
+
+
+def claim(worker_name, limit):
+    now = timezone.now()
+    lease = timedelta(seconds=settings.TASK_LEASE_SECONDS)
+    due = Task.objects.due(now, lease).order_by('run_at', 'pk')
+    claimed = dict(status=Task.RUNNING, locked_by=worker_name, locked_at=now, started_at=now,
+                   attempts=F('attempts') + 1)
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            pks = list(due.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            Task.objects.filter(pk__in=pks).update(**claimed)
+    else:
+        # No row locks to skip past: each candidate is claimed by an UPDATE
+        # that re-checks it is still due, so of two racing workers exactly
+        # one gets a row count of 1.
+        pks = [
+            pk for pk in due.values_list('pk', flat=True)[:limit]
+            if Task.objects.due(now, lease).filter(pk=pk).update(**claimed)
+        ]
+    return list(Task.objects.filter(pk__in=pks, locked_by=worker_name, locked_at=now))
+
+
+def backoff(attempts):
+    base, cap = settings.TASK_RETRY_BACKOFF
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), cap) * random.uniform(0.5, 1.0))
+
+
+def execute(claimed):
+    mine = Task.objects.filter(pk=claimed.pk, locked_by=claimed.locked_by, locked_at=claimed.locked_at)
+    func = _registry.get(claimed.name)
+    try:
+        if func is None:
+            raise LookupError(f"No task registered as {claimed.name!r}")
+        func(*claimed.args, **claimed.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        now = timezone.now()
+        if claimed.attempts >= claimed.max_attempts:
+            mine.update(status=Task.FAILED, last_error=error, finished_at=now)
+        else:
+            mine.update(status=Task.QUEUED, last_error=error, locked_by='', locked_at=None,
+                        run_at=now + backoff(claimed.attempts))
+        return False
+    mine.update(status=Task.DONE, finished_at=timezone.now(), last_error='')
+    return True
+
+
+class Worker:
+    def __init__(self, workers=None, poll_interval=None, name=None):
+        self.workers = workers or settings.TASK_WORKERS
+        self.poll_interval = settings.TASK_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+        self.processed = 0
+        self.failed = 0
+
+    def _execute(self, claimed):
+        close_old_connections()
+        try:
+            return execute(claimed)
+        finally:
+            close_old_connections()
+
+    def run(self, burst=False, stop=None):
+        """Claim and run tasks until `stop` is set, or, with burst, until nothing is due."""
+        stop = stop or threading.Event()
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tasks') as pool:
+            while not stop.is_set():
+                free = self.workers - len(running)
+                claimed = claim(self.name, free) if free else []
+                running.update(pool.submit(self._execute, t) for t in claimed)
+                if not running:
+                    if burst:
+                        break
+                    stop.wait(self.poll_interval)
+                    continue
+                # Back to claiming as soon as a slot frees up, or after a poll
+                # interval if the pool had room but nothing was due.
+                done, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                self._record(done)
+            self._record(wait(running).done)
+
+    def _record(self, futures):
+        for future in futures:
+            self.processed += 1
+            self.failed += not future.result()
+
+
+def stats(window=timedelta(hours=1)):
+    """Queue depth and latency, for dashboards and alerting."""
+    now = timezone.now()
+    depth = dict(Task.objects.order_by().values_list('status').annotate(Count('pk')))
+    due = Task.objects.filter(status=Task.QUEUED, run_at__lte=now)
+    oldest = due.aggregate(oldest=Min('run_at'))['oldest']
+    recent = list(
+        Task.objects.filter(status=Task.DONE, finished_at__gte=now - window)
+        .order_by('-finished_at').values_list('run_at', 'started_at', 'finished_at')[:1000]
+    )
+
+    def mean(values):
+        values = list(values)
+        return sum(values) / len(values) if values else None
+
+    return {
+        'depth': {status: depth.get(status, 0) for status, _ in Task.STATUS_CHOICES},
+        'due': due.count(),
+        'oldest_due_seconds': (now - oldest).total_seconds() if oldest else 0,
+        'avg_wait_seconds': mean((started - run_at).total_seconds() for run_at, started, _ in recent),
+        'avg_run_seconds': mean((finished - started).total_seconds() for _, started, finished in recent),
+        'done_recently': len(recent),
+    }
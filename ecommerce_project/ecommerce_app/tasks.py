@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.mail import send_mail
+
+from . import stock_shards
+from .models import Order
+from .taskqueue import task
+
+
+@task()
+def send_order_confirmation(order_id):
+    order = Order.objects.select_related('user').filter(pk=order_id).first()
+    if order is None or not order.user.email:
+        return
+    lines = [
+        f"{item.quantity} x {item.product.title} @ {item.price}"
+        for item in order.items.select_related('product').order_by('pk')
+    ]
+    send_mail(
+        subject=f"Order #{order.pk} confirmed",
+        message="\n".join([f"Thanks for your order, {order.user.get_username()}.", "", *lines, "",
+                           f"Total: {order.total}"]),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        recipient_list=[order.user.email],
+    )
+
+
+@task()
+def sync_stock_shards(product_id):
+    stock_shards.sync(product_id)
@@ -0,0 +1,42 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+register = template.Library()
+
+PLACEHOLDER = 'https://via.placeholder.com/{}'
+PLACEHOLDER_SIZES = {'thumb': 160, 'card': 300, 'detail': 500}
+
+
+def _sources(image, size):
+    """(webp url, jpeg url, width, height, blurhash, original url) for a model instance or serialized dict."""
+    if isinstance(image, dict):
+        entry = image.get('derivatives', {}).get(size, {})
+        return entry.get('webp'), entry.get('jpeg'), entry.get('width'), entry.get('height'), \
+            image.get('blurhash', ''), image.get('image')
+    entry = image.derivatives.get(size, {})
+    webp, jpeg = (default_storage.url(entry[fmt]) if entry.get(fmt) else None for fmt in ('webp', 'jpeg'))
+    return webp, jpeg, entry.get('width'), entry.get('height'), image.blurhash, image.image.url
+
+
+@register.simple_tag
+def product_image(image, size='card', css_class='', alt=''):
+    """
+    Render a <picture> with the WebP and JPEG derivative of the given size,
+    falling back to the original upload until the derivatives exist.
+    """
+    if not image:
+        return format_html('<img src="{}" class="{}" alt="{}">',
+                           PLACEHOLDER.format(PLACEHOLDER_SIZES.get(size, 300)), css_class, alt)
+    webp, jpeg, width, height, blurhash, original = _sources(image, size)
+    # The detail image is the page's main content; don't defer it.
+    loading = 'eager' if size == 'detail' else 'lazy'
+    if not jpeg:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="{}" decoding="async">',
+                           original, css_class, alt, loading)
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}">'
+        '<img src="{}" width="{}" height="{}" class="{}" alt="{}" loading="{}" decoding="async"'
+        ' data-blurhash="{}"></picture>',
+        webp, jpeg, width, height, css_class, alt, loading, blurhash,
+    )
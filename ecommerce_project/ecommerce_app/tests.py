@@ -1,3 +1,1720 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from functools import reduce
+from io import BytesIO, StringIO
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection
+from django.db.models import F, Q
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+from PIL import Image
+from rest_framework import generics
+
+from ecommerce_project import db_profiles
+
+from . import catalog_io, imaging, index_advisor, metrics, page_cache, routers, search, slugs, stock_shards, taskqueue
+from .catalog_cache import get_product_json, product_version
+from .management.commands import sync_replicas
+from .models import (
+    Address, Cart, CartItem, Category, Order, OrderItem, PaymentRecord, Product, ProductFacet, ProductImage,
+    StockReservation, StockShard, Task, Wishlist,
+)
+from .pagination import encode_cursor, keyset_filter
+from .serializers import CategorySerializer, ProductFilterSerializer, ProductSerializer
+from .services import InsufficientStock, place_order, release_expired_reservations, update_cart
+from .views import ConditionalGetMixin
+
+User = get_user_model()
+
+
+def make_products(category, count, images_per_product=2):
+    products = Product.objects.bulk_create(
+        Product(category=category, title=f'Product {i}', slug=f'{category.slug}-product-{i}', price=100 + i, stock=10)
+        for i in range(count)
+    )
+    ProductImage.objects.bulk_create(
+        ProductImage(product=product, image=f'products/{product.slug}-{n}.png')
+        for product in products
+        for n in range(images_per_product)
+    )
+    return products
+
+
+@override_settings(PAGE_CACHE_VIEWS=[])
+class StoreHomeQueryTests(TestCase):
+    def test_query_count_does_not_grow_with_catalog(self):
+        # paginator count + product page + primary image prefetch
+        make_products(Category.objects.create(name='Small'), 3)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('store-home'))
+        self.assertEqual(len(response.context['products']), 3)
+
+        make_products(Category.objects.create(name='Large'), 60)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('store-home'))
+        self.assertEqual(len(response.context['products']), 24)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('store-home'), {'page': 2})
+
+    def test_cards_use_primary_image(self):
+        product = make_products(Category.objects.create(name='Cameras'), 1)[0]
+        response = self.client.get(reverse('store-home'))
+        self.assertContains(response, f'/media/products/{product.slug}-0.png')
+        self.assertNotContains(response, f'/media/products/{product.slug}-1.png')
+
+
+class ProductListTests(TestCase):
+    def setUp(self):
+        self.products = make_products(Category.objects.create(name='Pens'), 5, images_per_product=0)
+        # Equal sort keys: the id breaks the ties.
+        Product.objects.update(created_at=timezone.now())
+        Product.objects.filter(pk__in=[self.products[1].pk, self.products[3].pk]).update(price=500)
+
+    def pages(self, **params):
+        ids, url = [], reverse('product-list') + '?' + urlencode(params)
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [product['id'] for product in response.json()['results']]
+            url = response.json()['next']
+        return ids
+
+    def test_cursor_pages_through_every_product_once(self):
+        pks = [p.pk for p in self.products]
+        self.assertEqual(self.pages(page_size=2), pks)
+        self.assertEqual(self.pages(page_size=2, sort='-price'), [pks[1], pks[3], pks[4], pks[2], pks[0]])
+        self.assertEqual(self.pages(page_size=1, sort='price', fields='id'), [pks[0], pks[2], pks[4], pks[1], pks[3]])
+
+    def test_first_link(self):
+        data = self.client.get(reverse('product-list'), {'page_size': 2}).json()
+        self.assertIsNone(data['first'])
+        data = self.client.get(data['next']).json()
+        self.assertNotIn('cursor=', data['first'])
+
+    def test_invalid_cursor(self):
+        for cursor in ('not-base64!', encode_cursor(['2024-01-01']), encode_cursor(['yesterday', 1])):
+            response = self.client.get(reverse('product-list'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.json(), {'detail': 'Invalid cursor.'})
+        response = self.client.get(reverse('product-search'), {'q': 'product', 'cursor': 'not-base64!'})
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(connection.vendor == 'sqlite', "reads SQLite query plans")
+    def test_later_pages_seek_into_the_ordering_index(self):
+        last = Product.objects.order_by('pk').last()
+        for sort, index in (('newest', 'product_created_idx'), ('price', 'product_price_idx'),
+                            ('-price', 'product_price_idx')):
+            ordering = ProductFilterSerializer.SORTS[sort]
+            values = [getattr(last, field.lstrip('-')) for field in ordering]
+            plan = Product.objects.order_by(*ordering).filter(keyset_filter(ordering, values))[:25].explain()
+            with self.subTest(sort=sort):
+                # A range starting at the cursor, not a walk from the first row.
+                self.assertRegex(plan, rf'SEARCH \S+ USING INDEX {index} \(\w+[<>]\?\)')
+                # At most the ties on the leading column are sorted.
+                self.assertNotIn('B-TREE FOR ORDER BY', plan)
+
+    def test_fields_projection(self):
+        results = self.client.get(reverse('product-list'), {'fields': 'id,title,bogus'}).json()['results']
+        self.assertEqual(set(results[0]), {'id', 'title'})
+        results = self.client.get(reverse('product-list'), {'fields': 'bogus'}).json()['results']
+        self.assertEqual(set(results[0]), set(ProductSerializer.Meta.fields))
+        results = self.client.get(reverse('product-list'), {'fields': 'category,images'}).json()['results']
+        self.assertEqual(results[0], {'category': 'Pens', 'images': []})
+
+
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        self.lamps = Category.objects.create(name='Lamps')
+        self.books = Category.objects.create(name='Books')
+        # Priced 100.. and 600..; make_products skips the signals, so count them.
+        self.cheap = make_products(self.lamps, 3, images_per_product=0)
+        self.dear = make_products(self.books, 2, images_per_product=0)
+        Product.objects.filter(category=self.books).update(price=F('price') + 500, old_price=F('price') + 600)
+        ProductFacet.rebuild()
+
+    def assert_counts_match_a_rebuild(self):
+        rows = lambda: set(ProductFacet.objects.filter(count__gt=0).values_list(
+            'category', 'price_bucket', 'in_stock', 'on_sale', 'count'))
+        counted = rows()
+        ProductFacet.rebuild()
+        self.assertEqual(counted, rows())
+
+    def test_saves_and_deletes_move_counts(self):
+        product = Product.objects.get(pk=self.cheap[0].pk)
+        product.price = 3000
+        product.stock = 0
+        product.save()
+        self.assert_counts_match_a_rebuild()
+        product.category = self.books
+        product.old_price = 4000
+        product.save()
+        self.assert_counts_match_a_rebuild()
+        Product.objects.create(category=self.lamps, title='New lamp', price=50, stock=1)
+        self.assert_counts_match_a_rebuild()
+        product.delete()
+        self.assert_counts_match_a_rebuild()
+
+    def test_partial_and_hand_built_instances(self):
+        product = Product.objects.only('id', 'price').get(pk=self.cheap[1].pk)
+        product.price = 700
+        with mock.patch.object(ProductFacet, 'rebuild') as rebuild:
+            product.save()
+            original = Product.objects.get(pk=self.dear[0].pk)
+            Product(pk=original.pk, category=self.lamps, title=original.title, slug=original.slug,
+                    price=20, stock=0, created_at=original.created_at).save()
+        rebuild.assert_not_called()
+        # Nor were the deferred columns loaded one query at a time.
+        self.assertEqual(product.get_deferred_fields(), {
+            f.attname for f in Product._meta.concrete_fields if f.attname not in ('id', 'price', 'slug')
+        })
+        self.assert_counts_match_a_rebuild()
+
+    def test_listing_filters_and_facets(self):
+        url = reverse('product-list')
+        ids = lambda **params: sorted(p['id'] for p in self.client.get(url, params).data['results'])
+        self.assertEqual(ids(category='books'), sorted(p.pk for p in self.dear))
+        self.assertEqual(ids(min_price=600), sorted(p.pk for p in self.dear))
+        self.assertEqual(ids(max_price=101), [p.pk for p in self.cheap[:2]])
+        self.assertEqual(ids(on_sale=True), sorted(p.pk for p in self.dear))
+        Product.objects.filter(pk=self.cheap[0].pk).update(stock=0)
+        self.assertEqual(ids(in_stock=True, category='lamps'), [p.pk for p in self.cheap[1:]])
+        self.assertEqual(self.client.get(url, {'sort': 'cheapest'}).status_code, 400)
+
+        facets = self.client.get(url, {'category': 'books'}).data['facets']
+        self.assertEqual(facets['categories'], [
+            {'slug': 'books', 'name': 'Books', 'count': 2},
+            {'slug': 'lamps', 'name': 'Lamps', 'count': 3},
+        ])
+        self.assertEqual(facets['price'], [{'min': 500, 'max': 1000, 'count': 2}])
+        facets = self.client.get(url, {'max_price': 400}).data['facets']
+        self.assertEqual(facets['categories'], [{'slug': 'lamps', 'name': 'Lamps', 'count': 3}])
+
+
+class ProductCacheTests(TestCase):
+    def setUp(self):
+        caches[settings.PRODUCT_CACHE_ALIAS].clear()
+        self.category = Category.objects.create(name='Mugs')
+        self.product = make_products(self.category, 1, images_per_product=1)[0]
+
+    def cached(self):
+        return json.loads(get_product_json(self.product.slug))
+
+    def test_payload_is_served_from_the_cache(self):
+        body = get_product_json(self.product.slug)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_product_json(self.product.slug), body)
+        self.assertEqual(self.client.get(reverse('product-detail', args=[self.product.slug])).content, body)
+        self.assertIsNone(get_product_json('no-such-product'))
+
+    def test_changes_invalidate_the_payload(self):
+        self.cached()
+        self.product.title = 'Big mug'
+        self.product.save()
+        self.assertEqual(self.cached()['title'], 'Big mug')
+
+        image = ProductImage.objects.create(product=self.product, image='products/extra.png')
+        self.assertEqual(len(self.cached()['images']), 2)
+        image.delete()
+        self.assertEqual(len(self.cached()['images']), 1)
+
+        self.category.name = 'Cups'
+        self.category.save()
+        self.assertEqual(self.cached()['category'], 'Cups')
+
+        Product.objects.filter(pk=self.product.pk).update(title='Unseen')
+        self.assertEqual(self.cached()['title'], 'Big mug')
+
+    def test_image_urls_match_across_endpoints(self):
+        image = self.product.images.get()
+        detail = self.client.get(reverse('product-detail', args=[self.product.slug])).json()
+        listed = self.client.get(reverse('product-list')).json()['results'][0]
+        self.assertEqual(detail['images'][0]['image'], image.image.url)
+        self.assertTrue(image.image.url.startswith(settings.MEDIA_URL))
+        self.assertEqual(listed['images'], detail['images'])
+
+
+class SlugTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Lamps')
+
+    def product(self, title, slug=''):
+        return Product.objects.create(category=self.category, title=title, slug=slug, price=100, stock=1)
+
+    def test_collisions_take_the_next_suffix(self):
+        self.assertEqual(self.product('Desk lamp').slug, 'desk-lamp')
+        self.assertEqual(self.product('Desk Lamp!').slug, 'desk-lamp-1')
+        self.product('Desk lamp', slug='desk-lamp-9')
+        self.product('Desk lamp', slug='desk-lamp-x')
+        self.product('Desk lamps')
+        self.assertEqual(self.product('Desk lamp').slug, 'desk-lamp-10')
+        self.assertEqual(slugs.unique_slug(Product, 'Desk lamps'), 'desk-lamps-1')
+        self.assertEqual(slugs.unique_slug(Product, 'Floor lamp'), 'floor-lamp')
+        self.assertEqual(Category.objects.create(name='Lamps!').slug, 'lamps-1')
+
+    def test_allocate_slugs_is_unique_against_the_table_and_the_batch(self):
+        self.product('Desk lamp')
+        batch = [
+            Product(category=self.category, title=title, slug=slug, price=100, stock=1)
+            for title, slug in [
+                ('Desk lamp', ''), ('Desk lamp', ''), ('Floor lamp', ''), ('Floor lamp', 'floor-lamp-4'),
+                ('Floor lamp', ''),
+            ]
+        ]
+        with self.assertNumQueries(1):
+            slugs.allocate_slugs(batch, 'title')
+        self.assertEqual(
+            [product.slug for product in batch],
+            ['desk-lamp-1', 'desk-lamp-2', 'floor-lamp-5', 'floor-lamp-4', 'floor-lamp-6'],
+        )
+        Product.objects.bulk_create(batch)
+        self.assertEqual(slugs.allocate_slugs([], 'title'), [])
+
+    def test_save_retries_when_the_slug_is_taken_concurrently(self):
+        self.product('Desk lamp')
+        # The first lookup returns a slug another writer has just taken.
+        with mock.patch.object(slugs, 'unique_slug', side_effect=['desk-lamp', 'desk-lamp-1']) as lookup:
+            product = self.product('Desk lamp')
+        self.assertEqual(lookup.call_count, 2)
+        self.assertEqual(product.slug, 'desk-lamp-1')
+
+        with mock.patch.object(slugs, 'unique_slug', return_value='desk-lamp'), self.assertRaises(IntegrityError):
+            self.product('Desk lamp')
+
+    def test_other_integrity_errors_are_not_retried(self):
+        category = Category(name='Lamps')
+        with mock.patch.object(slugs, 'unique_slug', wraps=slugs.unique_slug) as lookup, \
+                self.assertRaises(IntegrityError):
+            category.save()
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(category.slug, '')
+
+
+class CatalogImportExportTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = Path(directory.name)
+
+    def write(self, name, text):
+        path = self.dir / name
+        path.write_text(text, encoding='utf-8')
+        return str(path)
+
+    def run_command(self, name, *args, **options):
+        out, err = StringIO(), StringIO()
+        call_command(name, *args, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_creates_then_updates_by_slug(self):
+        path = self.write('products.csv', (
+            'slug,title,category,price,old_price,description,stock,images\n'
+            'desk-lamp,Desk lamp,Lamps,20.00,25.00,Bright,5,products/a.png|products/b.png\n'
+            ',Floor lamp,Lamps,40.00,,,2,\n'
+            ',Mug,Kitchen,5.00,,,0,\n'
+        ))
+        out, err = self.run_command('import_catalog', path, batch_size=2)
+        self.assertIn('3 created, 0 updated, 0 unchanged, 2 images, 2 new categories, 0 skipped', out)
+        self.assertEqual(err, '')
+        lamp = Product.objects.get(slug='desk-lamp')
+        self.assertEqual((lamp.category.name, lamp.price, lamp.old_price, lamp.stock), ('Lamps', 20, 25, 5))
+        self.assertEqual([image.image.name for image in lamp.images.order_by('pk')], ['products/a.png', 'products/b.png'])
+        self.assertEqual(Product.objects.get(title='Floor lamp').slug, 'floor-lamp')
+        self.assertIsNone(Product.objects.get(title='Floor lamp').old_price)
+
+        path = self.write('update.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'slug': 'desk-lamp', 'title': 'Desk lamp', 'category': 'Lamps', 'price': '18.00', 'stock': 5,
+             'old_price': '25.00', 'description': 'Bright', 'images': ['products/a.png', 'products/b.png']},
+            {'slug': 'floor-lamp', 'title': 'Floor lamp', 'category': 'Lamps', 'price': '40.00', 'stock': 2},
+        ]))
+        out, _ = self.run_command('import_catalog', path)
+        self.assertIn('0 created, 1 updated, 1 unchanged, 0 images, 0 new categories', out)
+        self.assertEqual(Product.objects.get(slug='desk-lamp').price, 18)
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_import_from_stdin_leaves_it_open(self):
+        stdin = StringIO('title,category,price\nDesk lamp,Lamps,20.00\n')
+        with mock.patch('sys.stdin', stdin):
+            out, _ = self.run_command('import_catalog', '-')
+        self.assertIn('1 created', out)
+        self.assertFalse(stdin.closed)
+
+    def test_invalid_rows_and_malformed_lines_are_reported(self):
+        path = self.write('products.jsonl', '\n'.join([
+            json.dumps({'title': 'Desk lamp', 'category': 'Lamps', 'price': '20.00'}),
+            '{"title": "Broken", "category": ',
+            '',
+            json.dumps({'title': 'Free lamp', 'category': 'Lamps', 'price': '-1'}),
+            json.dumps({'title': 'Floor lamp', 'category': 'Lamps', 'price': '40.00'}),
+        ]))
+        out, err = self.run_command('import_catalog', path)
+        self.assertIn('2 created', out)
+        self.assertIn('2 skipped', out)
+        lines = err.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('line 2: Invalid JSON:'))
+        self.assertTrue(lines[1].startswith('line 4: ') and 'price' in lines[1])
+
+        errors = []
+        rows = list(catalog_io.read_rows(StringIO('{"a": 1}\nnot json\n'), 'jsonl', errors))
+        self.assertEqual(rows, [(1, {'a': 1})])
+        self.assertEqual([number for number, _ in errors], [2])
+
+    def test_export_round_trips_through_import(self):
+        lamps = Category.objects.create(name='Lamps')
+        make_products(lamps, 3, images_per_product=2)
+        Product.objects.filter(title='Product 1').update(old_price=150)
+        for fmt in ('csv', 'jsonl'):
+            with self.subTest(fmt=fmt):
+                path = str(self.dir / f'export.{fmt}')
+                _, err = self.run_command('export_catalog', path)
+                self.assertEqual(err, '')
+                exported = list(catalog_io.export_rows())
+                self.assertEqual([row['slug'] for row in exported], [p.slug for p in Product.objects.order_by('pk')])
+                self.assertEqual(exported[1]['old_price'], '150.00')
+                self.assertEqual(len(exported[0]['images']), 2)
+
+                errors = []
+                with open(path, newline='', encoding='utf-8') as stream:
+                    read = [
+                        dict(row, price=str(row['price']), old_price=row['old_price'] and str(row['old_price']))
+                        for row in catalog_io.validate_rows(catalog_io.read_rows(stream, fmt, errors), errors)
+                    ]
+                self.assertEqual(errors, [])
+                self.assertEqual(read, exported)
+
+                out, _ = self.run_command('import_catalog', path)
+                self.assertIn('0 created, 0 updated, 3 unchanged', out)
+
+
+def png(size, color, mode='RGB', exif=None):
+    buffer = BytesIO()
+    Image.new(mode, size, color).save(buffer, 'PNG', exif=exif or Image.Exif())
+    return buffer.getvalue()
+
+
+class ImagingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.product = make_products(Category.objects.create(name='Lamps'), 1, images_per_product=0)[0]
+
+    @staticmethod
+    def base83(text):
+        return reduce(lambda value, char: value * 83 + imaging._BASE83.index(char), text, 0)
+
+    def test_blurhash(self):
+        placeholder = imaging.blurhash(Image.new('RGB', (32, 32), (255, 0, 0)))
+        # 4x3 components: the size flag, the AC maximum, the DC colour and 11 AC terms.
+        self.assertEqual(len(placeholder), 2 + 4 + 11 * 2)
+        self.assertEqual(self.base83(placeholder[0]), 3 + 2 * 9)
+        self.assertEqual(self.base83(placeholder[2:6]), 0xFF0000)
+        self.assertEqual(imaging.blurhash(Image.new('RGB', (8, 8), (0, 0, 255)), 1, 1), '00' + imaging._base83(0xFF, 4))
+
+        gradient = Image.linear_gradient('L').resize((32, 32))
+        self.assertNotEqual(imaging.blurhash(gradient)[6:], imaging.blurhash(Image.new('L', (32, 32), 128))[6:])
+
+    def test_render_fits_sizes_and_flattens(self):
+        with Image.open(BytesIO(png((2000, 1000), (0, 0, 0, 0), mode='RGBA'))) as source:
+            width, height, placeholder, rendered = imaging.render(source)
+        self.assertEqual((width, height), (2000, 1000))
+        self.assertEqual(len(placeholder), 28)
+        self.assertEqual({name: rendered[name][:2] for name in rendered}, {
+            'thumb': (160, 80), 'card': (480, 240), 'detail': (1200, 600),
+        })
+        files = rendered['thumb'][2]
+        self.assertTrue(files['webp'].startswith(b'RIFF'))
+        with Image.open(BytesIO(files['jpeg'])) as jpeg:
+            self.assertEqual(jpeg.format, 'JPEG')
+            self.assertFalse(jpeg.info.get('exif'))
+            # Transparency becomes white, not black.
+            self.assertGreater(min(jpeg.convert('RGB').getpixel((80, 40))), 240)
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees.
+        with Image.open(BytesIO(png((200, 100), (10, 20, 30), exif=exif))) as source:
+            width, height, _, rendered = imaging.render(source)
+        self.assertEqual((width, height), (100, 200))
+        # Never scaled up.
+        self.assertEqual(rendered['detail'][:2], (100, 200))
+
+    def test_uploads_are_rendered_by_a_queued_task(self):
+        image = ProductImage(product=self.product)
+        image.image.save('lamp.png', ContentFile(png((600, 300), (200, 100, 50))), save=False)
+        version = product_version(self.product.slug)
+        image.save()
+        task = Task.objects.get()
+        self.assertEqual((task.name, task.args), ('ecommerce_app.imaging.render_images', [[image.pk]]))
+        image.refresh_from_db()
+        self.assertEqual(image.derivatives, {})
+
+        taskqueue.drain()
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height, len(image.blurhash)), (600, 300, 28))
+        self.assertEqual(image.derivatives['card']['width'], 480)
+        self.assertTrue(default_storage.exists(image.derivatives['card']['webp']))
+        self.assertNotEqual(product_version(self.product.slug), version)
+
+        imaging.schedule(range(imaging.IMAGES_PER_TASK + 1))
+        self.assertEqual(
+            [len(task.args[0]) for task in Task.objects.filter(status=Task.QUEUED).order_by('pk')],
+            [imaging.IMAGES_PER_TASK, 1],
+        )
+
+    def test_product_image_tag(self):
+        template = Template("{% load product_images %}{% product_image image size 'img' 'Lamp' %}")
+
+        def tag(image, size='card'):
+            return template.render(Context({'image': image, 'size': size}))
+
+        self.assertIn('src="https://via.placeholder.com/160"', tag(None, 'thumb'))
+        self.assertEqual(
+            tag({'image': '/media/products/lamp.png', 'derivatives': {}}),
+            '<img src="/media/products/lamp.png" class="img" alt="Lamp" loading="lazy" decoding="async">',
+        )
+
+        image = ProductImage.objects.create(
+            product=self.product, image='products/lamp.png', blurhash='LKO2?U%2', derivatives={'detail': {
+                'width': 1200, 'height': 600,
+                'webp': 'products/derived/lamp-detail.webp', 'jpeg': 'products/derived/lamp-detail.jpg',
+            }},
+        )
+        html = tag(image, 'detail')
+        self.assertIn('<source type="image/webp" srcset="/media/products/derived/lamp-detail.webp">', html)
+        self.assertIn('<img src="/media/products/derived/lamp-detail.jpg" width="1200" height="600"', html)
+        self.assertIn('loading="eager"', html)
+        self.assertIn('data-blurhash="LKO2?U%2"', html)
+        # No derivative of that size yet: the original upload.
+        self.assertIn('src="/media/products/lamp.png"', tag(image, 'thumb'))
+
+
+def make_buyer(username, lines):
+    user = User.objects.create(username=username)
+    address = Address.objects.create(
+        user=user, full_name=username, phone='1', address_line1='Street',
+        city='City', state='State', postal_code='000000',
+    )
+    cart = Cart.objects.create(user=user)
+    CartItem.objects.bulk_create(CartItem(cart=cart, product=p, quantity=q) for p, q in lines)
+    return user, address, cart
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        # Priced 100, 101 and 102.
+        self.products = make_products(Category.objects.create(name='Snacks'), 3, images_per_product=0)
+        self.cart = Cart.objects.create(user=User.objects.create(username='snacker'))
+
+    def assert_totals(self, item_count, subtotal):
+        stored = Cart.objects.values_list('item_count', 'subtotal').get(pk=self.cart.pk)
+        self.assertEqual(stored, (item_count, Decimal(subtotal)))
+        Cart.objects.filter(pk=self.cart.pk).recalculate_totals()
+        self.assertEqual(Cart.objects.values_list('item_count', 'subtotal').get(pk=self.cart.pk), stored)
+
+    def test_item_changes_keep_totals(self):
+        first = CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=1)
+        self.assert_totals(3, 301)
+        first.quantity = 5
+        first.save()
+        self.assert_totals(6, 601)
+        first.delete()
+        self.assert_totals(1, 101)
+        self.cart.clear()
+        self.assert_totals(0, 0)
+
+    def test_product_changes_update_totals(self):
+        CartItem.objects.create(cart=self.cart, product=self.products[2], quantity=2)
+        product = Product.objects.get(pk=self.products[2].pk)
+        product.price = 150
+        product.save()
+        self.assert_totals(2, 300)
+        product.delete()
+        self.assert_totals(0, 0)
+
+    def test_command_repairs_drift(self):
+        CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=1)
+        other = Cart.objects.create(user=User.objects.create(username='other'))
+        Cart.objects.update(item_count=9, subtotal=1)
+        out = StringIO()
+        call_command('recalculate_cart_totals', batch_size=1, stdout=out)
+        self.assertIn('Recalculated totals for 2 carts.', out.getvalue())
+        self.assert_totals(1, 100)
+        self.assertEqual(Cart.objects.values_list('item_count', 'subtotal').get(pk=other.pk), (0, Decimal(0)))
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Books')
+        self.products = make_products(category, 50, images_per_product=0)
+
+    def test_checkout_query_count_is_independent_of_cart_size(self):
+        user, address, _ = make_buyer('small', [(self.products[0], 1)])
+        self.client.force_login(user)
+        with self.assertNumQueries(16):
+            response = self.client.post(reverse('checkout'), {'address_id': address.pk})
+        self.assertEqual(response.status_code, 201)
+
+        user, address, _ = make_buyer('large', [(p, 2) for p in self.products])
+        self.client.force_login(user)
+        with self.assertNumQueries(16):
+            response = self.client.post(reverse('checkout'), {'address_id': address.pk})
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.data['order_id'])
+        self.assertEqual(order.items.count(), 50)
+        self.assertEqual(order.total, sum(p.price * 2 for p in self.products))
+        self.assertFalse(CartItem.objects.filter(cart__user=user).exists())
+
+    def test_checkout_enqueues_confirmation_email(self):
+        user, address, _ = make_buyer('mailme', [(self.products[0], 1)])
+        User.objects.filter(pk=user.pk).update(email='mailme@example.com')
+        self.client.force_login(user)
+        response = self.client.post(reverse('checkout'), {'address_id': address.pk})
+        self.assertEqual(len(mail.outbox), 0)
+        task = Task.objects.get()
+        self.assertEqual(task.args, [response.data['order_id']])
+
+        taskqueue.drain()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.DONE)
+        self.assertEqual(mail.outbox[0].to, ['mailme@example.com'])
+
+    def test_insufficient_stock_rolls_back_every_line(self):
+        first, second = self.products[:2]
+        user, address, cart = make_buyer('buyer', [(first, 1), (second, 11)])
+        self.client.force_login(user)
+        response = self.client.post(reverse('checkout'), {'address_id': address.pk})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(second.title, response.data['detail'])
+        first.refresh_from_db()
+        self.assertEqual(first.stock, 10)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(cart.items.count(), 2)
+
+
+class CartBatchTests(TestCase):
+    def setUp(self):
+        self.products = make_products(Category.objects.create(name='Batch'), 3, images_per_product=0)
+        self.user, _, self.cart = make_buyer('batcher', [])
+        update_cart(self.user, [{'op': 'add', 'product_id': self.products[0].pk}])
+        self.client.force_login(self.user)
+
+    def batch(self, *operations):
+        return self.client.post(reverse('cart-batch'), {'operations': list(operations)}, content_type='application/json')
+
+    def quantities(self):
+        return dict(self.cart.items.values_list('product_id', 'quantity'))
+
+    def test_operations_apply_in_order(self):
+        first, second, third = (p.pk for p in self.products)
+        response = self.batch(
+            {'op': 'add', 'product_id': first, 'quantity': 2},
+            {'op': 'add', 'product_id': second},
+            {'op': 'set', 'product_id': second, 'quantity': 4},
+            {'op': 'remove', 'product_id': first},
+            {'op': 'add', 'product_id': third},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {second: 4, third: 1})
+        self.assertEqual(response.data['item_count'], 5)
+
+    def test_rejects_bad_quantities_and_unknown_products(self):
+        pk = self.products[1].pk
+        for operation in (
+            {'op': 'add', 'product_id': pk, 'quantity': 0},
+            {'op': 'add', 'product_id': pk, 'quantity': -3},
+            {'op': 'set', 'product_id': pk, 'quantity': -1},
+            {'op': 'add', 'product_id': 0},
+        ):
+            self.assertEqual(self.batch(operation).status_code, 400, operation)
+        response = self.client.post(reverse('cart-add'), {'product_id': pk, 'quantity': -1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1})
+
+
+class WishlistTests(TestCase):
+    def setUp(self):
+        self.products = make_products(Category.objects.create(name='Wants'), 4, images_per_product=0)
+        self.client.force_login(User.objects.create(username='wisher'))
+
+    def post(self, name, data):
+        return self.client.post(reverse(name), data, content_type='application/json')
+
+    def ids(self):
+        return sorted(self.client.get(reverse('wishlist-list'), {'mode': 'ids'}).data['product_ids'])
+
+    def test_toggle(self):
+        pk = self.products[0].pk
+        self.assertEqual(self.post('wishlist-toggle', {'product_id': pk}).data, {'status': 'added'})
+        self.assertEqual(self.ids(), [pk])
+        self.assertEqual(self.post('wishlist-toggle', {'product_id': pk}).data, {'status': 'removed'})
+        self.assertEqual(self.ids(), [])
+        self.assertEqual(self.post('wishlist-toggle', {'product_id': 0}).status_code, 404)
+
+    def test_add_and_remove_many(self):
+        pks = [p.pk for p in self.products]
+        self.post('wishlist-toggle', {'product_id': pks[0]})
+        # Already listed and unknown products are skipped.
+        response = self.post('wishlist-add-many', {'product_ids': [pks[0], pks[1], pks[2], 0]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ids(), pks[:3])
+        self.post('wishlist-remove-many', {'product_ids': [pks[1], pks[3]]})
+        self.assertEqual(self.ids(), [pks[0], pks[2]])
+        self.assertEqual(self.post('wishlist-add-many', {'product_ids': []}).status_code, 400)
+
+        products = self.client.get(reverse('wishlist-list')).data['products']
+        self.assertEqual(sorted(p['id'] for p in products), [pks[0], pks[2]])
+
+    def test_wishlists_are_per_user(self):
+        self.post('wishlist-toggle', {'product_id': self.products[0].pk})
+        self.client.force_login(User.objects.create(username='other'))
+        self.post('wishlist-remove-many', {'product_ids': [self.products[0].pk]})
+        self.assertEqual(self.ids(), [])
+        self.assertEqual(Wishlist.products.through.objects.count(), 1)
+
+
+class SearchTestsMixin:
+    def setUp(self):
+        self.lamps = Category.objects.create(name='Lamps')
+        self.books = Category.objects.create(name='Books')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.desk = self.product('Desk lamp', self.lamps, 'Bright light for reading')
+            self.guide = self.product('Reading guide', self.books, 'Which lamp to buy')
+            self.floor = self.product('Floor lamp', self.lamps, 'Tall')
+
+    def product(self, title, category, description):
+        return Product.objects.create(category=category, title=title, description=description, price=10)
+
+    def search(self, query, **kwargs):
+        return [pk for _, pk in search.search(query, **kwargs)]
+
+    def test_ranking_and_matching(self):
+        hits = self.search('lamp')
+        # Title matches outrank description matches.
+        self.assertEqual(set(hits[:2]), {self.desk.pk, self.floor.pk})
+        self.assertEqual(hits[2], self.guide.pk)
+        # Terms are prefixes, and all of them must match.
+        self.assertEqual(set(self.search('lam read')), {self.desk.pk, self.guide.pk})
+        self.assertEqual(self.search('lamp nothing'), [])
+        self.assertEqual(self.search('  '), [])
+        self.assertEqual(self.search('lamp', category='books'), [self.guide.pk])
+
+    def test_cursor(self):
+        pages, after = [], None
+        while True:
+            hits = search.search('lamp', limit=1, after=after)
+            if not hits:
+                break
+            pages.append(hits[0][1])
+            after = hits[0]
+        self.assertEqual(pages, self.search('lamp'))
+
+    def test_index_follows_changes(self):
+        self.search('lamp')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.floor.title = 'Standing light'
+            self.floor.save()
+            self.desk.delete()
+            self.books.name = 'Manuals'
+            self.books.save()
+            added = self.product('Lamp oil', self.books, '')
+        self.assertEqual(self.search('floor'), [])
+        self.assertEqual(self.search('standing'), [self.floor.pk])
+        self.assertEqual(self.search('desk'), [])
+        self.assertEqual(set(self.search('manuals')), {added.pk, self.guide.pk})
+        self.assertEqual(self.search('oil'), [added.pk])
+
+    def test_rebuild_command(self):
+        self.wipe()
+        self.assertEqual(self.search('tall'), [])
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn(type(search.get_backend()).__name__, out.getvalue())
+        self.assertEqual(self.search('tall'), [self.floor.pk])
+
+    def test_api(self):
+        url = reverse('product-search') + '?' + urlencode({'q': 'lamp', 'page_size': 2, 'fields': 'id,title'})
+        response = self.client.get(url)
+        self.assertEqual([p['id'] for p in response.data['results']], self.search('lamp')[:2])
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+        response = self.client.get(response.data['next'])
+        self.assertEqual([p['id'] for p in response.data['results']], [self.guide.pk])
+        self.assertIsNone(response.data['next'])
+
+
+@skipUnless(connection.vendor == 'sqlite', "FTS5 is the SQLite backend")
+class FTS5SearchTests(SearchTestsMixin, TestCase):
+    def wipe(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+
+
+class InMemorySearchTests(SearchTestsMixin, TestCase):
+    def setUp(self):
+        self.backend = search.InMemoryBackend()
+        patcher = mock.patch.object(search, 'get_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def wipe(self):
+        self.backend.rebuild()
+        self.backend._clear()
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.product = make_products(Category.objects.create(name='Drops'), 1, images_per_product=0)[0]
+        self.first, self.first_address, _ = make_buyer('first', [])
+        self.second, _, _ = make_buyer('second', [])
+
+    def test_cart_changes_hold_stock(self):
+        update_cart(self.first, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 7}])
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.reserved, self.product.available), (7, 3))
+
+        self.client.force_login(self.second)
+        response = self.client.post(reverse('cart-add'), {'product_id': self.product.pk, 'quantity': 4})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.filter(cart__user=self.second).exists())
+
+        update_cart(self.first, [{'op': 'set', 'product_id': self.product.pk, 'quantity': 2}])
+        response = self.client.post(reverse('cart-add'), {'product_id': self.product.pk, 'quantity': 4})
+        self.assertEqual(response.status_code, 200)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 6)
+
+    def test_checkout_converts_holds(self):
+        cart = update_cart(self.first, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 3}])
+        update_cart(self.second, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 7}])
+        place_order(cart, self.first_address)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (7, 7))
+        self.assertFalse(cart.reservations.exists())
+
+    def test_expired_holds_are_released(self):
+        update_cart(self.first, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 3}])
+        update_cart(self.second, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 2}])
+        StockReservation.objects.filter(cart__user=self.first).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_reservations(batch_size=1), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 2)
+        self.assertEqual(StockReservation.objects.get().cart.user, self.second)
+
+    def test_saving_a_loaded_product_keeps_its_counters(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        Product.objects.filter(pk=self.product.pk).update(reserved=F('reserved') + 5, shard_count=2)
+        stale.price = 150
+        stale.save()
+        fresh = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((fresh.price, fresh.reserved, fresh.shard_count), (150, 5, 2))
+
+    def test_deleting_a_cart_or_its_user_gives_holds_back(self):
+        cart = update_cart(self.first, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 3}])
+        update_cart(self.second, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 2}])
+        cart.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 2)
+
+        self.second.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_checkout_page_reports_shortfalls_without_writing(self):
+        update_cart(self.first, [{'op': 'add', 'product_id': self.product.pk, 'quantity': 7}])
+        # Put in the cart before holds existed, so nothing is held for it.
+        CartItem.objects.create(cart=Cart.objects.get(user=self.second), product=self.product, quantity=4)
+        holds = list(StockReservation.objects.values_list('cart', 'quantity', 'expires_at'))
+
+        self.client.force_login(self.second)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('checkout-page'))
+        self.assertContains(response, f'{self.product.title} (3 available)')
+        self.assertFalse([q['sql'] for q in queries if not q['sql'].startswith('SELECT')])
+        self.assertEqual(list(StockReservation.objects.values_list('cart', 'quantity', 'expires_at')), holds)
+
+        self.client.force_login(self.first)
+        self.assertNotContains(self.client.get(reverse('checkout-page')), 'available)')
+
+
+class StockShardTests(TestCase):
+    def setUp(self):
+        self.product = make_products(Category.objects.create(name='Hot'), 1, images_per_product=0)[0]
+        stock_shards.reshard(self.product, 4)
+
+    def test_reshard_spreads_stock(self):
+        self.assertEqual(sorted(StockShard.objects.values_list('stock', flat=True)), [2, 2, 3, 3])
+        self.assertEqual(stock_shards.level(Product.objects.get()), 10)
+        stock_shards.reshard(self.product, 0)
+        self.assertFalse(StockShard.objects.exists())
+        self.assertEqual(Product.objects.get().stock, 10)
+
+    def test_checkout_takes_from_shards(self):
+        # No shard holds 4 units, so this one drains several.
+        _, address, cart = make_buyer('buyer', [(self.product, 4)])
+        place_order(cart, address)
+        self.assertEqual(sum(StockShard.objects.values_list('stock', flat=True)), 6)
+
+        _, address, cart = make_buyer('late', [(self.product, 7)])
+        with self.assertRaises(InsufficientStock):
+            place_order(cart, address)
+        self.assertEqual(sum(StockShard.objects.values_list('stock', flat=True)), 6)
+
+        self.assertEqual(Product.objects.get().stock, 10)
+        Task.objects.update(run_at=timezone.now())
+        taskqueue.drain()
+        self.assertEqual(Product.objects.get().stock, 6)
+
+    def test_mirror_refresh_runs_after_the_window_of_checkouts(self):
+        window = settings.STOCK_SHARD_SYNC_SECONDS
+        with mock.patch.object(stock_shards.time, 'time', return_value=1000 * window + 1):
+            for name in ('first', 'second'):
+                _, address, cart = make_buyer(name, [(self.product, 1)])
+                place_order(cart, address)
+                # The first checkout's refresh hasn't run yet, so the second isn't left out.
+                taskqueue.drain()
+        task = Task.objects.get(idempotency_key=f'stock-shards-sync:{self.product.pk}:1000')
+        self.assertEqual(task.status, Task.QUEUED)
+        self.assertAlmostEqual((task.run_at - task.created_at).total_seconds(), window - 1, delta=0.5)
+        self.assertEqual(Product.objects.get().stock, 10)
+
+        Task.objects.update(run_at=timezone.now())
+        taskqueue.drain()
+        self.assertEqual(Product.objects.get().stock, 8)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.product = make_products(Category.objects.create(name='Games'), 3)[0]
+
+    def assert_revalidates(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('stale-while-revalidate=', response['Cache-Control'])
+        self.assertIn('public', response['Cache-Control'])
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.product.price += 1
+        self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_product_list(self):
+        self.assert_revalidates(reverse('product-list') + '?sort=price&page_size=2')
+        first = self.client.get(reverse('product-list') + '?sort=price&page_size=2')['ETag']
+        self.assertEqual(self.client.get(reverse('product-list') + '?page_size=2&sort=price')['ETag'], first)
+        self.assertNotEqual(self.client.get(reverse('product-list') + '?sort=price&page_size=3')['ETag'], first)
+
+    def test_product_detail(self):
+        self.assert_revalidates(reverse('product-detail', args=[self.product.slug]))
+
+    def test_default_validators_follow_the_catalog(self):
+        class CategoryList(ConditionalGetMixin, generics.ListAPIView):
+            queryset = Category.objects.order_by('pk')
+            serializer_class = CategorySerializer
+            pagination_class = None
+
+        view = CategoryList.as_view()
+        response = view(RequestFactory().get('/categories/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        etag = response['ETag']
+        response = view(RequestFactory().get('/categories/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+
+        self.product.price += 1
+        self.product.save()
+        response = view(RequestFactory().get('/categories/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_authenticated_responses_are_private(self):
+        self.client.force_login(User.objects.create(username='shopper'))
+        response = self.client.get(reverse('product-list'))
+        self.assertIn('private', response['Cache-Control'])
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        caches[settings.PAGE_CACHE_ALIAS].clear()
+        metrics.PAGE_CACHE_REQUESTS.clear()
+        self.first, self.second = make_products(Category.objects.create(name='Lamps'), 2)
+
+    def page(self, product):
+        return reverse('product-detail-page', args=[product.slug])
+
+    def test_anonymous_pages_are_served_from_the_cache(self):
+        rendered = self.client.get(self.page(self.first))
+        self.assertNotContains(rendered, 'csrfmiddlewaretoken')
+        self.assertIn('Accept-Encoding', rendered['Vary'])
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.page(self.first))
+        self.assertEqual(cached.content, rendered.content)
+
+        with self.assertNumQueries(0):
+            compressed = self.client.get(self.page(self.first), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(compressed['Content-Length'], str(len(compressed.content)))
+        self.assertEqual(gzip.decompress(compressed.content), rendered.content)
+        refused = self.client.get(self.page(self.first), HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(refused.has_header('Content-Encoding'))
+
+        self.assertEqual(metrics.PAGE_CACHE_REQUESTS.collect(), {
+            (('endpoint', 'product-detail-page'), ('result', 'miss')): 1,
+            (('endpoint', 'product-detail-page'), ('result', 'hit')): 3,
+        })
+
+    def test_a_product_change_invalidates_its_pages_only(self):
+        for url in (self.page(self.first), self.page(self.second), reverse('store-home')):
+            self.client.get(url)
+
+        self.first.title = 'Desk lamp'
+        self.first.save()
+        self.assertContains(self.client.get(self.page(self.first)), 'Desk lamp')
+        self.assertContains(self.client.get(reverse('store-home')), 'Desk lamp')
+        with self.assertNumQueries(0):
+            self.client.get(self.page(self.second))
+
+    def test_logged_in_visitors_get_their_own_page(self):
+        self.client.get(self.page(self.first))
+        self.client.force_login(User.objects.create(username='shopper'))
+        self.assertContains(self.client.get(self.page(self.first)), 'csrfmiddlewaretoken', count=2)
+
+    @override_settings(ROOT_URLCONF='ecommerce_project.urls_async')
+    async def test_logged_in_visitors_get_their_own_page_under_asgi(self):
+        rendered = await self.async_client.get(self.page(self.first))
+        self.assertNotContains(rendered, 'csrfmiddlewaretoken')
+        cached = await self.async_client.get(self.page(self.first))
+        self.assertEqual(cached.content, rendered.content)
+
+        await self.async_client.aforce_login(await User.objects.acreate(username='shopper'))
+        self.assertContains(await self.async_client.get(self.page(self.first)), 'csrfmiddlewaretoken', count=2)
+        self.assertEqual(metrics.PAGE_CACHE_REQUESTS.collect(), {
+            (('endpoint', 'product-detail-page'), ('result', 'miss')): 1,
+            (('endpoint', 'product-detail-page'), ('result', 'hit')): 1,
+        })
+
+    def test_waits_for_a_page_another_request_is_rendering(self):
+        pages = caches[settings.PAGE_CACHE_ALIAS]
+        rendered = self.client.get(self.page(self.first))
+        key = page_cache.page_key(RequestFactory().get(self.page(self.first)), product_version(self.first.slug))
+        entries = pages.get_many([f'{key}:identity'])
+        pages.clear()
+
+        pages.add(f'{key}:lock', 1)
+        threading.Timer(0.2, pages.set_many, [entries]).start()
+        with self.assertNumQueries(0):
+            response = self.client.get(self.page(self.first))
+        self.assertEqual(response.content, rendered.content)
+        self.assertEqual(
+            metrics.PAGE_CACHE_REQUESTS.collect()[('endpoint', 'product-detail-page'), ('result', 'wait')], 1,
+        )
+
+
+@override_settings(PAGE_CACHE_VIEWS=[])
+class AsyncViewTests(TestCase):
+    """The async views under urls_async answer exactly as the sync ones do."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_products(Category.objects.create(name='Lamps'), 3)
+        cls.user = User.objects.create(username='buyer')
+
+    def setUp(self):
+        caches[settings.PRODUCT_CACHE_ALIAS].clear()
+
+    @staticmethod
+    def body(response):
+        # CSRF tokens are masked afresh for every response.
+        return re.sub(rb'name="csrfmiddlewaretoken" value="[^"]+"', b'', response.content)
+
+    async def assert_same_responses(self, logged_in):
+        if logged_in:
+            await self.async_client.aforce_login(self.user)
+            await sync_to_async(self.client.force_login)(self.user)
+        slug = self.products[0].slug
+        urls = [
+            '/', '/?page=1', f'/product/{slug}/', '/api/products/', '/api/products/?sort=price&fields=slug,price',
+            '/api/products/?cursor=nonsense', f'/api/products/{slug}/', '/api/products/no-such-product/',
+        ]
+        for url in urls:
+            with self.subTest(url=url, logged_in=logged_in):
+                expected = await sync_to_async(self.client.get)(url)
+                with override_settings(ROOT_URLCONF='ecommerce_project.urls_async'):
+                    response = await self.async_client.get(url)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(self.body(response), self.body(expected))
+                self.assertEqual(response.get('Cache-Control'), expected.get('Cache-Control'))
+        return response
+
+    async def test_anonymous(self):
+        await self.assert_same_responses(logged_in=False)
+
+    async def test_logged_in(self):
+        await self.assert_same_responses(logged_in=True)
+        with override_settings(ROOT_URLCONF='ecommerce_project.urls_async'):
+            page = await self.async_client.get(f'/product/{self.products[0].slug}/')
+        self.assertContains(page, 'csrfmiddlewaretoken', count=2)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.products = make_products(Category.objects.create(name='Tools'), 3, images_per_product=1)
+
+    def test_server_timing_and_prometheus_output(self):
+        response = self.client.get(reverse('product-list'))
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries", serialize;dur=')
+        self.client.force_login(User.objects.create_user('ops', is_staff=True))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_db_queries_count{endpoint="product-list",method="GET"}', response.content.decode())
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_need_staff_or_the_token(self):
+        # The test client connects from 127.0.0.1, as a local reverse proxy would.
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+
+    @override_settings(METRICS_DEBUG_QUERIES=True, METRICS_DUPLICATE_QUERY_THRESHOLD=3)
+    def test_repeated_queries_are_flagged_with_their_origin(self):
+        def n_plus_one(request):
+            return HttpResponse(str([Product.objects.get(pk=p.pk).title for p in self.products]))
+
+        request = RequestFactory().get('/')
+        with self.assertLogs('ecommerce_app.metrics', 'WARNING') as logs:
+            response = metrics.MetricsMiddleware(n_plus_one)(request)
+        self.assertEqual(response['X-Duplicate-Queries'], '1')
+        self.assertIn('tests.py', logs.output[0])
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Games')
+        self.products = make_products(category, 10)
+        self.user, self.address, _ = make_buyer('history', [])
+        self.client.force_login(self.user)
+
+    def place_orders(self, count, lines):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, address=self.address, total=0)
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=p, quantity=2, price=p.price) for p in self.products[:lines]
+            )
+
+    def test_query_count_is_constant_per_page(self):
+        self.place_orders(1, 1)
+        # Session and user lookups, then orders, order lines and images.
+        with self.assertNumQueries(5):
+            self.client.get(reverse('orders-list'))
+        self.place_orders(30, 10)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('orders-list'), {'page_size': 20})
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(len(response.data['results'][0]['items']), 10)
+        with self.assertNumQueries(5):
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 11)
+
+    def test_summary_mode_omits_lines(self):
+        self.place_orders(3, 4)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('orders-list'), {'mode': 'summary'})
+        self.assertEqual(
+            set(response.data['results'][0]), {'id', 'status', 'total', 'item_count', 'created_at'},
+        )
+        self.assertEqual(response.data['results'][0]['item_count'], 8)
+
+    @skipUnless(connection.vendor == 'sqlite', "reads SQLite query plans")
+    def test_later_pages_seek_into_the_user_index(self):
+        self.place_orders(3, 1)
+        last = Order.objects.order_by('pk').first()
+        ordering = ('-created_at', '-id')
+        plan = (
+            Order.objects.filter(user=self.user).order_by(*ordering)
+            .filter(keyset_filter(ordering, [last.created_at, last.pk]))[:25].explain()
+        )
+        self.assertIn('USING INDEX order_user_created_id_idx (user_id=? AND created_at<?)', plan)
+        self.assertNotIn('B-TREE FOR ORDER BY', plan)
+
+    def test_other_users_orders_are_hidden(self):
+        self.place_orders(1, 1)
+        order = Order.objects.get()
+        other, _, _ = make_buyer('other', [])
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('orders-detail', args=[order.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('orders-list')).data['results'], [])
+
+
+calls = []
+
+
+@taskqueue.task(name='tests.flaky', max_attempts=2)
+def flaky(value):
+    calls.append(value)
+    if value == 'fail':
+        raise ValueError(value)
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_failures_retry_with_backoff_then_give_up(self):
+        taskqueue.enqueue(flaky, 'fail')
+        taskqueue.drain()
+        task = Task.objects.get()
+        self.assertEqual((task.status, task.attempts), (Task.QUEUED, 1))
+        self.assertGreater(task.run_at, timezone.now())
+        self.assertIn('ValueError', task.last_error)
+
+        Task.objects.update(run_at=timezone.now())
+        taskqueue.drain()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 2))
+        self.assertEqual(calls, ['fail', 'fail'])
+
+    def test_idempotency_key_drops_duplicates(self):
+        for _ in range(3):
+            taskqueue.enqueue(flaky, 'once', key='only-once')
+        taskqueue.drain()
+        self.assertEqual(calls, ['once'])
+        self.assertEqual(taskqueue.stats()['depth'][Task.DONE], 1)
+
+    def test_expired_lease_is_reclaimed(self):
+        taskqueue.enqueue(flaky, 'stuck')
+        self.assertEqual(len(taskqueue.claim('dead-worker', 10)), 1)
+        self.assertEqual(taskqueue.claim('other', 10), [])
+        Task.objects.update(locked_at=timezone.now() - timedelta(seconds=settings.TASK_LEASE_SECONDS + 1))
+        taskqueue.drain('other')
+        self.assertEqual(Task.objects.get().status, Task.DONE)
+
+
+class CheckoutConcurrencyTests(TransactionTestCase):
+    buyers = 20
+    stock = 5
+
+    def test_parallel_checkouts_never_oversell(self):
+        product = make_products(Category.objects.create(name='Flash sale'), 1, images_per_product=0)[0]
+        Product.objects.filter(pk=product.pk).update(stock=self.stock)
+        carts = [make_buyer(f'buyer{i}', [(product, 1)])[1:] for i in range(self.buyers)]
+
+        results = []
+        start = threading.Barrier(self.buyers)
+
+        def buy(address, cart):
+            start.wait()
+            try:
+                for _ in range(200):
+                    try:
+                        place_order(cart, address)
+                        results.append('ordered')
+                        return
+                    except InsufficientStock:
+                        results.append('sold out')
+                        return
+                    except OperationalError:
+                        # Without BEGIN IMMEDIATE (the sqlite-plain profile),
+                        # SQLite reports lock contention instead of waiting.
+                        time.sleep(random.uniform(0.001, 0.01))
+                results.append('gave up')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=args) for args in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(results.count('ordered'), self.stock)
+        self.assertEqual(results.count('sold out'), self.buyers - self.stock)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(sum(OrderItem.objects.values_list('quantity', flat=True)), self.stock)
+
+    def test_checkout_racing_an_add_loses_nothing(self):
+        first, second = make_products(Category.objects.create(name='Race'), 2, images_per_product=0)
+        for n in range(5):
+            user, address, _ = make_buyer(f"racer{n}", [])
+            update_cart(user, [{'op': 'add', 'product_id': first.pk, 'quantity': 1}])
+            cart = Cart.objects.get(user=user)
+            errors = []
+            start = threading.Barrier(2)
+
+            def attempt(work):
+                start.wait()
+                try:
+                    for _ in range(200):
+                        try:
+                            return work()
+                        except OperationalError:
+                            time.sleep(random.uniform(0.001, 0.01))
+                    errors.append('gave up')
+                except Exception as exc:
+                    errors.append(exc)
+                finally:
+                    connection.close()
+
+            threads = [
+                threading.Thread(target=attempt, args=[lambda: place_order(cart, address)]),
+                threading.Thread(target=attempt, args=[
+                    lambda: update_cart(user, [{'op': 'add', 'product_id': second.pk, 'quantity': 2}]),
+                ]),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+            # The add is either in the order or still in the cart, with its hold.
+            ordered = dict(OrderItem.objects.filter(order__user=user).values_list('product_id', 'quantity'))
+            in_cart = dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+            held = dict(StockReservation.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+            self.assertEqual(ordered.get(first.pk), 1)
+            self.assertEqual(ordered.get(second.pk, 0) + in_cart.get(second.pk, 0), 2)
+            self.assertEqual(held, in_cart)
+            cart.refresh_from_db()
+            self.assertEqual(cart.item_count, sum(in_cart.values()))
+
+        for product in (first, second):
+            product.refresh_from_db()
+            holds = StockReservation.objects.filter(product=product).values_list('quantity', flat=True)
+            self.assertEqual(product.reserved, sum(holds))
+
+
+class CartConcurrencyTests(TransactionTestCase):
+    requests = 10
+
+    def test_parallel_adds_to_one_cart_all_count(self):
+        product = make_products(Category.objects.create(name='Restock'), 1, images_per_product=0)[0]
+        Product.objects.filter(pk=product.pk).update(stock=100)
+        user, _, cart = make_buyer('shopper', [])
+        errors = []
+        start = threading.Barrier(self.requests)
+
+        def add():
+            start.wait()
+            try:
+                for _ in range(200):
+                    try:
+                        update_cart(user, [{'op': 'add', 'product_id': product.pk, 'quantity': 2}])
+                        return
+                    except OperationalError:
+                        time.sleep(random.uniform(0.001, 0.01))
+                errors.append('gave up')
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add) for _ in range(self.requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(CartItem.objects.get(cart=cart).quantity, 2 * self.requests)
+        cart.refresh_from_db()
+        self.assertEqual((cart.item_count, cart.subtotal), (2 * self.requests, 2 * self.requests * product.price))
+        self.assertEqual(Product.objects.get().reserved, 2 * self.requests)
+
+
+class DatabaseProfileTests(TestCase):
+    @skipUnless(connection.vendor == 'sqlite' and settings.SQLITE_PRAGMAS, "SQLite tuning is off")
+    def test_sqlite_connections_run_the_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(connection.settings_dict['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+
+    def test_profiles(self):
+        base_dir = Path('/srv/shop')
+        databases, pragmas = db_profiles.databases('sqlite-plain', base_dir, {})
+        self.assertEqual((databases['default']['NAME'], pragmas), (base_dir / 'db.sqlite3', {}))
+        self.assertNotIn('OPTIONS', databases['default'])
+
+        pooled = db_profiles.databases('postgresql', base_dir, {'POSTGRES_HOST': 'db'})[0]['default']
+        self.assertEqual(pooled['HOST'], 'db')
+        self.assertEqual(pooled['OPTIONS']['pool']['max_size'], 10)
+        self.assertNotIn('CONN_MAX_AGE', pooled)
+
+        replicated = db_profiles.databases('sqlite', base_dir, {'DJANGO_DB_REPLICAS': '2'})[0]
+        self.assertEqual(replicated['replica2']['NAME'], base_dir / 'db.replica2.sqlite3')
+        self.assertEqual(replicated['replica2']['TEST'], {'MIRROR': 'default'})
+
+        persistent = db_profiles.databases('postgresql', base_dir, {'DJANGO_DB_POOL': '0'})[0]['default']
+        self.assertEqual((persistent['CONN_MAX_AGE'], persistent['CONN_HEALTH_CHECKS']), (600, True))
+        self.assertNotIn('OPTIONS', persistent)
+
+        with self.assertRaises(ValueError):
+            db_profiles.databases('mysql', base_dir, {})
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_SELECTION='round-robin')
+class ReplicaRoutingTests(TestCase):
+    def route(self, view_name='product-list', method='GET', cookies=None, write=False):
+        """The databases Product, Product again and Cart are read from in one request."""
+        router = routers.ReplicaRouter()
+
+        def view(request):
+            aliases = [router.db_for_read(Product)]
+            if write:
+                router.db_for_write(Cart)
+            aliases += [router.db_for_read(Product), router.db_for_read(Cart)]
+            return HttpResponse(','.join(aliases))
+
+        def get_response(request):
+            request.resolver_match = SimpleNamespace(view_name=view_name)
+            return middleware.process_view(request, view, (), {}) or view(request)
+
+        middleware = routers.ReplicaRoutingMiddleware(get_response)
+        request = RequestFactory().generic(method, '/')
+        request.COOKIES.update(cookies or {})
+        response = middleware(request)
+        return response.content.decode().split(','), response.cookies.get(routers.PIN_COOKIE)
+
+    def test_catalog_reads_go_to_one_replica_per_request(self):
+        (first, again, cart), _ = self.route()
+        self.assertIn(first, ['replica1', 'replica2'])
+        self.assertEqual((again, cart), (first, 'default'))
+        (second, _, _), _ = self.route()
+        self.assertNotEqual(second, first)
+        self.assertEqual(routers.pool.in_flight[first], 0)
+
+    def test_other_views_methods_and_code_outside_requests_use_the_primary(self):
+        self.assertEqual(self.route('cart-list')[0], ['default'] * 3)
+        self.assertEqual(self.route(method='POST')[0], ['default'] * 3)
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Product), 'default')
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.route()[0], ['default'] * 3)
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        aliases, pin = self.route(write=True)
+        self.assertEqual(aliases[1:], ['default', 'default'])
+        self.assertEqual(pin['max-age'], settings.REPLICA_PIN_SECONDS)
+        self.assertEqual(self.route(cookies={routers.PIN_COOKIE: pin.value})[0], ['default'] * 3)
+        expired = {routers.PIN_COOKIE: str(time.time() - 1)}
+        self.assertIn(self.route(cookies=expired)[0][0], ['replica1', 'replica2'])
+
+    def test_least_loaded_picks_the_replica_with_fewest_requests(self):
+        pool = routers.ReplicaPool()
+        busy = pool.acquire(['replica1', 'replica2'], 'least-loaded')
+        idle = pool.acquire(['replica1', 'replica2'], 'least-loaded')
+        self.assertNotEqual(busy, idle)
+        pool.release(idle)
+        self.assertEqual(pool.acquire(['replica1', 'replica2'], 'least-loaded'), idle)
+        self.assertEqual(pool.acquire(['replica1', 'replica2'], 'least-loaded'), idle)
+        self.assertEqual(pool.in_flight, {busy: 1, idle: 2})
+
+
+@skipUnless(connection.vendor == 'sqlite', "copies SQLite files")
+class SyncReplicasTests(TransactionTestCase):
+    def test_copies_the_primary_into_each_replica(self):
+        make_products(Category.objects.create(name='Lamps'), 3)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replicas = {
+            alias: SimpleNamespace(settings_dict={'NAME': str(Path(directory.name) / f'{alias}.sqlite3')})
+            for alias in ('replica1', 'replica2')
+        }
+        out = StringIO()
+        with override_settings(DATABASE_REPLICAS=list(replicas)), \
+                mock.patch.object(sync_replicas, 'connections', {'default': connection, **replicas}):
+            call_command('sync_replicas', stdout=out)
+        self.assertIn('Copied the primary to 2 replicas', out.getvalue())
+
+        expected = list(Product.objects.order_by('pk').values_list('slug', 'category__name'))
+        for replica in replicas.values():
+            copy = sqlite3.connect(replica.settings_dict['NAME'])
+            try:
+                rows = copy.execute(
+                    'SELECT p.slug, c.name FROM ecommerce_app_product p'
+                    ' JOIN ecommerce_app_category c ON c.id = p.category_id ORDER BY p.id'
+                ).fetchall()
+            finally:
+                copy.close()
+            self.assertEqual(rows, expected)
+
+    def test_needs_replicas(self):
+        with override_settings(DATABASE_REPLICAS=[]), self.assertRaisesMessage(CommandError, 'No replicas configured'):
+            call_command('sync_replicas')
+
+
+class IndexAdvisorTests(TestCase):
+    def test_reports_scans_and_sorts_an_index_would_avoid(self):
+        log = index_advisor.QueryLog()
+        log.start()
+        try:
+            list(PaymentRecord.objects.filter(method='UPI').order_by('-created_at'))
+            list(PaymentRecord.objects.filter(method='UPI').order_by('-created_at'))
+            list(Product.objects.order_by('-created_at')[:5])
+            list(Product.objects.filter(pk__in=[1, 2]))
+        finally:
+            log.stop()
+        self.assertEqual(len(log.queries), 3)
+
+        findings = [f for f in index_advisor.analyze(log) if f.fields]
+        # A scan and a sort, both served by the same index.
+        self.assertEqual({f.kind for f in findings}, {'full scan', 'sort'})
+        self.assertEqual({(f.model, tuple(f.fields), f.runs) for f in findings},
+                         {(PaymentRecord, ('method', '-created_at'), 2)})
+        self.assertIn('tests.py', findings[0].query.origin)
+
+    def test_suggest(self):
+        table = '"ecommerce_app_order"'
+        sql = (f'SELECT * FROM {table} WHERE ({table}."created_at" > %s AND {table}."user_id" = %s '
+               f'AND {table}."status" IN (%s)) ORDER BY {table}."id" DESC LIMIT 5')
+        self.assertEqual(index_advisor.suggest(sql, 'ecommerce_app_order'), ['user_id', 'status', 'created_at'])
+        sql = f'SELECT * FROM {table} ORDER BY LENGTH({table}."status"), {table}."created_at" DESC'
+        self.assertEqual(index_advisor.suggest(sql, 'ecommerce_app_order'), ['-created_at'])
+
+    def test_suggest_for_keyset_pages(self):
+        # Cursor pages AND a bound on the leading column onto an OR of
+        # "past it" and "tied with it, past the id".
+        products = Product.objects.filter(keyset_filter(['price', 'id'], [Decimal('10'), 5])).order_by('price', 'id')
+        self.assertEqual(index_advisor.suggest(str(products[:5].query), 'ecommerce_app_product'), ['price', 'id'])
+        orders = Order.objects.filter(
+            keyset_filter(['-created_at', '-id'], [timezone.now(), 5]), user_id=1,
+        ).order_by('-created_at', '-id')
+        self.assertEqual(index_advisor.suggest(str(orders[:5].query), 'ecommerce_app_order'),
+                         ['user_id', '-created_at', '-id'])
+        # Nothing compared only inside an OR leads the index.
+        sql = str(Product.objects.filter(Q(price__gt=10) | Q(stock=0)).order_by('title').query)
+        self.assertEqual(index_advisor.suggest(sql, 'ecommerce_app_product'), ['title'])
+
+
+# Query budgets. Every endpoint is requested once against a small data set
+# and once against a large one, with cold caches, and must run exactly the
+# same number of queries both times: a count that grows with the data is an
+# N+1. Timings are a coarse backstop; scale them with PERF_TIME_FACTOR on
+# slow machines.
+
+TIME_BUDGET = 0.5 * float(os.environ.get('PERF_TIME_FACTOR', 1))
+
+
+def fill_cart(cart, products):
+    CartItem.objects.bulk_create(CartItem(cart=cart, product=p, quantity=1) for p in products)
+    Cart.objects.filter(pk=cart.pk).recalculate_totals()
+
+
+def fill_wishlist(user, products):
+    wishlist = Wishlist.objects.create(user=user)
+    Wishlist.products.through.objects.bulk_create(
+        Wishlist.products.through(wishlist=wishlist, product=p) for p in products
+    )
+
+
+def make_orders(user, address, count, products):
+    orders = Order.objects.bulk_create(
+        Order(user=user, address=address, total=sum(p.price for p in products)) for _ in range(count)
+    )
+    OrderItem.objects.bulk_create(
+        OrderItem(order=order, product=p, quantity=1, price=p.price) for order in orders for p in products
+    )
+    return orders
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.small_category = Category.objects.create(name='Few')
+        cls.large_category = Category.objects.create(name='Many')
+        few = make_products(cls.small_category, 3)
+        many = make_products(cls.large_category, 2000)
+        search.rebuild()
+
+        cls.small, small_address, small_cart = make_buyer('small', [])
+        cls.large, large_address, large_cart = make_buyer('large', [])
+        Address.objects.bulk_create(
+            Address(user=cls.large, full_name=f'Large {i}', phone='1', address_line1='Street',
+                    city='City', state='State', postal_code='000000')
+            for i in range(20)
+        )
+        fill_cart(small_cart, few[:1])
+        # Below SQLite's 999 parameter limit, so bulk writes of the whole cart
+        # stay one statement.
+        fill_cart(large_cart, many[:150])
+        fill_wishlist(cls.small, few[:1])
+        fill_wishlist(cls.large, many[:500])
+        make_orders(cls.small, small_address, 1, few[:1])
+        make_orders(cls.large, large_address, 30, many[:10])
+
+        cls.addresses = {cls.small: small_address, cls.large: large_address}
+        cls.few, cls.many = few, many
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+
+    def request(self, user, method, url, data=None):
+        client = Client()
+        if user is not None:
+            client.force_login(user)
+        caches[settings.PRODUCT_CACHE_ALIAS].clear()
+        caches[settings.PAGE_CACHE_ALIAS].clear()
+        cache.clear()
+        kwargs = {'content_type': 'application/json'} if method in ('post', 'put', 'patch') else {}
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data, **kwargs)
+            elapsed = time.perf_counter() - started
+        self.assertLess(elapsed, TIME_BUDGET, f"{method.upper()} {url} took {elapsed:.3f}s")
+        return response, len(queries)
+
+    def assert_budget(self, budget, method, requests, status=200):
+        """`requests` is one (user, url, data) per data size."""
+        counts = []
+        for user, url, data in requests:
+            response, count = self.request(user, method, url, data)
+            self.assertEqual(response.status_code, status, f"{method.upper()} {url}")
+            counts.append(count)
+        self.assertEqual(counts, [budget] * len(counts), f"{method.upper()} {requests[0][1]}: queries per data size")
+
+    def per_user(self, url, data=None):
+        return [(self.small, url, data), (self.large, url, data)]
+
+    def per_category(self, url, params=None):
+        return [
+            (None, url, dict(params or {}, category=category.slug))
+            for category in (self.small_category, self.large_category)
+        ]
+
+    # Catalog
+
+    def test_product_list(self):
+        # Catalog version seed (2), page, images, facet counts (2).
+        self.assert_budget(6, 'get', self.per_category(reverse('product-list')))
+
+    def test_product_list_sorted_and_filtered(self):
+        self.assert_budget(6, 'get', self.per_category(reverse('product-list'), {'sort': 'price', 'in_stock': 1}))
+
+    def test_product_search(self):
+        self.assert_budget(3, 'get', self.per_category(reverse('product-search'), {'q': 'product'}))
+
+    def test_product_detail(self):
+        # Catalog version seed (2), product with category, images.
+        self.assert_budget(4, 'get', [
+            (None, reverse('product-detail', args=[product.slug]), None) for product in (self.few[0], self.many[0])
+        ])
+
+    def test_store_home(self):
+        # Catalog version seed (2) for the page cache key, count, page, images.
+        self.assert_budget(5, 'get', [(None, reverse('store-home'), None), (None, reverse('store-home'), {'page': 50})])
+
+    def test_product_detail_page(self):
+        self.assert_budget(2, 'get', [
+            (None, reverse('product-detail-page', args=[product.slug]), None)
+            for product in (self.few[0], self.many[0])
+        ])
+
+    # Cart
+
+    def test_cart(self):
+        self.assert_budget(6, 'get', self.per_user(reverse('cart-list')))
+
+    def test_cart_page(self):
+        # Session, user, cart, items with their products.
+        self.assert_budget(4, 'get', self.per_user(reverse('cart-page')))
+
+    def test_cart_add(self):
+        self.assert_budget(13, 'post', self.per_user(reverse('cart-add'), {'product_id': self.many[1500].pk}))
+
+    def test_cart_batch(self):
+        operations = [{'op': 'add', 'product_id': p.pk, 'quantity': 1} for p in self.many[1000:1020]]
+        self.assert_budget(15, 'post', self.per_user(reverse('cart-batch'), {'operations': operations}))
+
+    def test_cart_update_item_and_remove(self):
+        items = [CartItem.objects.filter(cart__user=user).order_by('pk').first() for user in (self.small, self.large)]
+        self.assert_budget(14, 'post', [
+            (item.cart.user, reverse('cart-update-item'), {'item_id': item.pk, 'quantity': 2}) for item in items
+        ])
+        self.assert_budget(14, 'post', [
+            (item.cart.user, reverse('cart-remove'), {'item_id': item.pk}) for item in items
+        ])
+
+    # Wishlist
+
+    def test_wishlist(self):
+        self.assert_budget(6, 'get', self.per_user(reverse('wishlist-list')))
+        self.assert_budget(3, 'get', self.per_user(reverse('wishlist-list') + '?mode=ids'))
+
+    def test_wishlist_page(self):
+        # Session, user, wishlist, products, primary images.
+        self.assert_budget(5, 'get', self.per_user(reverse('wishlist-page')))
+
+    def test_wishlist_changes(self):
+        product = self.many[1999]
+        self.assert_budget(6, 'post', self.per_user(reverse('wishlist-toggle'), {'product_id': product.pk}))
+        ids = [p.pk for p in self.many[1900:1950]]
+        self.assert_budget(5, 'post', self.per_user(reverse('wishlist-add-many'), {'product_ids': ids}))
+        self.assert_budget(3, 'post', self.per_user(reverse('wishlist-remove-many'), {'product_ids': ids}))
+
+    # Addresses, orders, checkout
+
+    def test_addresses(self):
+        self.assert_budget(3, 'get', self.per_user(reverse('addresses-list')))
+        self.assert_budget(3, 'get', [
+            (user, reverse('addresses-detail', args=[address.pk]), None) for user, address in self.addresses.items()
+        ])
+        data = {'full_name': 'New', 'phone': '1', 'address_line1': 'Road', 'city': 'Town', 'state': 'State',
+                'postal_code': '111111'}
+        self.assert_budget(3, 'post', self.per_user(reverse('addresses-list'), data), status=201)
+        self.assert_budget(4, 'put', [
+            (user, reverse('addresses-detail', args=[address.pk]), data) for user, address in self.addresses.items()
+        ])
+
+    def test_orders(self):
+        self.assert_budget(5, 'get', self.per_user(reverse('orders-list')))
+        self.assert_budget(3, 'get', self.per_user(reverse('orders-list') + '?mode=summary'))
+        self.assert_budget(5, 'get', [
+            (user, reverse('orders-detail', args=[Order.objects.filter(user=user).latest('pk').pk]), None)
+            for user in (self.small, self.large)
+        ])
+
+    def test_checkout_page(self):
+        self.assert_budget(7, 'get', self.per_user(reverse('checkout-page')))
+
+    def test_checkout(self):
+        self.assert_budget(16, 'post', [
+            (user, reverse('checkout'), {'address_id': address.pk}) for user, address in self.addresses.items()
+        ], status=201)
+
+    def test_task_stats(self):
+        self.assert_budget(6, 'get', [(self.staff, reverse('task-stats'), None)])
@@ -1,19 +1,20 @@
-from . import views
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ProductListAPIView, ProductDetailAPIView, CartViewSet, WishlistViewSet, AddressViewSet, CheckoutAPIView
+from .views import ProductListAPIView, ProductSearchAPIView, ProductDetailAPIView, CartViewSet, WishlistViewSet, AddressViewSet, OrderViewSet, CheckoutAPIView, TaskStatsAPIView
 
 
 router = DefaultRouter()
 router.register(r'cart', CartViewSet, basename='cart')
 router.register(r'wishlist', WishlistViewSet, basename='wishlist')
 router.register(r'addresses', AddressViewSet, basename='addresses')
+router.register(r'orders', OrderViewSet, basename='orders')
 
 
 urlpatterns = [
 path('products/', ProductListAPIView.as_view(), name='product-list'),
+path('products/search/', ProductSearchAPIView.as_view(), name='product-search'),
 path('products/<slug:slug>/', ProductDetailAPIView.as_view(), name='product-detail'),
 path('checkout/', CheckoutAPIView.as_view(), name='checkout'),
+path('tasks/stats/', TaskStatsAPIView.as_view(), name='task-stats'),
 path('', include(router.urls)),
-path("", views.store_home, name="store-home"),
 ]
\ No newline at end of file
@@ -1,34 +1,191 @@
+import json
+from decimal import Decimal
+
 from rest_framework import generics, viewsets, status
 from rest_framework.decorators import action, api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from .models import Product, Category, Cart, CartItem, Wishlist, Address, Order, OrderItem
+from .models import Product, ProductFacet, Category, Cart, CartItem, Wishlist, Address, Order, OrderItem
 from .serializers import (
 ProductSerializer, CategorySerializer, CartSerializer, CartItemSerializer,
-WishlistSerializer, AddressSerializer, OrderSerializer
+WishlistSerializer, AddressSerializer, OrderSerializer, CartOperationSerializer, CartBatchSerializer,
+WishlistProductSerializer, WishlistProductsSerializer, ProductFilterSerializer, OrderSummarySerializer
 )
-from django.db import transaction
-from ecommerce_app import serializers
-
-
-class ProductListAPIView(generics.ListAPIView):
+from .catalog_cache import catalog_version, get_product_json, product_version, product_versions
+from .conditional import add_validators, last_modified, list_etag, not_modified, product_etag
+from .pagination import InvalidCursor, KeysetPagination, decode_cursor, encode_cursor
+from .services import (
+    EmptyCart, InsufficientStock, UnknownProducts, place_order, unavailable_products, update_cart,
+)
+from django.db.models import DecimalField, F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
+from ecommerce_app import search, taskqueue
+
+
+def requested_product_fields(params):
+    """The ProductSerializer fields named in ?fields=a,b, or None for all of them."""
+    raw = params.get('fields')
+    if not raw:
+        return None
+    fields = [f for f in raw.split(',') if f in ProductSerializer.Meta.fields]
+    return fields or None
+
+
+def product_queryset(fields=None, ordering=()):
+    """Products loading only what serializing `fields` needs, plus the keyset `ordering` columns."""
+    qs = Product.objects.all()
+    if fields is None:
+        return qs.select_related('category').prefetch_related('images')
+    # The keyset cursor reads the ordering columns off the last row.
+    ordering = {f.lstrip('-') for f in ordering}
+    columns = {'id', 'created_at'} | (ordering & {f.name for f in Product._meta.concrete_fields})
+    columns.update(f for f in fields if f not in ('category', 'images'))
+    if 'category' in fields:
+        qs = qs.select_related('category')
+        columns.update(('category', 'category__name'))
+    if 'images' in fields:
+        qs = qs.prefetch_related('images')
+    return qs.only(*columns)
+
+
+def parse_product_filters(params):
+    serializer = ProductFilterSerializer(data=params)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def filter_products(qs, filters):
+    if filters.get('category'):
+        qs = qs.filter(category__slug=filters['category'])
+    if filters.get('min_price') is not None:
+        qs = qs.filter(price__gte=filters['min_price'])
+    if filters.get('max_price') is not None:
+        qs = qs.filter(price__lte=filters['max_price'])
+    if filters['in_stock']:
+        qs = qs.filter(stock__gt=0)
+    if filters['on_sale']:
+        qs = qs.filter(old_price__gt=F('price'))
+    if filters['sort'] == 'discount':
+        qs = qs.annotate(discount=Coalesce(F('old_price') - F('price'), Value(Decimal('0')),
+                                           output_field=DecimalField(max_digits=10, decimal_places=2)))
+    return qs
+
+
+def facet_filters(filters):
+    return {k: v for k, v in filters.items() if k != 'sort'}
+
+
+class ProductFieldsMixin:
+    """Honours ?fields=a,b for both the columns loaded and the fields serialized."""
+
+    def get_requested_fields(self):
+        return requested_product_fields(self.request.query_params)
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_product_queryset(self):
+        return product_queryset(self.get_requested_fields(), getattr(self, 'keyset_ordering', ()))
+
+
+class ConditionalGetMixin:
+    """
+    Answers GETs the client already has with a 304 before the view does any
+    work, and adds ETag, Last-Modified and Cache-Control to the rest.
+    """
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Return (etag, last modified timestamp). By default they follow the
+        catalog version, so any product change makes the response stale;
+        views that depend on less override this.
+        """
+        version = catalog_version()
+        return list_etag(request, version), last_modified(version)
+
+    def get(self, request, *args, **kwargs):
+        self.validators = self.get_validators(request, *args, **kwargs)
+        response = not_modified(request, *self.validators)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'validators', None):
+            add_validators(response, *self.validators, anonymous=not request.user.is_authenticated)
+        return response
+
+
+class ProductListAPIView(ConditionalGetMixin, ProductFieldsMixin, generics.ListAPIView):
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
-    pagination_class = None
+    pagination_class = KeysetPagination
+
+    def get_filters(self):
+        if not hasattr(self, '_filters'):
+            self._filters = parse_product_filters(self.request.query_params)
+        return self._filters
 
     def get_queryset(self):
-        qs = Product.objects.all().prefetch_related('images', 'category')
-        category = self.request.query_params.get('category')
-        if category:
-            qs = qs.filter(category__slug=category)
-        return qs
+        filters = self.get_filters()
+        self.keyset_ordering = ProductFilterSerializer.SORTS[filters['sort']]
+        return filter_products(self.get_product_queryset(), filters)
 
-class ProductDetailAPIView(generics.RetrieveAPIView):
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        response.data['facets'] = ProductFacet.counts(**facet_filters(self.get_filters()))
+        return response
+
+
+class ProductSearchAPIView(ProductFieldsMixin, generics.GenericAPIView):
+    serializer_class = ProductSerializer
+    permission_classes = [AllowAny]
+    pagination_class = KeysetPagination
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        category = request.query_params.get('category')
+        page_size = self.paginator.get_page_size(request)
+        after = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                score, pk = decode_cursor(cursor)
+                after = (float(score), int(pk))
+            except (TypeError, ValueError):
+                raise InvalidCursor
+
+        hits = search.search(query, category=category, limit=page_size + 1, after=after)
+        next_link = None
+        if len(hits) > page_size:
+            hits = hits[:page_size]
+            next_link = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor(hits[-1]))
+
+        products = self.get_product_queryset().in_bulk([pk for _, pk in hits])
+        results = [products[pk] for _, pk in hits if pk in products]
+        return Response({'next': next_link, 'results': self.get_serializer(results, many=True).data})
+
+
+class ProductDetailAPIView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
     lookup_field = 'slug'
-    queryset = Product.objects.all().prefetch_related('images', 'category')
+    queryset = Product.objects.all().select_related('category').prefetch_related('images')
+
+    def get_validators(self, request, *args, **kwargs):
+        return product_etag(product_version(kwargs[self.lookup_field])), last_modified(catalog_version())
+
+    def retrieve(self, request, *args, **kwargs):
+        body = get_product_json(kwargs[self.lookup_field])
+        if body is None:
+            raise Http404
+        return HttpResponse(body, content_type='application/json')
 
 
 class CartViewSet(viewsets.ViewSet):
@@ -38,70 +195,120 @@ class CartViewSet(viewsets.ViewSet):
         cart, created = Cart.objects.get_or_create(user=user)
         return cart
 
+    def _cart_with_items(self, user):
+        items = CartItem.objects.select_related('product__category').prefetch_related('product__images')
+        return Cart.objects.prefetch_related(Prefetch('items', queryset=items)).get(user=user)
+
     def list(self, request):
-        cart = self._get_cart(request.user)
-        serializer = CartSerializer(cart)
-        data = serializer.data
-        data['subtotal'] = cart.subtotal
-        return Response(data)
+        self._get_cart(request.user)
+        serializer = CartSerializer(self._cart_with_items(request.user))
+        return Response(serializer.data)
 
     @action(detail=False, methods=['post'])
     def add(self, request):
-        product_id = request.data.get('product_id')
-        qty = int(request.data.get('quantity', 1))
-        product = get_object_or_404(Product, pk=product_id)
-        cart = self._get_cart(request.user)
-        item, created = CartItem.objects.get_or_create(cart=cart, product=product,
-                                                      defaults={'quantity': qty})
-        if not created:
-            item.quantity = item.quantity + qty
-            item.save()
-        return Response({'ok': True, 'subtotal': cart.subtotal})
+        serializer = CartOperationSerializer(data={
+            'op': 'add',
+            'product_id': request.data.get('product_id'),
+            'quantity': request.data.get('quantity', 1),
+        })
+        serializer.is_valid(raise_exception=True)
+        try:
+            cart = update_cart(request.user, [serializer.validated_data])
+        except UnknownProducts:
+            raise Http404
+        except InsufficientStock as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return self._totals_response(cart)
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            update_cart(request.user, serializer.validated_data['operations'])
+        except (UnknownProducts, InsufficientStock) as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(CartSerializer(self._cart_with_items(request.user)).data)
 
     @action(detail=False, methods=['post'])
     def update_item(self, request):
         item_id = request.data.get('item_id')
         qty = int(request.data.get('quantity', 1))
-        item = get_object_or_404(CartItem, pk=item_id, cart__user=request.user)
-        if qty <= 0:
-            item.delete()
-        else:
-            item.quantity = qty
-            item.save()
-        return Response({'ok': True, 'subtotal': item.cart.subtotal if hasattr(item, 'cart') else 0})
+        item = get_object_or_404(CartItem.objects.only('product_id'), pk=item_id, cart__user=request.user)
+        # Through update_cart so the stock hold follows the new quantity.
+        try:
+            cart = update_cart(request.user, [{'op': 'set', 'product_id': item.product_id, 'quantity': max(qty, 0)}])
+        except InsufficientStock as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return self._totals_response(cart)
 
     @action(detail=False, methods=['post'])
     def remove(self, request):
         item_id = request.data.get('item_id')
-        item = get_object_or_404(CartItem, pk=item_id, cart__user=request.user)
-        cart = item.cart
-        item.delete()
-        return Response({'ok': True, 'subtotal': cart.subtotal})
+        item = get_object_or_404(CartItem.objects.only('product_id'), pk=item_id, cart__user=request.user)
+        cart = update_cart(request.user, [{'op': 'remove', 'product_id': item.product_id}])
+        return self._totals_response(cart)
+
+    def _totals_response(self, cart):
+        cart.refresh_from_db(fields=['subtotal', 'item_count'])
+        return Response({'ok': True, 'subtotal': cart.subtotal, 'item_count': cart.item_count})
 
 
 class WishlistViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
+    # The auto-created (wishlist, product) through table. Membership changes
+    # go straight to it so nothing ever loads the whole product set.
+    through = Wishlist.products.through
 
     def _get_wishlist(self, user):
         wishlist, _ = Wishlist.objects.get_or_create(user=user)
         return wishlist
 
     def list(self, request):
+        if request.query_params.get('mode') == 'ids':
+            ids = self.through.objects.filter(wishlist__user=request.user).values_list('product_id', flat=True)
+            return Response({'product_ids': list(ids)})
         wishlist = self._get_wishlist(request.user)
+        products = Product.objects.select_related('category').prefetch_related('images')
+        wishlist = Wishlist.objects.prefetch_related(Prefetch('products', queryset=products)).get(pk=wishlist.pk)
         serializer = WishlistSerializer(wishlist)
         return Response(serializer.data)
 
     @action(detail=False, methods=['post'])
     def toggle(self, request):
-        pid = request.data.get('product_id')
-        product = get_object_or_404(Product, pk=pid)
+        serializer = WishlistProductSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        pid = serializer.validated_data['product_id']
         wishlist = self._get_wishlist(request.user)
-        if product in wishlist.products.all():
-            wishlist.products.remove(product)
+        deleted, _ = self.through.objects.filter(wishlist=wishlist, product_id=pid).delete()
+        if deleted:
             return Response({'status': 'removed'})
-        else:
-            wishlist.products.add(product)
-            return Response({'status': 'added'})
+        if not Product.objects.filter(pk=pid).exists():
+            raise Http404
+        self.through.objects.bulk_create([self.through(wishlist=wishlist, product_id=pid)], ignore_conflicts=True)
+        return Response({'status': 'added'})
+
+    @action(detail=False, methods=['post'])
+    def add_many(self, request):
+        serializer = WishlistProductsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        wishlist = self._get_wishlist(request.user)
+        ids = Product.objects.filter(pk__in=serializer.validated_data['product_ids']).values_list('pk', flat=True)
+        self.through.objects.bulk_create(
+            [self.through(wishlist=wishlist, product_id=pid) for pid in ids],
+            ignore_conflicts=True,
+        )
+        return Response({'status': 'added'})
+
+    @action(detail=False, methods=['post'])
+    def remove_many(self, request):
+        serializer = WishlistProductsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.through.objects.filter(
+            wishlist__user=request.user,
+            product_id__in=serializer.validated_data['product_ids'],
+        ).delete()
+        return Response({'status': 'removed'})
 
 
 class AddressViewSet(viewsets.ModelViewSet):
@@ -115,6 +322,34 @@ class AddressViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
 
 
+class OrderViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    The user's orders, newest first. ?mode=summary returns totals and status
+    without line items.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-created_at', '-id')
+
+    def is_summary(self):
+        return self.action == 'list' and self.request.query_params.get('mode') == 'summary'
+
+    def get_serializer_class(self):
+        return OrderSummarySerializer if self.is_summary() else OrderSerializer
+
+    def get_queryset(self):
+        orders = Order.objects.filter(user=self.request.user)
+        if self.is_summary():
+            return orders.only('id', 'status', 'total', 'created_at').annotate(
+                item_count=Coalesce(Sum('items__quantity'), 0),
+            )
+        # Three queries per page however many orders and lines it holds:
+        # orders with their address, lines with product and category, images.
+        items = OrderItem.objects.select_related('product__category').prefetch_related('product__images')
+        return orders.select_related('address').prefetch_related(Prefetch('items', queryset=items.order_by('id')))
+
+
 class CheckoutAPIView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
 
@@ -122,38 +357,44 @@ class CheckoutAPIView(generics.GenericAPIView):
         address_id = request.data.get('address_id')
         address = get_object_or_404(Address, pk=address_id, user=request.user)
         cart = Cart.objects.filter(user=request.user).first()
-        if not cart or not cart.items.exists():
+        if not cart:
             return Response({'detail': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
 
-        with transaction.atomic():
-            order = Order.objects.create(user=request.user, address=address, status='PENDING')
-            total = 0
-            for item in cart.items.select_related('product'):
-                if item.quantity > item.product.stock:
-                    raise serializers.ValidationError(f"Not enough stock for {item.product.title}")
-                oi = OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    quantity=item.quantity,
-                    price=item.product.price
-                )
-                total += oi.subtotal
-                item.product.stock = max(0, item.product.stock - item.quantity)
-                item.product.save(update_fields=['stock'])
-
-            order.total = total
-            order.save(update_fields=['total'])
-            cart.items.all().delete()
+        try:
+            order = place_order(cart, address)
+        except EmptyCart:
+            return Response({'detail': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+        except InsufficientStock as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'order_id': order.id, 'total': order.total}, status=status.HTTP_201_CREATED)
 
 
+class TaskStatsAPIView(generics.GenericAPIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(taskqueue.stats())
+
+
+STOREFRONT_PAGE_SIZE = 24
+
+
 def store_home(request):
-    products = Product.objects.all()
-    return render(request, "ecommerce_app/index.html", {"products": products})
+    paginator = Paginator(Product.objects.storefront(), STOREFRONT_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get("page"))
+    products = list(page)
+    # Card fragments are cached per product version, so edits show up at once.
+    versions = product_versions([p.slug for p in products])
+    for product in products:
+        product.cache_version = versions[product.slug]
+    return render(request, "ecommerce_app/index.html", {"products": products, "page": page})
 
 def product_detail_page(request, slug):
-    product = get_object_or_404(Product, slug=slug)
+    body = get_product_json(slug)
+    if body is None:
+        raise Http404
+    product = json.loads(body)
     return render(request, "ecommerce_app/product_detail.html", {"product": product})
 
 
@@ -164,7 +405,7 @@ def cart_page(request):
     if request.user.is_authenticated:
         cart = Cart.objects.filter(user=request.user).first()
         if cart:
-            items = cart.items.all()
+            items = cart.items.select_related('product').order_by('pk')
 
     return render(request, "ecommerce_app/cart.html", {"cart": cart, "items": items})
 
@@ -176,7 +417,10 @@ def wishlist_page(request):
     if request.user.is_authenticated:
         wishlist = Wishlist.objects.filter(user=request.user).first()
         if wishlist:
-            products = wishlist.products.all()
+            products = (
+                Product.objects.filter(wishlisted_by=wishlist)
+                .only('id', 'title', 'price', 'slug', 'created_at').with_primary_image()
+            )
 
     return render(request, "ecommerce_app/wishlist.html", {"wishlist": wishlist, "products": products})
 
@@ -186,4 +430,8 @@ def checkout_page(request):
         return redirect("/login/")  # Optional
 
     addresses = Address.objects.filter(user=request.user)
-    return render(request, "ecommerce_app/checkout.html", {"addresses": addresses})
+    # A GET only reports what's short; placing the order (POST) re-checks the
+    # stock of any hold that has expired in the meantime.
+    cart = Cart.objects.filter(user=request.user).first()
+    unavailable = unavailable_products(cart) if cart is not None else []
+    return render(request, "ecommerce_app/checkout.html", {"addresses": addresses, "unavailable": unavailable})
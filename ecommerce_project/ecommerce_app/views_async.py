@@ -0,0 +1,119 @@
+"""
+Async versions of the hottest read endpoints, routed by
+ecommerce_project/urls_async.py (the default URLconf under ASGI).
+
+Under ASGI every sync view is run through sync_to_async and holds a worker
+thread for its whole duration; these views stay on the event loop and only
+hop to the sync thread for the queries themselves and template rendering. They share their
+query building with the sync views in views.py, so both return the same
+responses.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .catalog_cache import acatalog_version, aget_product_json, aproduct_versions
+from .conditional import add_validators, last_modified, list_etag, not_modified, product_etag
+from .models import Product, ProductFacet
+from .pagination import KeysetPagination
+from .serializers import ProductFilterSerializer, ProductSerializer
+from .views import (
+    STOREFRONT_PAGE_SIZE, facet_filters, filter_products, parse_product_filters, product_queryset,
+    requested_product_fields,
+)
+
+
+async def arender(request, template_name, context):
+    # Context processors and templates resolve request.user and the session
+    # lazily through the sync ORM, so the template is rendered on the sync
+    # thread; the view's own queries have already run on the loop.
+    return await sync_to_async(render)(request, template_name, context)
+
+
+def json_response(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+async def conditional(request, etag, modified, respond):
+    """As views.ConditionalGetMixin: a 304 if the client is current, else respond()."""
+    response = not_modified(request, etag, modified)
+    if response is None:
+        response = await respond()
+    user = await request.auser()
+    return add_validators(response, etag, modified, anonymous=not user.is_authenticated)
+
+
+async def product_list(request):
+    if request.method not in ('GET', 'HEAD'):
+        return json_response({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    version = await acatalog_version()
+    return await conditional(request, list_etag(request, version), last_modified(version),
+                             lambda: render_product_list(request))
+
+
+async def render_product_list(request):
+    request = Request(request)
+    params = request.query_params
+    try:
+        filters = parse_product_filters(params)
+        ordering = ProductFilterSerializer.SORTS[filters['sort']]
+        fields = requested_product_fields(params)
+        queryset = filter_products(product_queryset(fields, ordering), filters)
+        paginator = KeysetPagination()
+        paginator.ordering = ordering
+        page = await paginator.apaginate_queryset(queryset, request)
+    except APIException as exc:
+        # Same body as DRF's default exception handler.
+        data = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+        return json_response(data, status=exc.status_code)
+    serializer = ProductSerializer(page, many=True, fields=fields, context={'request': request})
+    response = paginator.get_paginated_response(serializer.data)
+    response.data['facets'] = await ProductFacet.acounts(**facet_filters(filters))
+    return json_response(response.data)
+
+
+async def product_detail(request, slug):
+    etag = product_etag((await aproduct_versions([slug]))[slug])
+    return await conditional(request, etag, last_modified(await acatalog_version()),
+                             lambda: render_product_detail(slug))
+
+
+async def render_product_detail(slug):
+    body = await aget_product_json(slug)
+    if body is None:
+        return json_response({'detail': 'Not found.'}, status=404)
+    return HttpResponse(body, content_type='application/json')
+
+
+async def store_home(request):
+    queryset = Product.objects.storefront()
+    paginator = Paginator(queryset, STOREFRONT_PAGE_SIZE)
+    # Paginator counts lazily through the sync ORM; give it the count up front.
+    paginator.count = await queryset.acount()
+    try:
+        number = paginator.validate_number(request.GET.get('page') or 1)
+    except PageNotAnInteger:
+        number = 1
+    except EmptyPage:
+        number = paginator.num_pages
+    offset = (number - 1) * STOREFRONT_PAGE_SIZE
+    page_queryset = queryset[offset:offset + STOREFRONT_PAGE_SIZE]
+    products = [p async for p in page_queryset.aiterator(chunk_size=STOREFRONT_PAGE_SIZE)]
+    versions = await aproduct_versions([p.slug for p in products])
+    for product in products:
+        product.cache_version = versions[product.slug]
+    page = Page(products, number, paginator)
+    return await arender(request, 'ecommerce_app/index.html', {'products': products, 'page': page})
+
+
+async def product_detail_page(request, slug):
+    body = await aget_product_json(slug)
+    if body is None:
+        raise Http404
+    return await arender(request, 'ecommerce_app/product_detail.html', {'product': json.loads(body)})
@@ -0,0 +1,91 @@
+"""
+Database profiles, picked in settings.py with DJANGO_DB_PROFILE:
+
+    sqlite        (default) db.sqlite3 tuned for concurrent writers: write
+                  transactions take the lock up front (BEGIN IMMEDIATE) and
+                  every connection runs SQLITE_PRAGMAS (ecommerce_app/db.py)
+    sqlite-plain  db.sqlite3 with Django's defaults, for comparison
+    postgresql    the POSTGRES_* environment variables; with psycopg's
+                  in-process pool, or with DJANGO_DB_POOL=0 persistent
+                  connections (DJANGO_CONN_MAX_AGE seconds) health-checked
+                  before reuse
+
+Replicas, as DATABASES aliases replica1, replica2... for ecommerce_app/routers.py:
+DJANGO_DB_REPLICAS=N adds N SQLite files db.replica<n>.sqlite3 standing in for
+replicas (`manage.py sync_replicas` copies the primary into them), and
+POSTGRES_REPLICA_HOSTS a comma-separated list of PostgreSQL replica hosts.
+In tests every replica mirrors the primary.
+"""
+SQLITE_PRAGMAS = {
+    # Readers no longer block the writer or each other.
+    'journal_mode': 'wal',
+    # Sync the WAL at checkpoints rather than every commit: still safe against
+    # application crashes, a power cut can lose the last transactions.
+    'synchronous': 'normal',
+    # Milliseconds to wait for the write lock before "database is locked".
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    # Negative: KiB, so 64 MB of page cache per connection.
+    'cache_size': -64 * 1024,
+}
+
+
+def sqlite(base_dir, tuned=True):
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': base_dir / 'db.sqlite3',
+        'TEST': {'NAME': base_dir / 'test_db.sqlite3'},
+    }
+    if tuned:
+        # A deferred transaction that reads first and writes later can't wait
+        # for the lock (it would deadlock), so SQLite fails it at once.
+        database['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+    return database
+
+
+def postgresql(environ):
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': environ.get('POSTGRES_DB', 'ecommerce'),
+        'USER': environ.get('POSTGRES_USER', 'ecommerce'),
+        'PASSWORD': environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': environ.get('POSTGRES_PORT', '5432'),
+    }
+    if environ.get('DJANGO_DB_POOL', '1') != '0':
+        # Needs psycopg[pool]. Django doesn't allow CONN_MAX_AGE with a pool:
+        # connections go back to the pool at the end of each request.
+        database['OPTIONS'] = {'pool': {
+            'min_size': int(environ.get('DJANGO_DB_POOL_MIN', 2)),
+            'max_size': int(environ.get('DJANGO_DB_POOL_MAX', 10)),
+            'timeout': 10,
+        }}
+    else:
+        database['CONN_MAX_AGE'] = int(environ.get('DJANGO_CONN_MAX_AGE', 600))
+        database['CONN_HEALTH_CHECKS'] = True
+    return database
+
+
+def replica(primary, **changes):
+    return {**primary, **changes, 'TEST': {'MIRROR': 'default'}}
+
+
+def databases(profile, base_dir, environ):
+    """DATABASES and SQLITE_PRAGMAS for a profile."""
+    if profile in ('sqlite', 'sqlite-plain'):
+        primary = sqlite(base_dir, tuned=profile == 'sqlite')
+        replicas = [
+            replica(primary, NAME=base_dir / f'db.replica{n}.sqlite3')
+            for n in range(1, int(environ.get('DJANGO_DB_REPLICAS', 0)) + 1)
+        ]
+        pragmas = SQLITE_PRAGMAS if profile == 'sqlite' else {}
+    elif profile == 'postgresql':
+        primary = postgresql(environ)
+        hosts = filter(None, environ.get('POSTGRES_REPLICA_HOSTS', '').split(','))
+        replicas = [replica(primary, HOST=host.strip()) for host in hosts]
+        pragmas = {}
+    else:
+        raise ValueError(f"Unknown DJANGO_DB_PROFILE {profile!r}: use sqlite, sqlite-plain or postgresql")
+    result = {'default': primary}
+    result.update((f'replica{n}', database) for n, database in enumerate(replicas, 1))
+    return result, pragmas
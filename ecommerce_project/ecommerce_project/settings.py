@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from . import db_profiles
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -53,6 +56,9 @@ STATICFILES_DIRS = [
 
 
 MIDDLEWARE = [
+    'ecommerce_app.metrics.MetricsMiddleware',
+    'ecommerce_app.routers.ReplicaRoutingMiddleware',
+    'ecommerce_app.page_cache.PageCacheMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,11 +68,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'ecommerce_project.urls'
+# asgi.py selects ecommerce_project.urls_async, which swaps in async views.
+ROOT_URLCONF = os.environ.get('DJANGO_ROOT_URLCONF', 'ecommerce_project.urls')
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing template rendering for ecommerce_app.metrics.
+        'BACKEND': 'ecommerce_app.metrics.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,17 +89,106 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'ecommerce_project.wsgi.application'
 
+REST_FRAMEWORK = {
+    # DRF's JSON and browsable API renderers, timed for ecommerce_app.metrics.
+    'DEFAULT_RENDERER_CLASSES': [
+        'ecommerce_app.metrics.JSONRenderer',
+        'ecommerce_app.metrics.BrowsableAPIRenderer',
+    ],
+}
+
+# Request metrics (ecommerce_app/metrics.py), served at /metrics to staff users
+# and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>". Unset, only
+# staff can read them.
+METRICS_TOKEN = os.environ.get('DJANGO_METRICS_TOKEN')
+# Log queries repeated this many times within one request, with the line that
+# issued them.
+METRICS_DEBUG_QUERIES = DEBUG
+METRICS_DUPLICATE_QUERY_THRESHOLD = 3
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
-
-DATABASES = {
+# DJANGO_DB_PROFILE picks sqlite (the default, tuned for concurrent writes),
+# sqlite-plain or postgresql; see db_profiles.py. SQLITE_PRAGMAS run on every
+# new SQLite connection.
+DB_PROFILE = os.environ.get('DJANGO_DB_PROFILE', 'sqlite')
+DATABASES, SQLITE_PRAGMAS = db_profiles.databases(DB_PROFILE, BASE_DIR, os.environ)
+
+# Read replicas (ecommerce_app/routers.py): catalog reads of these views go
+# to one of DATABASE_REPLICAS, picked 'round-robin' or 'least-loaded'; a
+# client that wrote reads from the primary for REPLICA_PIN_SECONDS after.
+DATABASE_ROUTERS = ['ecommerce_app.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+REPLICA_SELECTION = 'round-robin'
+REPLICA_PIN_SECONDS = 5
+REPLICA_VIEWS = ['store-home', 'product-list', 'product-detail', 'product-detail-page', 'product-search']
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+#
+# The "products" cache holds serialized product JSON and "pages" rendered
+# storefront pages. Each is a bounded LRU in local memory by default; point
+# them at django.core.cache.backends.redis.RedisCache (or FileBasedCache as a
+# local stand-in) to share them between processes.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'products': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'products',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pages',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 3000},
+    },
 }
 
+PRODUCT_CACHE_ALIAS = 'products'
+
+# Rendered pages of these views for anonymous visitors (page_cache.py), with
+# their gzip and brotli copies. A request finding a page missing while another
+# renders it waits up to PAGE_CACHE_LOCK_WAIT seconds for that render.
+PAGE_CACHE_ALIAS = 'pages'
+PAGE_CACHE_VIEWS = ['store-home', 'product-detail-page']
+PAGE_CACHE_LOCK_WAIT = 5
+
+# Cache-Control for anonymous catalog API responses (conditional.py): seconds
+# a shared cache may serve them fresh, then keep serving them stale while it
+# revalidates with If-None-Match.
+CATALOG_CACHE_MAX_AGE = 60
+CATALOG_STALE_WHILE_REVALIDATE = 300
+
+# Seconds a cart's stock hold lasts after its last change.
+# Expired holds are given back by `python manage.py release_expired_reservations`.
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Sharded stock (stock_shards.py): seconds a shard total is cached for reads,
+# and the most often a product's stock mirror is refreshed after checkouts.
+STOCK_SHARD_CACHE_SECONDS = 2
+STOCK_SHARD_SYNC_SECONDS = 5
+
+# Background tasks (taskqueue.py), run with `python manage.py run_tasks`.
+TASK_WORKERS = 4
+TASK_POLL_INTERVAL = 1.0
+# A running task whose worker hasn't finished it within this long is retried.
+TASK_LEASE_SECONDS = 300
+# (base, cap) seconds of exponential retry backoff.
+TASK_RETRY_BACKOFF = (10, 3600)
+# Run tasks in-process as soon as the enqueuing transaction commits, with no
+# worker needed.
+TASKS_EAGER = False
+
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+DEFAULT_FROM_EMAIL = 'orders@example.com'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -17,8 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path,include
 
+from ecommerce_app.metrics import metrics_view
+
 urlpatterns = [
      path("", include("ecommerce_app.urls_frontend")),
     path('admin/', admin.site.urls),
     path('api/', include('ecommerce_app.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
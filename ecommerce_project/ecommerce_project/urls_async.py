@@ -0,0 +1,20 @@
+"""
+URL configuration used under ASGI (see asgi.py): the catalog read endpoints
+are served by the native async views in ecommerce_app.views_async, everything
+else by the same views as ecommerce_project.urls.
+"""
+from django.urls import path
+
+from ecommerce_app import views_async
+from ecommerce_app.views import ProductSearchAPIView
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path("", views_async.store_home, name="store-home"),
+    path("product/<slug:slug>/", views_async.product_detail_page, name="product-detail-page"),
+    path('api/products/', views_async.product_list, name='product-list'),
+    # Listed here so the async detail route below doesn't swallow it.
+    path('api/products/search/', ProductSearchAPIView.as_view(), name='product-search'),
+    path('api/products/<slug:slug>/', views_async.product_detail, name='product-detail'),
+] + sync_urlpatterns